@@ -1,27 +1,172 @@
-from flask import Flask, render_template, jsonify, request, send_from_directory, redirect, url_for
+from flask import Flask, render_template, jsonify, request, send_from_directory, redirect, url_for, Response, send_file, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as SesionFlask
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.wsgi import ClosingIterator
 import urllib.request
+import urllib.parse
+import hmac
+import hashlib
 import json
 import jwt
 import datetime
 from functools import wraps
+from contextlib import contextmanager
 import os
+import sys
 from xml.etree import ElementTree as ET
 import re
+import io
+import csv
+import zipfile
+import tempfile
+import math
+import heapq
+import unicodedata
+import time
+import threading
+import atexit
+import cProfile
+import pstats
+import mmap
+import struct
+import fcntl
+from collections import OrderedDict, Counter
+from bisect import bisect_left, bisect_right
+from array import array
+from zoneinfo import ZoneInfo
+import click
+import numpy as np
+from PIL import Image, ImageOps
+from sqlalchemy import event, exc
+from sqlalchemy import orm as sa_orm
+from sqlalchemy.schema import CreateColumn
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'combimap_secret_key_2025'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root@localhost/MiCombiBackend'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('COMBIMAP_DATABASE_URI', 'mysql+pymysql://root@localhost/MiCombiBackend')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['CACHE_FOLDER'] = 'cache'
+app.config['STREAM_ROUTES_BATCH'] = 50     # rutas por lote en respuestas streaming
+app.config['STREAM_ROWS_BATCH'] = 1000     # filas simples por lote
 app.config['ALLOWED_EXTENSIONS'] = {'kml', 'kmz'}
 
-# Crear carpeta de uploads si no existe
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Geocodificación inversa (las pruebas de carga apuntan a un sustituto local)
+app.config['NOMINATIM_URL'] = os.environ.get('COMBIMAP_NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+app.config['NOMINATIM_TIMEOUT'] = 5           # segundos
 
-db = SQLAlchemy(app)
+# Posiciones de vehículos en tiempo real
+app.config['VEHICLE_API_KEY'] = os.environ.get('COMBIMAP_VEHICLE_KEY')   # sin clave no se aceptan lecturas (503)
+app.config['VEHICLE_STATE_FILE'] = os.path.join(app.root_path, 'cache', 'vehiculos.bin')
+app.config['VEHICLE_MAX_TRACKED'] = int(os.environ.get('COMBIMAP_VEHICLE_MAX_TRACKED', 1000))   # lleno, se reemplaza el que lleva más sin reportar
+app.config['VEHICLE_TTL_SECONDS'] = 3600      # vehículos sin reportar liberan su lugar
+app.config['VEHICLE_MAX_FIXES'] = 500         # lecturas por petición
+app.config['VEHICLE_BUFFER_SIZE'] = 32        # posiciones recientes por vehículo
+app.config['VEHICLE_FLUSH_SIZE'] = 500        # filas de historial por inserción
+app.config['VEHICLE_FLUSH_SECONDS'] = 10      # antigüedad máxima del lote pendiente
+app.config['VEHICLE_STALE_SECONDS'] = 300     # vehículos sin reportar se ocultan
+app.config['VEHICLE_STREAM_INTERVAL'] = 1.0   # agrupación mínima de eventos SSE
+app.config['VEHICLE_STREAM_MAX_SECONDS'] = 600   # el navegador se reconecta solo al cerrarse el stream
+app.config['VEHICLE_STREAM_ASYNC'] = False    # asgi.py lo activa: solo ahí el stream no ocupa un hilo por cliente
+app.config['VEHICLE_POLL_SECONDS'] = 10       # sin stream, el mapa consulta /api/vehicles con este intervalo
+app.config['VEHICLE_SNAP_TOLERANCE'] = 60     # metros para ajustar a la ruta
+
+# Agrupación de paradas en el mapa público
+app.config['CLUSTER_RADIUS_PX'] = 60          # radio de agrupación en píxeles de pantalla
+app.config['CLUSTER_MIN_ZOOM'] = 0
+app.config['CLUSTER_MAX_ZOOM'] = 16           # desde el zoom 17 (calle) se ven paradas sueltas
+
+# Pool de conexiones y réplica de lectura (opcional)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('COMBIMAP_DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('COMBIMAP_DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('COMBIMAP_DB_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.environ.get('COMBIMAP_DB_POOL_RECYCLE', 1800)),   # antes del wait_timeout de MySQL
+    'pool_pre_ping': os.environ.get('COMBIMAP_DB_PRE_PING', '1') != '0',
+}
+if os.environ.get('COMBIMAP_REPLICA_URI'):
+    # Las opciones del pool no se heredan a los binds: se repiten para la réplica
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica': dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'], url=os.environ['COMBIMAP_REPLICA_URI'])
+    }
+app.config['REPLICA_STICKY_SECONDS'] = 10     # lecturas a la primaria tras escribir (retraso de replicación)
+app.config['REPLICA_STICKY_COOKIE'] = 'combimap_escritura'
+
+class SesionEnrutada(SesionFlask):
+    """
+    Sesión que manda a la réplica los SELECT de las peticiones públicas (ver
+    _elegir_base_de_datos) y todo lo demás a la primaria. Solo los flush y
+    las sentencias INSERT/UPDATE/DELETE cuentan como escrituras; el SQL
+    textual (text(), EXPLAIN) va a la primaria sin fijar al cliente en ella.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and 'replica' in self._db.engines and has_request_context():
+            if self._flushing or getattr(clause, 'is_dml', False):
+                g.escribio_en_primaria = True
+            elif g.get('leer_de_replica') and getattr(clause, 'is_select', False):
+                return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': SesionEnrutada})
+
+@app.before_request
+def _elegir_base_de_datos():
+    """GET públicos leen de la réplica, salvo que el cliente haya escrito hace poco"""
+    if 'replica' not in app.config.get('SQLALCHEMY_BINDS', {}):
+        return
+    try:
+        ultima_escritura = float(request.cookies.get(app.config['REPLICA_STICKY_COOKIE'], 0))
+    except ValueError:
+        ultima_escritura = 0
+    g.leer_de_replica = (
+        request.method in ('GET', 'HEAD')
+        and not request.path.startswith('/api/admin')
+        and time.time() - ultima_escritura > app.config['REPLICA_STICKY_SECONDS']
+    )
+
+@app.after_request
+def _fijar_lecturas_en_primaria(response):
+    """Tras una escritura el cliente lee de la primaria unos segundos (read-your-writes)"""
+    if g.get('escribio_en_primaria'):
+        response.set_cookie(app.config['REPLICA_STICKY_COOKIE'], f"{time.time():.3f}",
+                            max_age=app.config['REPLICA_STICKY_SECONDS'], httponly=True, samesite='Lax')
+    return response
+
+@contextmanager
+def lecturas_en_primaria():
+    """
+    Lecturas a la primaria dentro del bloque. Lo usan las cachés que duran
+    más que la petición: lo que leyeran de una réplica atrasada quedaría
+    guardado aunque la réplica se ponga al día.
+    """
+    replica = has_request_context() and g.get('leer_de_replica')
+    if replica:
+        g.leer_de_replica = False
+    try:
+        yield
+    finally:
+        if replica:
+            g.leer_de_replica = True
+
+@contextmanager
+def lectura_consistente():
+    """
+    Conexión a la primaria en la que todas las consultas ven el mismo estado
+    de la base: REPEATABLE READ en MySQL y, en SQLite, un BEGIN explícito
+    (pysqlite no abre transacción para los SELECT). Al salir se deshace.
+    """
+    with db.engine.connect() as conexion:
+        if conexion.dialect.name == 'sqlite':
+            conexion.exec_driver_sql('BEGIN')
+        else:
+            conexion.execution_options(isolation_level='REPEATABLE READ')
+        try:
+            yield conexion
+        finally:
+            conexion.rollback()
 
 # --- Modelos de la Base de Datos ---
 
@@ -58,11 +203,16 @@ class Ruta(db.Model):
     costo = db.Column(db.Numeric(6, 2))
     descripcion = db.Column(db.Text)
     activa = db.Column(db.Boolean, default=True)
+    # Contadores desnormalizados (ver "Contadores de Rutas")
+    num_coordenadas = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    num_paradas = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    longitud_m = db.Column(db.Float, nullable=False, default=0, server_default='0')
     
     base_inicio = db.relationship('Base', foreign_keys=[base_inicio_id])
     base_fin = db.relationship('Base', foreign_keys=[base_fin_id])
     coordenadas = db.relationship('RutaCoordenada', backref='ruta', order_by='RutaCoordenada.orden', cascade="all, delete-orphan")
     paradas = db.relationship('RutaParada', backref='ruta', order_by='RutaParada.orden', cascade="all, delete-orphan")
+    servicios = db.relationship('RutaServicio', backref='ruta', order_by='RutaServicio.hora_inicio', cascade="all, delete-orphan")
 
 class Parada(db.Model):
     __tablename__ = 'paradas'
@@ -82,6 +232,10 @@ class RutaCoordenada(db.Model):
     longitud = db.Column(db.Numeric(11, 8), nullable=False)
     orden = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_ruta_coordenadas_ruta_orden', 'ruta_id', 'orden'),
+    )
+
 class RutaParada(db.Model):
     __tablename__ = 'ruta_paradas'
     id = db.Column(db.Integer, primary_key=True)
@@ -90,6 +244,60 @@ class RutaParada(db.Model):
     orden = db.Column(db.Integer, nullable=False)
     parada = db.relationship('Parada')
 
+    __table_args__ = (
+        db.Index('ix_ruta_paradas_ruta_orden', 'ruta_id', 'orden'),
+        # Índice único (no UniqueConstraint) para que SQLite y MySQL lo creen igual
+        db.Index('uq_ruta_paradas_ruta_parada', 'ruta_id', 'parada_id', unique=True),
+    )
+
+class RutaServicio(db.Model):
+    """Banda horaria de servicio de una ruta: de hora_inicio a hora_fin, una salida cada intervalo"""
+    __tablename__ = 'ruta_servicios'
+    id = db.Column(db.Integer, primary_key=True)
+    ruta_id = db.Column(db.Integer, db.ForeignKey('rutas.id', ondelete='CASCADE'), nullable=False)
+    tipo_dia = db.Column(db.Enum('laborable', 'sabado', 'domingo'), nullable=False)
+    hora_inicio = db.Column(db.Time, nullable=False)
+    hora_fin = db.Column(db.Time, nullable=False)
+    intervalo_minutos = db.Column(db.Integer, nullable=False)
+
+class VehiculoPosicion(db.Model):
+    __tablename__ = 'vehiculo_posiciones'
+    id = db.Column(db.Integer, primary_key=True)
+    vehiculo_id = db.Column(db.String(50), nullable=False)
+    ruta_id = db.Column(db.Integer, db.ForeignKey('rutas.id', ondelete='SET NULL'))
+    latitud = db.Column(db.Numeric(10, 8), nullable=False)
+    longitud = db.Column(db.Numeric(11, 8), nullable=False)
+    distancia_ruta = db.Column(db.Float)
+    desvio = db.Column(db.Float)
+    registrado = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_vehiculo_posiciones_vehiculo_registrado', 'vehiculo_id', 'registrado'),
+    )
+
+class CambioRed(db.Model):
+    """Registro de cambios de rutas y paradas; `version` es la versión de los datos que los incluye"""
+    __tablename__ = 'cambios_red'
+    id = db.Column(db.Integer, primary_key=True)
+    entidad = db.Column(db.Enum('ruta', 'parada'), nullable=False)
+    entidad_id = db.Column(db.Integer, nullable=False)
+    operacion = db.Column(db.Enum('upsert', 'delete'), nullable=False)
+    creado = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    version = db.Column(db.Integer, index=True)   # se asigna al confirmar (ver _asignar_version_red)
+
+class VersionRed(db.Model):
+    """Contador de versiones de la red: una sola fila (id=1) que sube en cada commit con cambios"""
+    __tablename__ = 'red_version'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class VersionEsquema(db.Model):
+    """Migraciones del esquema aplicadas a la base de datos (ver "Migraciones del Esquema")"""
+    __tablename__ = 'esquema_versiones'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    nombre = db.Column(db.String(100), nullable=False)
+    aplicada = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
 # --- Decorador de Autenticación ---
 
 def token_required(f):
@@ -111,6 +319,886 @@ def token_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+# --- Registro de Cambios de la Red ---
+
+# Funciones a llamar después de confirmar cambios de rutas/paradas (p. ej. para
+# invalidar cachés en memoria). Reciben una lista de (entidad, id, operacion),
+# o None cuando no se sabe qué cambió y hay que descartar todo.
+_manejadores_cambio = []
+
+def al_cambiar_red(f):
+    """Registra una función a ejecutar después de cada commit con cambios en la red"""
+    _manejadores_cambio.append(f)
+    return f
+
+def registrar_cambio(entidad, entidad_id, operacion='upsert', propagar=True):
+    """
+    Agrega una entrada al registro de cambios dentro de la transacción actual.
+    Los cambios de una parada también marcan las rutas que la usan, porque la
+    representación pública de la ruta incluye sus paradas (propagar=False lo
+    omite, p. ej. para paradas recién creadas).
+    """
+    pendientes = db.session.info.setdefault('cambios_red', [])
+    vistos = db.session.info.setdefault('cambios_red_vistos', set())
+    if (entidad, entidad_id, operacion) in vistos:
+        return
+    vistos.add((entidad, entidad_id, operacion))
+    pendientes.append((entidad, entidad_id, operacion))
+    fila = CambioRed(entidad=entidad, entidad_id=entidad_id, operacion=operacion)
+    db.session.info.setdefault('cambios_red_filas', []).append(fila)
+    db.session.add(fila)
+
+    if entidad == 'parada' and propagar:
+        rutas = db.session.query(RutaParada.ruta_id).filter_by(parada_id=entidad_id).distinct().all()
+        for (ruta_id,) in rutas:
+            registrar_cambio('ruta', ruta_id)
+
+def version_red(conexion=None):
+    """Versión actual de los datos de la red (la del último commit con cambios)"""
+    return (conexion or db.session).scalar(db.select(VersionRed.version).where(VersionRed.id == 1)) or 0
+
+def version_compactada():
+    """Versión más antigua desde la que todavía se puede sincronizar por deltas"""
+    minimo = db.session.query(db.func.min(CambioRed.version)).scalar()
+    return minimo - 1 if minimo else 0
+
+def subir_version_red(conexion):
+    """Reserva la siguiente versión dentro de la transacción de `conexion` y la regresa"""
+    tabla = VersionRed.__table__
+    if not conexion.execute(tabla.update().where(tabla.c.id == 1).values(version=tabla.c.version + 1)).rowcount:
+        # Base creada sin migraciones: la fila se crea a partir del registro
+        ultima = conexion.scalar(db.select(db.func.max(db.func.coalesce(CambioRed.version, CambioRed.id))))
+        conexion.execute(tabla.insert().values(id=1, version=(ultima or 0) + 1))
+    return conexion.scalar(db.select(tabla.c.version).where(tabla.c.id == 1))
+
+@event.listens_for(db.session, 'before_commit')
+def _asignar_version_red(session):
+    # Los ids autoincrementales se asignan al insertar pero se ven al confirmar,
+    # así que un id menor puede aparecer después de que un cliente ya leyó uno
+    # mayor. La versión sale de un contador de una sola fila que se actualiza
+    # justo antes del commit: su bloqueo ordena a las transacciones que
+    # escriben y las versiones se hacen visibles en el orden en que se asignan.
+    filas = session.info.get('cambios_red_filas')
+    if not filas:
+        return
+    session.flush()
+    version = subir_version_red(session.connection())
+    for fila in filas:
+        fila.version = version
+    session.flush()
+    session.info['version_red_nueva'] = version
+
+@event.listens_for(db.session, 'after_commit')
+def _notificar_cambios_red(session):
+    session.info.pop('cambios_red_vistos', None)
+    session.info.pop('cambios_red_filas', None)
+    cambios = session.info.pop('cambios_red', None)
+    nueva = session.info.pop('version_red_nueva', None)
+    if cambios:
+        for manejador in _manejadores_cambio:
+            manejador(cambios)
+    if nueva:
+        # Este proceso ya aplicó sus cambios; avanza sin repetirlos si no hay huecos
+        with _sincronizacion_lock:
+            local = _sincronizacion['version']
+            if local is not None and local >= nueva - 1:
+                _sincronizacion['version'] = max(local, nueva)
+        contador_version_red.subir(nueva)
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_cambios_red(session):
+    session.info.pop('cambios_red', None)
+    session.info.pop('cambios_red_vistos', None)
+    session.info.pop('cambios_red_filas', None)
+    session.info.pop('version_red_nueva', None)
+
+# Invalidación entre workers: cada commit con cambios sube un contador de
+# 8 bytes en un archivo mapeado en memoria que comparten todos los procesos
+# de la máquina. Antes de cada petición el worker compara el contador con
+# la última versión que aplicó y, si quedó atrás, lee del registro solo los
+# cambios nuevos y se los pasa a los mismos manejadores de al_cambiar_red.
+# Quien escribe fuera de la aplicación (p. ej. panelAdmin/import_kml.py en
+# otra máquina) puede no alcanzar el archivo; por eso cada tantos segundos
+# el worker también consulta la versión en la base de datos.
+
+app.config['NETWORK_VERSION_FILE'] = os.path.join(app.root_path, 'cache', 'version_red.bin')
+app.config['NETWORK_VERSION_POLL'] = float(os.environ.get('COMBIMAP_NETWORK_VERSION_POLL', 30))   # segundos; 0 no consulta
+
+class ContadorCompartido:
+    """Entero de 64 bits en un archivo mmap; solo aumenta"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.mapa = None
+
+    def _abrir(self):
+        if self.mapa is None:
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+            fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < 8:
+                    os.ftruncate(fd, 8)
+                self.mapa = mmap.mmap(fd, 8)
+            finally:
+                os.close(fd)
+        return self.mapa
+
+    def leer(self):
+        return struct.unpack_from('<Q', self._abrir())[0]
+
+    def subir(self, valor, forzar=False):
+        mapa = self._abrir()
+        with open(self.ruta, 'rb') as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                if forzar or valor > struct.unpack_from('<Q', mapa)[0]:
+                    struct.pack_into('<Q', mapa, 0, valor)
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+
+contador_version_red = ContadorCompartido(app.config['NETWORK_VERSION_FILE'])
+_sincronizacion_lock = threading.Lock()
+_sincronizacion = {'version': None, 'consultada': 0.0}    # última versión aplicada en este proceso
+
+def _version_de_la_base():
+    """Versión en la base de datos si ya toca consultarla (NETWORK_VERSION_POLL), si no None"""
+    intervalo = app.config['NETWORK_VERSION_POLL']
+    ahora = time.monotonic()
+    if not intervalo or ahora - _sincronizacion['consultada'] < intervalo:
+        return None
+    _sincronizacion['consultada'] = ahora
+    with lecturas_en_primaria():
+        version = version_red()
+    contador_version_red.subir(version)
+    return version
+
+def sincronizar_cambios_red():
+    """Aplica en este proceso los cambios confirmados por otros workers"""
+    compartida = contador_version_red.leer()
+    local = _sincronizacion['version']
+    if local is not None and compartida <= local:
+        compartida = _version_de_la_base()
+        if compartida is None or compartida <= local:
+            return
+
+    # El registro se lee de la primaria: los manejadores recargan lo que cambió
+    # y una réplica atrasada les daría las filas anteriores
+    with _sincronizacion_lock, lecturas_en_primaria():
+        local = _sincronizacion['version']
+        if local is None:
+            # Primer uso: las cachés se cargan al vuelo con los datos actuales
+            _sincronizacion['consultada'] = time.monotonic()
+            version = version_red()
+            # Un contador adelantado respecto a la primaria viene de otra base de datos (p. ej. restaurada)
+            contador_version_red.subir(version, forzar=compartida > version)
+            _sincronizacion['version'] = version
+            return
+        if compartida <= local:
+            return
+
+        if local < version_compactada():
+            # El registro ya no tiene todos los cambios desde nuestra versión
+            cambios, nueva = None, version_red()
+        else:
+            filas = db.session.query(CambioRed.version, CambioRed.entidad, CambioRed.entidad_id, CambioRed.operacion)\
+                .filter(CambioRed.version > local).order_by(CambioRed.version, CambioRed.id).all()
+            if not filas:
+                return
+            cambios = list(dict.fromkeys((f.entidad, f.entidad_id, f.operacion) for f in filas))
+            nueva = filas[-1].version
+
+        for manejador in _manejadores_cambio:
+            manejador(cambios)
+        _sincronizacion['version'] = nueva
+
+def version_sincronizada():
+    """
+    Versión de la red ya aplicada en este proceso. Las cachés que se arman
+    por versión la usan como llave: sincronizar_cambios_red() la mantiene
+    al día con el contador compartido, sin una consulta por petición.
+    """
+    if _sincronizacion['version'] is None:
+        sincronizar_cambios_red()
+    return _sincronizacion['version']
+
+@app.before_request
+def _sincronizar_antes_de_peticion():
+    if request.endpoint not in ('static', 'media_file'):
+        sincronizar_cambios_red()
+
+@app.cli.command('compactar-cambios')
+@click.option('--dias', default=30, show_default=True, help='Días de historial a conservar')
+def compactar_cambios(dias):
+    """Elimina entradas antiguas del registro de cambios (conserva la última)"""
+    limite = datetime.datetime.utcnow() - datetime.timedelta(days=dias)
+    ultima = version_red()
+    borrados = CambioRed.query.filter(CambioRed.creado < limite, CambioRed.version < ultima).delete()
+    db.session.commit()
+    print(f"Registro de cambios compactado: {borrados} entradas eliminadas (versión actual {ultima})")
+
+class IndiceEnMemoria:
+    """
+    Base de los índices en memoria que se mantienen con el registro de cambios.
+
+    Los datos publicados (self.datos) no se modifican nunca: cargar() y
+    actualizar() construyen unos nuevos y los publican cambiando una sola
+    referencia. Las consultas no toman el candado; leen self.datos una vez
+    y trabajan con esa versión aunque mientras tanto se publique otra.
+
+    Las subclases implementan _construir() (todo desde la base de datos) y
+    _aplicar(datos, pendientes) (una copia con los cambios aplicados), y
+    pueden redefinir _pendientes(cambios) para filtrar lo que les interesa.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()              # una sola reconstrucción a la vez
+        self.lock_pendientes = threading.Lock()   # lo toman también los commits (marcar)
+        self.datos = None
+        self.pendientes = set()
+        self.recargar = True
+
+    def _pendientes(self, cambios):
+        return {(entidad, entidad_id) for entidad, entidad_id, _ in cambios}
+
+    def marcar(self, cambios):
+        with self.lock_pendientes:
+            if cambios is None:
+                self.recargar = True
+            else:
+                self.pendientes |= self._pendientes(cambios)
+
+    def cargar(self):
+        """Reconstruye todo desde la base de datos"""
+        with self.lock_pendientes:
+            self.recargar = True
+        self.actualizar()
+
+    def actualizar(self):
+        """Aplica los cambios marcados desde la última vez (o carga todo si hace falta)"""
+        if not self.recargar and not self.pendientes:
+            return
+        with self.lock:
+            with self.lock_pendientes:
+                recargar, self.recargar = self.recargar, False
+                pendientes, self.pendientes = self.pendientes, set()
+            try:
+                with lecturas_en_primaria():
+                    if recargar:
+                        self.datos = self._construir()
+                    elif pendientes:
+                        self.datos = self._aplicar(self.datos, pendientes)
+            except Exception:
+                # Se reintenta en la siguiente petición
+                with self.lock_pendientes:
+                    self.recargar = self.recargar or recargar
+                    self.pendientes |= pendientes
+                raise
+
+    def _construir(self):
+        raise NotImplementedError
+
+    def _aplicar(self, datos, pendientes):
+        raise NotImplementedError
+
+# --- Límite de Peticiones y Control de Carga ---
+
+# Cada cliente (IP) tiene una cubeta de fichas que se recarga con el tiempo y
+# cada endpoint cuesta cierto número de fichas; sin fichas se responde 429.
+# Las cubetas y los contadores viven en un archivo mmap que comparten todos
+# los workers de la máquina, con el mismo bloqueo flock que ContadorCompartido.
+# Además, la máquina atiende a la vez un número limitado de peticiones de
+# la API pública (contadas por worker en el mismo archivo); si una espera
+# turno más que el presupuesto (contando lo que ya esperó en el proxy) se
+# descarta con 503 y Retry-After.
+#
+# Una IP puede ser de muchos usuarios (NAT de los operadores móviles), así
+# que la cubeta alcanza para varias cargas completas del mapa seguidas.
+
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_FILE'] = os.path.join(app.root_path, 'cache', 'limites.bin')
+app.config['RATE_LIMIT_CAPACITY'] = int(os.environ.get('COMBIMAP_RATE_LIMIT_CAPACITY', 600))    # fichas por cliente (ráfaga máxima)
+app.config['RATE_LIMIT_REFILL'] = float(os.environ.get('COMBIMAP_RATE_LIMIT_REFILL', 10.0))    # fichas recuperadas por segundo
+app.config['RATE_LIMIT_CLIENTS'] = 16384      # cubetas en la tabla compartida
+app.config['RATE_LIMIT_TRUST_PROXY'] = os.environ.get('COMBIMAP_TRUST_PROXY') == '1'   # IP de X-Forwarded-For (solo detrás de un proxy propio)
+app.config['RATE_LIMIT_DEFAULT_COST'] = 1     # otros endpoints de /api/ (fuera de /api/admin)
+app.config['RATE_LIMIT_COSTS'] = {
+    'get_routes': 5,
+    'sync_network': 5,
+    'get_all_stops': 3,
+    'export_gtfs': 30,
+    'isochrone': 10,
+    'reverse_geocode_api': 10,    # consulta a Nominatim
+    'routes_near': 1,
+    'search': 1,                  # una por tecla al autocompletar
+    'get_stop_clusters': 1,       # una por cada movimiento del mapa
+    'login': 10,
+    'contact': 20,
+    'vehicles_ping': 0,           # autenticada con su propia clave
+}
+# Peticiones de la API pública a la vez en toda la máquina; por omisión, por
+# debajo de los hilos de gunicorn (workers × threads) para que sí se alcance
+app.config['API_MAX_CONCURRENT'] = int(os.environ.get('COMBIMAP_API_MAX_CONCURRENT', (os.cpu_count() or 1) * 4))
+app.config['API_QUEUE_BUDGET'] = 0.5          # segundos máximos de espera antes de descartar
+app.config['API_QUEUE_POLL'] = 0.01           # segundos entre intentos mientras se espera cupo
+app.config['API_RETRY_AFTER'] = 2             # segundos sugeridos al cliente tras un 503
+app.config['API_SHED_EXEMPT'] = set()         # endpoints que no ocupan cupo
+app.config['METRICS_TOKEN'] = os.environ.get('COMBIMAP_METRICS_TOKEN')
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class LimitadorCompartido:
+    """Cubetas de fichas por cliente, contadores por endpoint y peticiones en curso en un archivo mmap"""
+
+    _CABECERA = struct.Struct('<8sII')    # magia, cubetas, filas de contadores
+    _CONTADOR = struct.Struct('<56s3Q')   # endpoint, permitidas, limitadas, descartadas
+    _EN_CURSO = struct.Struct('<II')      # pid del worker, peticiones que atiende
+    _CUBETA = struct.Struct('<Qdd')       # hash del cliente, fichas, última actualización
+    _MAGIA = b'CMLIM002'
+    FILAS_CONTADORES = 256
+    FILAS_EN_CURSO = 256
+    SONDEOS = 8                           # cubetas revisadas por cliente (direccionamiento abierto)
+    RESULTADOS = ('allowed', 'limited', 'shed')
+
+    def __init__(self, ruta, cubetas):
+        self.ruta = ruta
+        self.cubetas = cubetas
+        self.mapa = None
+        self.filas = {}                   # endpoint -> desplazamiento de su fila de contadores
+
+    def _inicio_en_curso(self):
+        return self._CABECERA.size + self.FILAS_CONTADORES * self._CONTADOR.size
+
+    def _inicio_cubetas(self):
+        return self._inicio_en_curso() + self.FILAS_EN_CURSO * self._EN_CURSO.size
+
+    def _abrir(self):
+        if self.mapa is None:
+            tamano = self._inicio_cubetas() + self.cubetas * self._CUBETA.size
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+            fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                cabecera = self._CABECERA.pack(self._MAGIA, self.cubetas, self.FILAS_CONTADORES)
+                if os.pread(fd, self._CABECERA.size, 0) != cabecera or os.fstat(fd).st_size != tamano:
+                    # Archivo nuevo o de otra configuración: se reinicia en ceros
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, tamano)
+                    os.pwrite(fd, cabecera, 0)
+                self.mapa = mmap.mmap(fd, tamano)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        return self.mapa
+
+    def _fila(self, mapa, endpoint):
+        """Fila de contadores del endpoint; la agrega si no existe (con el bloqueo tomado)"""
+        fila = self.filas.get(endpoint)
+        if fila is None:
+            nombre = endpoint.encode()[:56]
+            for i in range(self.FILAS_CONTADORES):
+                desplazamiento = self._CABECERA.size + i * self._CONTADOR.size
+                actual = mapa[desplazamiento:desplazamiento + 56].rstrip(b'\0')
+                if not actual:
+                    mapa[desplazamiento:desplazamiento + 56] = nombre.ljust(56, b'\0')
+                if not actual or actual == nombre:
+                    fila = self.filas[endpoint] = desplazamiento
+                    break
+        return fila
+
+    def _contar(self, mapa, endpoint, resultado):
+        fila = self._fila(mapa, endpoint)
+        if fila is not None:
+            posicion = fila + 56 + 8 * self.RESULTADOS.index(resultado)
+            struct.pack_into('<Q', mapa, posicion, struct.unpack_from('<Q', mapa, posicion)[0] + 1)
+
+    def consumir(self, cliente, endpoint, costo, capacidad, recarga):
+        """
+        Descuenta `costo` fichas de la cubeta del cliente.
+        Regresa (permitido, fichas restantes, segundos hasta tener suficientes).
+        """
+        clave = int.from_bytes(hashlib.blake2b(cliente.encode(), digest_size=8).digest(), 'little') or 1
+        costo = min(costo, capacidad)
+        llena_en = capacidad / recarga    # una cubeta sin uso por más tiempo equivale a una nueva
+        mapa = self._abrir()
+        with open(self.ruta, 'rb') as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                ahora = time.time()
+                inicio = self._inicio_cubetas()
+                elegida = libre = vieja = None
+                for k in range(self.SONDEOS):
+                    posicion = inicio + ((clave + k) % self.cubetas) * self._CUBETA.size
+                    dueno, fichas, actualizada = self._CUBETA.unpack_from(mapa, posicion)
+                    if dueno == clave:
+                        elegida = (posicion, fichas, actualizada)
+                        break
+                    if libre is None and (dueno == 0 or ahora - actualizada >= llena_en):
+                        libre = posicion
+                    if vieja is None or actualizada < vieja[1]:
+                        vieja = (posicion, actualizada)
+                if elegida is None:
+                    elegida = (libre if libre is not None else vieja[0], capacidad, ahora)
+
+                posicion, fichas, actualizada = elegida
+                fichas = min(capacidad, fichas + max(0.0, ahora - actualizada) * recarga)
+                permitido = fichas >= costo
+                if permitido:
+                    fichas -= costo
+                self._CUBETA.pack_into(mapa, posicion, clave, fichas, ahora)
+                self._contar(mapa, endpoint, 'allowed' if permitido else 'limited')
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+        return permitido, fichas, 0.0 if permitido else (costo - fichas) / recarga
+
+    def _filas_en_curso(self, mapa):
+        inicio = self._inicio_en_curso()
+        fin = inicio + self.FILAS_EN_CURSO * self._EN_CURSO.size
+        return [(inicio + i * self._EN_CURSO.size, pid, cuenta)
+                for i, (pid, cuenta) in enumerate(self._EN_CURSO.iter_unpack(mapa[inicio:fin]))]
+
+    def ocupar(self, limite):
+        """
+        Cuenta una petición en curso de este proceso si en la máquina hay
+        menos de `limite`. Regresa False (sin contarla) si no hay cupo.
+        """
+        propio = os.getpid()
+        mapa = self._abrir()
+        with open(self.ruta, 'rb') as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                filas = self._filas_en_curso(mapa)
+                total = sum(cuenta for _, _, cuenta in filas)
+                if total >= limite:
+                    # Cupos de workers que terminaron sin liberarlos (p. ej. reiniciados por timeout)
+                    for posicion, pid, cuenta in filas:
+                        if pid and pid != propio and not _proceso_vivo(pid):
+                            self._EN_CURSO.pack_into(mapa, posicion, 0, 0)
+                            total -= cuenta
+                    if total >= limite:
+                        return False
+                fila = next((f for f in filas if f[1] == propio), None) or \
+                    next((f for f in filas if not f[2]), None)
+                if fila is None:
+                    return True    # tabla llena: no se cuenta, pero tampoco se descarta
+                posicion, pid, cuenta = fila
+                self._EN_CURSO.pack_into(mapa, posicion, propio, (cuenta if pid == propio else 0) + 1)
+                return True
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+
+    def liberar(self):
+        propio = os.getpid()
+        mapa = self._abrir()
+        with open(self.ruta, 'rb') as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                for posicion, pid, cuenta in self._filas_en_curso(mapa):
+                    if pid == propio:
+                        self._EN_CURSO.pack_into(mapa, posicion, propio, max(0, cuenta - 1))
+                        break
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+
+    def en_curso(self):
+        """Peticiones de la API pública que se atienden ahora en la máquina"""
+        return sum(cuenta for _, _, cuenta in self._filas_en_curso(self._abrir()))
+
+    def contar(self, endpoint, resultado):
+        mapa = self._abrir()
+        with open(self.ruta, 'rb') as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                self._contar(mapa, endpoint, resultado)
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+
+    def contadores(self):
+        """{endpoint: {'allowed': n, 'limited': n, 'shed': n}}"""
+        mapa = self._abrir()
+        resultado = {}
+        for i in range(self.FILAS_CONTADORES):
+            nombre, *valores = self._CONTADOR.unpack_from(mapa, self._CABECERA.size + i * self._CONTADOR.size)
+            nombre = nombre.rstrip(b'\0')
+            if not nombre:
+                break
+            resultado[nombre.decode(errors='replace')] = dict(zip(self.RESULTADOS, valores))
+        return resultado
+
+    def clientes_activos(self, capacidad, recarga):
+        """Cubetas que todavía no se han vuelto a llenar"""
+        mapa = self._abrir()
+        limite = time.time() - capacidad / recarga
+        inicio = self._inicio_cubetas()
+        fin = inicio + self.cubetas * self._CUBETA.size
+        return sum(1 for dueno, _, actualizada in self._CUBETA.iter_unpack(mapa[inicio:fin])
+                   if dueno and actualizada > limite)
+
+limitador = LimitadorCompartido(app.config['RATE_LIMIT_FILE'], app.config['RATE_LIMIT_CLIENTS'])
+
+def _esperar_cupo_api(presupuesto):
+    """Toma un cupo de API_MAX_CONCURRENT esperando a lo más `presupuesto` segundos"""
+    limite = app.config['API_MAX_CONCURRENT']
+    fin = time.monotonic() + presupuesto
+    while not limitador.ocupar(limite):
+        restante = fin - time.monotonic()
+        if restante <= 0:
+            return False
+        time.sleep(min(app.config['API_QUEUE_POLL'], restante))
+    return True
+
+def _cliente_actual():
+    return cliente_de(request.headers.get('X-Forwarded-For'), request.remote_addr)
+
+def cliente_de(reenviado_por, direccion):
+    """Identidad del cliente para el limitador: IP del proxy de confianza o la de la conexión"""
+    if app.config['RATE_LIMIT_TRUST_PROXY'] and reenviado_por:
+        return reenviado_por.split(',')[0].strip()
+    return direccion or 'desconocido'
+
+def _costo_peticion():
+    """Fichas que cuesta la petición actual (0 = sin límite)"""
+    costos = app.config['RATE_LIMIT_COSTS']
+    if request.endpoint in costos:
+        return costos[request.endpoint]
+    if request.path.startswith('/api/') and not request.path.startswith('/api/admin'):
+        return app.config['RATE_LIMIT_DEFAULT_COST']
+    return 0
+
+def _espera_en_proxy():
+    """Segundos que la petición esperó antes de llegar al worker (X-Request-Start del proxy)"""
+    valor = request.headers.get('X-Request-Start', '')
+    try:
+        inicio = float(valor[2:] if valor.startswith('t=') else valor)
+    except ValueError:
+        return 0.0
+    # nginx manda segundos con milisegundos; otros proxies, milisegundos o microsegundos
+    while inicio > 1e11:
+        inicio /= 1000
+    return max(0.0, time.time() - inicio)
+
+def _respuesta_saturada(status, mensaje, reintentar):
+    respuesta = jsonify({'message': mensaje, 'retry_after': reintentar})
+    respuesta.status_code = status
+    respuesta.headers['Retry-After'] = str(reintentar)
+    return respuesta
+
+def _limitar_peticion():
+    if not app.config['RATE_LIMIT_ENABLED'] or request.environ.get('combimap.interna'):
+        return
+    costo = _costo_peticion()
+    if not costo:
+        return
+
+    permitido, fichas, espera = limitador.consumir(
+        _cliente_actual(), request.endpoint or 'desconocido', costo,
+        app.config['RATE_LIMIT_CAPACITY'], app.config['RATE_LIMIT_REFILL'])
+    g.fichas_restantes = int(fichas)
+    if not permitido:
+        return _respuesta_saturada(429, 'Demasiadas peticiones', max(1, math.ceil(espera)))
+
+    if request.endpoint in app.config['API_SHED_EXEMPT']:
+        return
+    presupuesto = app.config['API_QUEUE_BUDGET'] - _espera_en_proxy()
+    if presupuesto <= 0 or not _esperar_cupo_api(presupuesto):
+        limitador.contar(request.endpoint or 'desconocido', 'shed')
+        return _respuesta_saturada(503, 'Servicio saturado, intenta de nuevo', app.config['API_RETRY_AFTER'])
+    g.cupo_api = True
+
+# Se registra antes que los demás before_request para rechazar sin tocar la base de datos
+app.before_request_funcs.setdefault(None, []).insert(0, _limitar_peticion)
+
+@app.after_request
+def _informar_fichas(response):
+    if 'fichas_restantes' in g:
+        response.headers['X-RateLimit-Remaining'] = str(g.fichas_restantes)
+    return response
+
+@app.teardown_request
+def _liberar_cupo_api(error=None):
+    if g.pop('cupo_api', None):
+        limitador.liberar()
+
+@app.route('/metrics')
+def metrics():
+    """Contadores del limitador en formato de texto de Prometheus"""
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return jsonify({'message': 'Token es inválido'}), 401
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({'message': 'Solo disponible desde la máquina local'}), 403
+
+    lineas = [
+        '# HELP combimap_rate_limit_requests_total Peticiones evaluadas por el limitador',
+        '# TYPE combimap_rate_limit_requests_total counter',
+    ]
+    for endpoint, valores in sorted(limitador.contadores().items()):
+        for resultado, total in valores.items():
+            lineas.append(f'combimap_rate_limit_requests_total{{endpoint="{endpoint}",result="{resultado}"}} {total}')
+    lineas += [
+        '# HELP combimap_rate_limit_active_clients Clientes cuya cubeta no se ha vuelto a llenar',
+        '# TYPE combimap_rate_limit_active_clients gauge',
+        f"combimap_rate_limit_active_clients {limitador.clientes_activos(app.config['RATE_LIMIT_CAPACITY'], app.config['RATE_LIMIT_REFILL'])}",
+        '# HELP combimap_api_max_concurrent Peticiones de la API pública atendidas a la vez en la máquina',
+        '# TYPE combimap_api_max_concurrent gauge',
+        f"combimap_api_max_concurrent {app.config['API_MAX_CONCURRENT']}",
+        '# HELP combimap_api_in_flight Peticiones de la API pública en curso en la máquina',
+        '# TYPE combimap_api_in_flight gauge',
+        f"combimap_api_in_flight {limitador.en_curso()}",
+    ]
+    return Response('\n'.join(lineas) + '\n', mimetype='text/plain; version=0.0.4')
+
+# --- Perfilado Bajo Demanda ---
+
+# Un administrador puede perfilar una petición concreta mandando su token
+# (x-access-token) junto con la cabecera `X-Profile: sample|cprofile` o el
+# parámetro `?_profile=sample`. La petición completa (incluido el cuerpo de
+# respuestas streaming) se mide con un muestreador de pila o con cProfile y
+# se registran las consultas SQL con su duración. El perfil se guarda en
+# cache/perfiles y su id viaja en la cabecera X-Profile-Id; las pilas salen en
+# formato "collapsed" (flamegraph.pl, speedscope). Sin la bandera, el costo es
+# revisar una cabecera y la query string en el middleware.
+
+app.config['PROFILE_FOLDER'] = os.path.join('cache', 'perfiles')
+app.config['PROFILE_INTERVAL'] = 0.005        # segundos entre muestras de la pila
+app.config['PROFILE_KEEP'] = 50               # perfiles guardados; se borran los más viejos
+app.config['PROFILE_MAX_SQL'] = 2000          # consultas registradas por perfil
+
+MODOS_PERFIL = ('sample', 'cprofile')
+_perfil_hilo = threading.local()              # perfil activo en el hilo que atiende la petición
+_sql_perfil_engines = set()
+
+class MuestreadorPila:
+    """Toma muestras de la pila de un hilo desde un hilo auxiliar"""
+
+    def __init__(self, hilo_id, intervalo):
+        self.hilo_id = hilo_id
+        self.intervalo = intervalo
+        self.pilas = Counter()
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, name='perfil-muestreo', daemon=True)
+
+    def _muestrear(self):
+        while not self._detener.wait(self.intervalo):
+            frame = sys._current_frames().get(self.hilo_id)
+            pila = []
+            while frame is not None:
+                codigo = frame.f_code
+                pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                frame = frame.f_back
+            if pila:
+                self.pilas[';'.join(reversed(pila))] += 1
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join()
+
+class PerfilPeticion:
+    """Pilas y consultas SQL de una petición perfilada"""
+
+    def __init__(self, environ, usuario, modo):
+        self.id = f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S}_{os.urandom(3).hex()}"
+        self.metodo = environ.get('REQUEST_METHOD')
+        self.ruta = environ.get('PATH_INFO')
+        self.query = environ.get('QUERY_STRING', '')
+        self.usuario = usuario
+        self.modo = modo
+        self.consultas = []
+        self.consultas_omitidas = 0
+        self.muestreador = None
+        self.perfilador = None
+
+    def iniciar(self):
+        _registrar_sql_perfil()
+        _perfil_hilo.actual = self
+        self.inicio = time.perf_counter()
+        if self.modo == 'cprofile':
+            self.perfilador = cProfile.Profile()
+            self.perfilador.enable()
+        else:
+            self.muestreador = MuestreadorPila(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+            self.muestreador.iniciar()
+
+    def anotar_consulta(self, engine, sql, parametros, ms, varias):
+        if len(self.consultas) >= app.config['PROFILE_MAX_SQL']:
+            self.consultas_omitidas += 1
+            return
+        self.consultas.append({
+            'engine': engine,
+            'statement': sql,
+            'parameters': repr(parametros)[:200],
+            'executemany': varias,
+            'ms': round(ms, 3)
+        })
+
+    def terminar(self, status):
+        duracion = (time.perf_counter() - self.inicio) * 1000
+        _perfil_hilo.actual = None
+        if self.perfilador is not None:
+            self.perfilador.disable()
+            salida = io.StringIO()
+            pstats.Stats(self.perfilador, stream=salida).sort_stats('cumulative').print_stats(60)
+            pilas, muestras, detalle = {}, 0, salida.getvalue()
+        else:
+            self.muestreador.detener()
+            pilas, muestras, detalle = dict(self.muestreador.pilas), sum(self.muestreador.pilas.values()), None
+
+        agrupadas = {}
+        for consulta in self.consultas:
+            grupo = agrupadas.setdefault(consulta['statement'], {'statement': consulta['statement'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            grupo['count'] += 1
+            grupo['total_ms'] += consulta['ms']
+            grupo['max_ms'] = max(grupo['max_ms'], consulta['ms'])
+
+        guardar_perfil({
+            'id': self.id,
+            'method': self.metodo,
+            'path': self.ruta,
+            'query': self.query,
+            'status': status,
+            'user': self.usuario,
+            'mode': self.modo,
+            'duration_ms': round(duracion, 2),
+            'interval_ms': app.config['PROFILE_INTERVAL'] * 1000,
+            'samples': muestras,
+            'sql_count': len(self.consultas) + self.consultas_omitidas,
+            'sql_ms': round(sum(c['ms'] for c in self.consultas), 2),
+            'sql_by_statement': sorted(agrupadas.values(), key=lambda c: -c['total_ms']),
+            'sql': self.consultas,
+            'stacks': pilas,
+            'cprofile': detalle
+        })
+
+def _antes_de_sql(conn, cursor, statement, parameters, context, executemany):
+    # El inicio va en el contexto de la sentencia y no en la conexión del pool:
+    # si la sentencia falla no queda nada pendiente para la siguiente
+    if context is not None and getattr(_perfil_hilo, 'actual', None) is not None:
+        context.perfil_inicio = time.perf_counter()
+
+def _sql_perfilado(nombre):
+    def despues_de_sql(conn, cursor, statement, parameters, context, executemany):
+        perfil = getattr(_perfil_hilo, 'actual', None)
+        inicio = getattr(context, 'perfil_inicio', None)
+        if perfil is not None and inicio is not None:
+            perfil.anotar_consulta(nombre, statement, parameters, (time.perf_counter() - inicio) * 1000, executemany)
+    return despues_de_sql
+
+def _registrar_sql_perfil():
+    """Escucha las consultas de cada engine (solo desde el primer perfil)"""
+    with app.app_context():
+        for nombre, engine in db.engines.items():
+            if engine not in _sql_perfil_engines:
+                _sql_perfil_engines.add(engine)
+                event.listen(engine, 'before_cursor_execute', _antes_de_sql)
+                event.listen(engine, 'after_cursor_execute', _sql_perfilado(nombre or 'primaria'))
+
+def guardar_perfil(perfil):
+    carpeta = app.config['PROFILE_FOLDER']
+    os.makedirs(carpeta, exist_ok=True)
+    with open(os.path.join(carpeta, f"{perfil['id']}.json"), 'w', encoding='utf-8') as f:
+        json.dump(perfil, f, ensure_ascii=False)
+    guardados = sorted(n for n in os.listdir(carpeta) if n.endswith('.json'))
+    for nombre in guardados[:-app.config['PROFILE_KEEP']]:
+        os.remove(os.path.join(carpeta, nombre))
+
+def _usuario_perfilador(token):
+    """Nombre del administrador dueño del token, o None si no es válido"""
+    if not token:
+        return None
+    try:
+        datos = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    except jwt.PyJWTError:
+        return None
+    with app.app_context():
+        usuario = db.session.get(User, datos.get('user_id'))
+        return usuario.username if usuario else None
+
+def _modo_perfil(environ):
+    modo = environ.get('HTTP_X_PROFILE')
+    if modo is None:
+        query = environ.get('QUERY_STRING', '')
+        if '_profile=' not in query:
+            return None
+        modo = urllib.parse.parse_qs(query).get('_profile', [''])[0]
+    modo = modo.strip().lower()
+    if modo in ('1', 'true', 'yes'):
+        return 'sample'
+    return modo if modo in MODOS_PERFIL else None
+
+class PerfiladorWSGI:
+    """Middleware que perfila las peticiones marcadas por un administrador"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        modo = _modo_perfil(environ)
+        if modo is None:
+            return self.wsgi_app(environ, start_response)
+        usuario = _usuario_perfilador(environ.get('HTTP_X_ACCESS_TOKEN'))
+        if usuario is None:
+            return self.wsgi_app(environ, start_response)   # sin un token válido la bandera se ignora
+
+        perfil = PerfilPeticion(environ, usuario, modo)
+        estado = {}
+
+        def start_response_perfilado(status, headers, exc_info=None):
+            estado['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, list(headers) + [('X-Profile-Id', perfil.id)], exc_info)
+
+        perfil.iniciar()
+        try:
+            cuerpo = self.wsgi_app(environ, start_response_perfilado)
+        except BaseException:
+            perfil.terminar(500)
+            raise
+        return ClosingIterator(cuerpo, lambda: perfil.terminar(estado.get('status')))
+
+app.wsgi_app = PerfiladorWSGI(app.wsgi_app)
+
+def _ruta_perfil(perfil_id):
+    if not re.fullmatch(r'[0-9T]+_[0-9a-f]+', perfil_id):
+        return None
+    ruta = os.path.abspath(os.path.join(app.config['PROFILE_FOLDER'], f'{perfil_id}.json'))
+    return ruta if os.path.exists(ruta) else None
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@token_required
+def list_profiles(current_user):
+    carpeta = app.config['PROFILE_FOLDER']
+    nombres = sorted((n for n in os.listdir(carpeta) if n.endswith('.json')), reverse=True) if os.path.isdir(carpeta) else []
+    resumen = []
+    for nombre in nombres:
+        with open(os.path.join(carpeta, nombre), encoding='utf-8') as f:
+            perfil = json.load(f)
+        resumen.append({k: perfil[k] for k in ('id', 'method', 'path', 'status', 'user', 'mode',
+                                               'duration_ms', 'samples', 'sql_count', 'sql_ms')})
+    return jsonify(resumen)
+
+@app.route('/api/admin/profiles/<perfil_id>', methods=['GET'])
+@token_required
+def get_profile(current_user, perfil_id):
+    """El perfil completo en JSON; ?format=folded da solo las pilas para flamegraph.pl/speedscope"""
+    ruta = _ruta_perfil(perfil_id)
+    if ruta is None:
+        return jsonify({'message': 'Perfil no encontrado'}), 404
+    if request.args.get('format') != 'folded':
+        return send_file(ruta, mimetype='application/json')
+    with open(ruta, encoding='utf-8') as f:
+        pilas = json.load(f)['stacks']
+    texto = ''.join(f'{pila} {n}\n' for pila, n in sorted(pilas.items()))
+    return Response(texto, mimetype='text/plain')
+
 # --- Rutas de la Aplicación ---
 
 @app.route('/')
@@ -119,7 +1207,7 @@ def index():
 
 @app.route('/map')
 def map_app():
-    return render_template('map.html')
+    return render_template('map.html', modo_vehiculos=modo_vehiculos())
 
 @app.route('/about')
 def about():
@@ -143,59 +1231,270 @@ def contact():
 
 # --- API para Ciudadanos ---
 
+def serializar_ruta(ruta):
+    """Representación pública de una ruta con su trazo y paradas"""
+    coordenadas = [[float(c.latitud), float(c.longitud)] for c in ruta.coordenadas]
+    
+    # Obtener paradas asociadas a la ruta
+    paradas = [{
+        'name': p.parada.nombre,
+        'lat': float(p.parada.latitud),
+        'lon': float(p.parada.longitud)
+    } for p in ruta.paradas]
+    return _ruta_publica(ruta, coordenadas, paradas)
+
+def serializar_vista_ruta(vista):
+    """Igual que serializar_ruta, leyendo de la instantánea binaria"""
+    paradas = [{'name': p.nombre, 'lat': p.latitud, 'lon': p.longitud} for p in vista.paradas()]
+    return _ruta_publica(vista, vista.coordenadas(), paradas)
+
+def _ruta_publica(ruta, coordenadas, paradas):
+    # Si no hay paradas pero sí coordenadas, crear paradas virtuales desde las coordenadas
+    if not paradas and coordenadas:
+        # Parada de inicio (primera coordenada)
+        if len(coordenadas) > 0:
+            paradas.append({
+                'name': f'Inicio: {ruta.nombre}',
+                'lat': coordenadas[0][0],
+                'lon': coordenadas[0][1]
+            })
+        # Parada de fin (última coordenada)
+        if len(coordenadas) > 1:
+            paradas.append({
+                'name': f'Final: {ruta.nombre}',
+                'lat': coordenadas[-1][0],
+                'lon': coordenadas[-1][1]
+            })
+    
+    return {
+        'id': ruta.id,
+        'name': ruta.nombre,
+        'color': ruta.color,
+        'costo': float(ruta.costo) if ruta.costo else None,
+        'horario': f"{ruta.horario_inicio.strftime('%H:%M')} - {ruta.horario_fin.strftime('%H:%M')}" if ruta.horario_inicio and ruta.horario_fin else None,
+        'descripcion': ruta.descripcion,
+        'coordinates': coordenadas,
+        'stops': paradas
+    }
+
+def serializar_parada(parada):
+    """Representación pública de una parada"""
+    return {
+        'id': parada.id,
+        'name': parada.nombre,
+        'lat': float(parada.latitud),
+        'lon': float(parada.longitud)
+    }
+
+# Respuestas en streaming (?stream=ndjson|geojson): las filas se leen por
+# lotes con paginación por llave y cada lote se codifica y se envía de
+# inmediato, así la memoria por petición no depende del tamaño de la red.
+
+FORMATOS_STREAMING = {
+    'ndjson': 'application/x-ndjson',
+    'geojson': 'application/geo+json'
+}
+
+def _respuesta_streaming(lotes, formato, a_feature):
+    """Codifica lotes de dicts como NDJSON o como FeatureCollection GeoJSON"""
+    def generar():
+        if formato == 'ndjson':
+            for lote in lotes:
+                if lote:
+                    yield ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in lote)
+            return
+
+        yield '{"type":"FeatureCollection","features":['
+        primero = True
+        for lote in lotes:
+            if not lote:
+                continue
+            texto = ','.join(json.dumps(a_feature(item), ensure_ascii=False) for item in lote)
+            yield texto if primero else ',' + texto
+            primero = False
+        yield ']}'
+
+    return Response(stream_with_context(generar()), mimetype=FORMATOS_STREAMING[formato])
+
+def _lotes_de_rutas(solo_activas=True):
+    """Rutas serializadas por lotes; la sesión se limpia entre lotes"""
+    tamano = app.config['STREAM_ROUTES_BATCH']
+    ultimo_id = 0
+    while True:
+        consulta = Ruta.query.filter(Ruta.id > ultimo_id)
+        if solo_activas:
+            consulta = consulta.filter(Ruta.activa == True)
+        rutas = consulta.order_by(Ruta.id).limit(tamano).options(
+            db.selectinload(Ruta.coordenadas),
+            db.selectinload(Ruta.paradas).joinedload(RutaParada.parada)
+        ).all()
+        if not rutas:
+            return
+        ultimo_id = rutas[-1].id
+        lote = [serializar_ruta(ruta) for ruta in rutas]
+        db.session.expunge_all()
+        yield lote
+
+def _lotes_de_filas(columnas, llave, filtro=None):
+    """Filas de columnas por lotes, paginando por la llave primaria"""
+    tamano = app.config['STREAM_ROWS_BATCH']
+    ultimo_id = 0
+    while True:
+        consulta = db.select(*columnas).where(llave > ultimo_id).order_by(llave).limit(tamano)
+        if filtro is not None:
+            consulta = consulta.where(filtro)
+        filas = db.session.execute(consulta).all()
+        if not filas:
+            return
+        ultimo_id = filas[-1].id
+        yield filas
+
+def _feature_ruta(ruta):
+    propiedades = {k: v for k, v in ruta.items() if k != 'coordinates'}
+    return {
+        'type': 'Feature',
+        'id': ruta['id'],
+        'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lat, lon in ruta['coordinates']]},
+        'properties': propiedades
+    }
+
+def _feature_parada(parada):
+    return {
+        'type': 'Feature',
+        'id': parada['id'],
+        'geometry': {'type': 'Point', 'coordinates': [parada['lon'], parada['lat']]},
+        'properties': {k: v for k, v in parada.items() if k not in ('lat', 'lon')}
+    }
+
+def _formato_streaming():
+    """Formato pedido en ?stream=; None si es la respuesta JSON normal"""
+    formato = request.args.get('stream')
+    if formato and formato not in FORMATOS_STREAMING:
+        return False
+    return formato
+
 @app.route('/api/routes')
 def get_routes():
+    formato = _formato_streaming()
+    if formato is False:
+        return jsonify({'error': 'Formato de streaming no soportado (ndjson o geojson)'}), 400
+    if formato:
+        return _respuesta_streaming(_lotes_de_rutas(), formato, _feature_ruta)
+
+    red = snapshot_red()
+    if red is not None:
+        return jsonify([serializar_vista_ruta(vista) for vista in red.rutas(solo_activas=True)])
+
     rutas = Ruta.query.filter_by(activa=True).all()
-    rutas_data = []
-    for ruta in rutas:
-        coordenadas = [[float(c.latitud), float(c.longitud)] for c in ruta.coordenadas]
-        
-        # Obtener paradas asociadas a la ruta
-        paradas = [{
-            'name': p.parada.nombre,
-            'lat': float(p.parada.latitud),
-            'lon': float(p.parada.longitud)
-        } for p in ruta.paradas]
-        
-        # Si no hay paradas pero sí coordenadas, crear paradas virtuales desde las coordenadas
-        if not paradas and coordenadas:
-            # Parada de inicio (primera coordenada)
-            if len(coordenadas) > 0:
-                paradas.append({
-                    'name': f'Inicio: {ruta.nombre}',
-                    'lat': coordenadas[0][0],
-                    'lon': coordenadas[0][1]
-                })
-            # Parada de fin (última coordenada)
-            if len(coordenadas) > 1:
-                paradas.append({
-                    'name': f'Final: {ruta.nombre}',
-                    'lat': coordenadas[-1][0],
-                    'lon': coordenadas[-1][1]
-                })
-        
-        rutas_data.append({
-            'id': ruta.id,
-            'name': ruta.nombre,
-            'color': ruta.color,
-            'costo': float(ruta.costo) if ruta.costo else None,
-            'horario': f"{ruta.horario_inicio.strftime('%H:%M')} - {ruta.horario_fin.strftime('%H:%M')}" if ruta.horario_inicio and ruta.horario_fin else None,
-            'descripcion': ruta.descripcion,
-            'coordinates': coordenadas,
-            'stops': paradas
-        })
+    rutas_data = [serializar_ruta(ruta) for ruta in rutas]
     return jsonify(rutas_data)
 
 @app.route('/api/stops')
 def get_all_stops():
-    paradas = Parada.query.all()
-    paradas_data = [{
-        'id': p.id,
-        'name': p.nombre,
-        'lat': float(p.latitud),
-        'lon': float(p.longitud)
-    } for p in paradas]
-    return jsonify(paradas_data)
+    formato = _formato_streaming()
+    if formato is False:
+        return jsonify({'error': 'Formato de streaming no soportado (ndjson o geojson)'}), 400
+    if formato:
+        lotes = ([serializar_parada(p) for p in filas]
+                 for filas in _lotes_de_filas((Parada.id, Parada.nombre, Parada.latitud, Parada.longitud), Parada.id))
+        return _respuesta_streaming(lotes, formato, _feature_parada)
+
+    red = snapshot_red()
+    if 'lat' in request.args or 'lon' in request.args:
+        datos, status = paradas_cercanas_publicas(red, request.args)
+        return jsonify(datos), status
+
+    paradas = red.paradas() if red is not None else Parada.query.all()
+    return jsonify([serializar_parada_con_imagenes(p) for p in paradas])
+
+# La lógica de las lecturas públicas vive en funciones sin dependencia de la
+# petición de Flask para que la comparta el servidor asíncrono (asgi.py).
+
+def serializar_parada_con_imagenes(parada):
+    return dict(serializar_parada(parada), images=imagenes_publicas(parada.imagenes))
+
+def paradas_cercanas_publicas(red, args):
+    """Paradas cercanas a ?lat&lon (&radius_m), ordenadas por distancia. Regresa (datos, status)"""
+    try:
+        lat, lon = float(args['lat']), float(args['lon'])
+        radio = min(float(args.get('radius_m', 500)), 5000)
+    except (KeyError, ValueError):
+        return {'error': 'lat y lon deben ser numéricos'}, 400
+    if red is None:
+        return {'error': 'Búsqueda por cercanía no disponible'}, 503
+    return [dict(serializar_parada_con_imagenes(p), distance_m=round(d, 1))
+            for d, p in red.paradas_cercanas(lat, lon, radio)], 200
+
+@app.route('/api/sync')
+def sync_network():
+    """
+    Sincronización incremental de la red.
+    ?since=<versión> regresa solo rutas y paradas agregadas, cambiadas o
+    eliminadas después de esa versión. Si la versión es 0 o anterior al
+    registro compactado, regresa la red completa ('full': true).
+    """
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Versión inválida'}), 400
+
+    # La versión se lee antes que los datos: si algo cambia mientras tanto,
+    # el cliente lo volverá a pedir en la siguiente sincronización.
+    version = version_red()
+    respuesta = {
+        'version': version,
+        'full': False,
+        'routes': [],
+        'stops': [],
+        'deleted': {'routes': [], 'stops': []}
+    }
+
+    if since <= 0 or since < version_compactada() or since > version:
+        respuesta['full'] = True
+        respuesta['routes'] = [_serializar_ruta_sync(r) for r in _consulta_rutas_sync().all()]
+        respuesta['stops'] = [_serializar_parada_sync(p) for p in Parada.query.all()]
+        return jsonify(respuesta)
+
+    ultimos = {}
+    for cambio in CambioRed.query.filter(CambioRed.version > since).order_by(CambioRed.version, CambioRed.id):
+        ultimos[(cambio.entidad, cambio.entidad_id)] = cambio.operacion
+
+    ids_rutas = [eid for (entidad, eid), op in ultimos.items() if entidad == 'ruta' and op == 'upsert']
+    ids_paradas = [eid for (entidad, eid), op in ultimos.items() if entidad == 'parada' and op == 'upsert']
+    rutas = _consulta_rutas_sync().filter(Ruta.id.in_(ids_rutas)).all() if ids_rutas else []
+    paradas = Parada.query.filter(Parada.id.in_(ids_paradas)).all() if ids_paradas else []
+
+    respuesta['routes'] = [_serializar_ruta_sync(r) for r in rutas]
+    respuesta['stops'] = [_serializar_parada_sync(p) for p in paradas]
+
+    # Lo que ya no existe (p. ej. borrado después de un upsert) cuenta como eliminado
+    rutas_encontradas = {r.id for r in rutas}
+    paradas_encontradas = {p.id for p in paradas}
+    for entidad, eid in ultimos:
+        if entidad == 'ruta' and eid not in rutas_encontradas:
+            respuesta['deleted']['routes'].append(eid)
+        elif entidad == 'parada' and eid not in paradas_encontradas:
+            respuesta['deleted']['stops'].append(eid)
+
+    return jsonify(respuesta)
+
+def _consulta_rutas_sync():
+    return Ruta.query.options(
+        db.selectinload(Ruta.coordenadas),
+        db.selectinload(Ruta.paradas).joinedload(RutaParada.parada)
+    )
+
+def _serializar_ruta_sync(ruta):
+    data = serializar_ruta(ruta)
+    data['active'] = bool(ruta.activa)
+    return data
+
+def _serializar_parada_sync(parada):
+    data = serializar_parada(parada)
+    data['description'] = parada.descripcion
+    data['type'] = parada.tipo
+    data['images'] = imagenes_publicas(parada.imagenes)
+    return data
 
 @app.route('/api/reverse-geocode')
 def reverse_geocode_api():
@@ -204,66 +1503,2330 @@ def reverse_geocode_api():
     if not lat or not lon:
         return jsonify({"error": "Latitud y longitud son requeridas"}), 400
 
-    url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}"
-    req = urllib.request.Request(url, headers={'User-Agent': 'CombiMapApp/1.0'})
+    req = urllib.request.Request(url_geocodificacion(lat, lon), headers=CABECERAS_NOMINATIM)
     try:
-        with urllib.request.urlopen(req) as response:
-            data = json.load(response)
-            address = data.get('display_name', 'Ubicación no encontrada')
-            return jsonify({"address": address})
+        with urllib.request.urlopen(req, timeout=app.config['NOMINATIM_TIMEOUT']) as response:
+            return jsonify({"address": direccion_geocodificada(json.load(response))})
     except Exception as e:
         print(f"Error con la API de Nominatim: {e}")
         return jsonify({"error": "No se pudo obtener la dirección"}), 500
 
-# --- API para Administradores ---
+CABECERAS_NOMINATIM = {'User-Agent': 'CombiMapApp/1.0'}
 
-@app.route('/api/login', methods=['POST'])
-def login():
-    auth = request.json
-    if not auth or not auth.get('username') or not auth.get('password'):
-        return jsonify({'message': 'No se pudo verificar'}), 401, {'WWW-Authenticate': 'Basic realm="Login required!"'}
+def url_geocodificacion(lat, lon):
+    consulta = urllib.parse.urlencode({'format': 'json', 'lat': lat, 'lon': lon})
+    return f"{app.config['NOMINATIM_URL'].rstrip('/')}/reverse?{consulta}"
 
-    user = User.query.filter_by(username=auth.get('username')).first()
+def direccion_geocodificada(data):
+    return data.get('display_name', 'Ubicación no encontrada')
 
-    if not user or not user.check_password(auth.get('password')):
-        return jsonify({'message': 'No se pudo verificar'}), 401, {'WWW-Authenticate': 'Basic realm="Login required!"'}
+# --- Instantánea Binaria de la Red ---
 
-    token = jwt.encode({
-        'user_id': user.id,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-    }, app.config['SECRET_KEY'], algorithm="HS256")
+# La red completa (rutas, trazos, paradas, enlaces y un índice de celdas de
+# paradas) se escribe en cache/red/red_<versión>.bin. Cada worker abre el
+# archivo con mmap y lo lee sin copiar: las páginas viven en la caché del
+# sistema y se comparten entre procesos. Las vistas (VistaRuta, VistaParada)
+# solo guardan el índice del registro.
 
-    return jsonify({'token': token})
+app.config['NETWORK_SNAPSHOT'] = True
+app.config['NETWORK_SNAPSHOT_CELL'] = 0.005   # grados por celda del índice de paradas
+app.config['NETWORK_SNAPSHOT_RETRY'] = 10     # segundos entre intentos si la reconstrucción falla
 
-@app.route('/api/admin/routes', methods=['POST'])
-@token_required
-def create_route(current_user):
-    data = request.get_json()
+_MAGIC_RED = b'CMRED001'
+_SIN_TEXTO = 0xFFFFFFFF
+# magic, versión, conteos (rutas, coordenadas, paradas, enlaces, celdas) y desplazamientos de las secciones
+_CABECERA_RED = struct.Struct('<8sQ5I4x12Q')
+# id, activa, inicio/cantidad de coordenadas, inicio/cantidad de enlaces, costo, horario (s o -1), textos (desplazamiento, largo)
+_REGISTRO_RUTA = struct.Struct('<IB3xIIIIdii6I')
+# id, tipo, lat, lon, textos: nombre, descripción, imágenes (JSON)
+_REGISTRO_PARADA = struct.Struct('<IB3xdd6I')
+_TIPOS_PARADA = ('secundaria', 'principal')
+
+def _celda_red(lat, lon):
+    tamano = app.config['NETWORK_SNAPSHOT_CELL']
+    return (int(math.floor(lat / tamano)) << 32) | (int(math.floor(lon / tamano)) & 0xFFFFFFFF)
+
+def escribir_snapshot_red(archivo, version, conexion):
+    """
+    Escribe la red en formato binario en el archivo abierto. `conexion` debe
+    venir de lectura_consistente() para que paradas, enlaces y trazos sean
+    los de una misma versión.
+    """
+    textos = bytearray()
+
+    def texto(valor):
+        if valor is None:
+            return _SIN_TEXTO, 0
+        datos = valor.encode('utf-8')
+        textos.extend(datos)
+        return len(textos) - len(datos), len(datos)
+
+    lats, lons, acumulado = array('d'), array('d'), array('d')
+    tramos = {}
+    ruta_actual, anterior = None, None
+    consulta = db.select(RutaCoordenada.ruta_id, RutaCoordenada.latitud, RutaCoordenada.longitud)\
+        .order_by(RutaCoordenada.ruta_id, RutaCoordenada.orden)
+    for ruta_id, lat, lon in conexion.execute(consulta.execution_options(yield_per=app.config['GTFS_YIELD_PER'])):
+        lat, lon = float(lat), float(lon)
+        if ruta_id != ruta_actual:
+            ruta_actual, anterior = ruta_id, None
+            tramos[ruta_id] = [len(lats), 0]
+        acumulado.append(acumulado[-1] + distancia_haversine(anterior[0], anterior[1], lat, lon) if anterior else 0.0)
+        lats.append(lat)
+        lons.append(lon)
+        tramos[ruta_id][1] += 1
+        anterior = (lat, lon)
+
+    paradas = conexion.execute(db.select(
+        Parada.id, Parada.tipo, Parada.latitud, Parada.longitud, Parada.nombre, Parada.descripcion, Parada.imagenes
+    ).order_by(Parada.id)).all()
+    indice_parada = {p.id: i for i, p in enumerate(paradas)}
+    registros_paradas = bytearray()
+    for p in paradas:
+        registros_paradas += _REGISTRO_PARADA.pack(
+            p.id, _TIPOS_PARADA.index(p.tipo) if p.tipo in _TIPOS_PARADA else 0, float(p.latitud), float(p.longitud),
+            *texto(p.nombre), *texto(p.descripcion), *texto(json.dumps(p.imagenes) if p.imagenes else None))
+
+    enlaces = array('I')
+    tramos_enlaces = {}
+    for ruta_id, parada_id in conexion.execute(
+            db.select(RutaParada.ruta_id, RutaParada.parada_id).order_by(RutaParada.ruta_id, RutaParada.orden)):
+        tramos_enlaces.setdefault(ruta_id, [len(enlaces), 0])[1] += 1
+        enlaces.append(indice_parada[parada_id])
+
+    rutas = conexion.execute(db.select(
+        Ruta.id, Ruta.activa, Ruta.costo, Ruta.horario_inicio, Ruta.horario_fin, Ruta.nombre, Ruta.color, Ruta.descripcion
+    ).order_by(Ruta.id)).all()
+    registros_rutas = bytearray()
+    for r in rutas:
+        registros_rutas += _REGISTRO_RUTA.pack(
+            r.id, bool(r.activa), *tramos.get(r.id, (0, 0)), *tramos_enlaces.get(r.id, (0, 0)),
+            float(r.costo) if r.costo else math.nan,
+            _segundos_del_dia(r.horario_inicio) if r.horario_inicio else -1,
+            _segundos_del_dia(r.horario_fin) if r.horario_fin else -1,
+            *texto(r.nombre), *texto(r.color), *texto(r.descripcion))
+
+    # Índice de paradas por celda: llaves ordenadas, inicio de cada celda y paradas agrupadas
+    por_celda = sorted(range(len(paradas)), key=lambda i: _celda_red(float(paradas[i].latitud), float(paradas[i].longitud)))
+    llaves, inicios, paradas_celda = array('q'), array('I'), array('I', por_celda)
+    for posicion, i in enumerate(por_celda):
+        llave = _celda_red(float(paradas[i].latitud), float(paradas[i].longitud))
+        if not llaves or llaves[-1] != llave:
+            llaves.append(llave)
+            inicios.append(posicion)
+    inicios.append(len(por_celda))
+
+    secciones = [
+        registros_rutas, array('I', (r.id for r in rutas)).tobytes(),
+        lats.tobytes(), lons.tobytes(), acumulado.tobytes(),
+        bytes(registros_paradas), array('I', (p.id for p in paradas)).tobytes(),
+        enlaces.tobytes(), llaves.tobytes(), inicios.tobytes(), paradas_celda.tobytes(), bytes(textos)
+    ]
+    desplazamientos = []
+    posicion = _CABECERA_RED.size
+    for seccion in secciones:
+        posicion += -posicion % 8
+        desplazamientos.append(posicion)
+        posicion += len(seccion)
+
+    archivo.write(_CABECERA_RED.pack(_MAGIC_RED, version, len(rutas), len(lats), len(paradas), len(enlaces),
+                                     len(llaves), *desplazamientos))
+    for inicio, seccion in zip(desplazamientos, secciones):
+        archivo.write(b'\0' * (inicio - archivo.tell()))
+        archivo.write(seccion)
+
+class VistaRuta:
+    __slots__ = ('_red', '_campos')
+
+    def __init__(self, red, indice):
+        self._red = red
+        self._campos = _REGISTRO_RUTA.unpack_from(red._rutas, indice * _REGISTRO_RUTA.size)
+
+    id = property(lambda self: self._campos[0])
+    activa = property(lambda self: bool(self._campos[1]))
+    costo = property(lambda self: None if math.isnan(self._campos[6]) else self._campos[6])
+    horario_inicio = property(lambda self: _hora_de_segundos(self._campos[7]))
+    horario_fin = property(lambda self: _hora_de_segundos(self._campos[8]))
+    nombre = property(lambda self: self._red.texto(*self._campos[9:11]))
+    color = property(lambda self: self._red.texto(*self._campos[11:13]))
+    descripcion = property(lambda self: self._red.texto(*self._campos[13:15]))
+
+    def geometria(self):
+        """(lats, lons, acumulado) como memoryviews sobre el archivo, sin copiar"""
+        inicio, cantidad = self._campos[2], self._campos[3]
+        red = self._red
+        return (red.lats[inicio:inicio + cantidad], red.lons[inicio:inicio + cantidad],
+                red.acumulado[inicio:inicio + cantidad])
+
+    def coordenadas(self):
+        lats, lons, _ = self.geometria()
+        return [[lat, lon] for lat, lon in zip(lats, lons)]
+
+    def paradas(self):
+        inicio, cantidad = self._campos[4], self._campos[5]
+        return [VistaParada(self._red, i) for i in self._red.enlaces[inicio:inicio + cantidad]]
+
+class VistaParada:
+    __slots__ = ('_red', '_campos')
+
+    def __init__(self, red, indice):
+        self._red = red
+        self._campos = _REGISTRO_PARADA.unpack_from(red._paradas, indice * _REGISTRO_PARADA.size)
+
+    id = property(lambda self: self._campos[0])
+    tipo = property(lambda self: _TIPOS_PARADA[self._campos[1]])
+    latitud = property(lambda self: self._campos[2])
+    longitud = property(lambda self: self._campos[3])
+    nombre = property(lambda self: self._red.texto(*self._campos[4:6]))
+    descripcion = property(lambda self: self._red.texto(*self._campos[6:8]))
+
+    @property
+    def imagenes(self):
+        valor = self._red.texto(*self._campos[8:10])
+        return json.loads(valor) if valor else None
+
+def _hora_de_segundos(segundos):
+    return None if segundos < 0 else datetime.time(segundos // 3600, segundos % 3600 // 60, segundos % 60)
+
+class SnapshotRed:
+    """Acceso de solo lectura a un archivo de red mapeado en memoria"""
+
+    def __init__(self, ruta):
+        with open(ruta, 'rb') as archivo:
+            self._mapa = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+        vista = memoryview(self._mapa)
+        magic, self.version, n_rutas, n_coords, n_paradas, n_enlaces, n_celdas, *d = _CABECERA_RED.unpack_from(vista)
+        if magic != _MAGIC_RED:
+            raise ValueError(f"{ruta} no es una instantánea de la red")
+
+        self._rutas = vista[d[0]:d[0] + n_rutas * _REGISTRO_RUTA.size]
+        self.ids_rutas = vista[d[1]:d[1] + n_rutas * 4].cast('I')
+        self.lats = vista[d[2]:d[2] + n_coords * 8].cast('d')
+        self.lons = vista[d[3]:d[3] + n_coords * 8].cast('d')
+        self.acumulado = vista[d[4]:d[4] + n_coords * 8].cast('d')
+        self._paradas = vista[d[5]:d[5] + n_paradas * _REGISTRO_PARADA.size]
+        self.ids_paradas = vista[d[6]:d[6] + n_paradas * 4].cast('I')
+        self.enlaces = vista[d[7]:d[7] + n_enlaces * 4].cast('I')
+        self.llaves_celda = vista[d[8]:d[8] + n_celdas * 8].cast('q')
+        self.inicios_celda = vista[d[9]:d[9] + (n_celdas + 1) * 4].cast('I')
+        self.paradas_celda = vista[d[10]:d[10] + n_paradas * 4].cast('I')
+        self._textos = vista[d[11]:]
+
+    def texto(self, inicio, largo):
+        return None if inicio == _SIN_TEXTO else str(self._textos[inicio:inicio + largo], 'utf-8')
+
+    def rutas(self, solo_activas=False):
+        vistas = (VistaRuta(self, i) for i in range(len(self.ids_rutas)))
+        return [r for r in vistas if r.activa] if solo_activas else list(vistas)
+
+    def ruta(self, ruta_id):
+        i = bisect_left(self.ids_rutas, ruta_id)
+        return VistaRuta(self, i) if i < len(self.ids_rutas) and self.ids_rutas[i] == ruta_id else None
+
+    def paradas(self):
+        return [VistaParada(self, i) for i in range(len(self.ids_paradas))]
+
+    def paradas_cercanas(self, lat, lon, radio_m):
+        """Paradas a menos de radio_m, ordenadas por distancia: [(metros, VistaParada)]"""
+        tamano = app.config['NETWORK_SNAPSHOT_CELL']
+        d_lat = radio_m / METROS_POR_GRADO
+        d_lon = radio_m / (METROS_POR_GRADO * max(math.cos(math.radians(lat)), 0.01))
+        resultado = []
+        for cy in range(int(math.floor((lat - d_lat) / tamano)), int(math.floor((lat + d_lat) / tamano)) + 1):
+            x1 = int(math.floor((lon - d_lon) / tamano))
+            x2 = int(math.floor((lon + d_lon) / tamano))
+            for cx in range(x1, x2 + 1):
+                llave = (cy << 32) | (cx & 0xFFFFFFFF)
+                k = bisect_left(self.llaves_celda, llave)
+                if k == len(self.llaves_celda) or self.llaves_celda[k] != llave:
+                    continue
+                for i in self.paradas_celda[self.inicios_celda[k]:self.inicios_celda[k + 1]]:
+                    parada = VistaParada(self, i)
+                    distancia = distancia_haversine(lat, lon, parada.latitud, parada.longitud)
+                    if distancia <= radio_m:
+                        resultado.append((distancia, parada))
+        resultado.sort(key=lambda r: r[0])
+        return resultado
+
+_snapshot_lock = threading.Lock()
+_snapshot = {'red': None, 'construyendo': False, 'fallo': None}
+
+def _carpeta_snapshots():
+    return os.path.join(app.config['CACHE_FOLDER'], 'red')
+
+def _versiones_de_snapshots(carpeta):
+    """{versión: nombre de archivo} de las instantáneas red_<versión>.bin de la carpeta"""
+    versiones = {}
+    for nombre in os.listdir(carpeta):
+        encontrado = re.fullmatch(r'red_(\d+)\.bin', nombre)
+        if encontrado:
+            versiones[int(encontrado.group(1))] = nombre
+    return versiones
+
+def construir_snapshot_red(version, conexion):
+    """
+    Escribe red_<versión>.bin si no existe (un solo proceso a la vez) y
+    regresa su ruta. Si otro proceso ya escribió una versión más nueva
+    regresa esa: quien leyó la base antes no debe reemplazarla.
+    """
+    carpeta = _carpeta_snapshots()
+    os.makedirs(carpeta, exist_ok=True)
+    with open(os.path.join(carpeta, '.lock'), 'w') as candado:
+        fcntl.flock(candado, fcntl.LOCK_EX)
+        versiones = _versiones_de_snapshots(carpeta)
+        if versiones and max(versiones) >= version:
+            return os.path.join(carpeta, versiones[max(versiones)])
+
+        ruta = os.path.join(carpeta, f"red_{version}.bin")
+        fd, temporal = tempfile.mkstemp(dir=carpeta, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as archivo:
+                escribir_snapshot_red(archivo, version, conexion)
+            os.replace(temporal, ruta)
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+        # Solo las anteriores; los workers que aún las mapean conservan sus páginas hasta soltarlas
+        for anterior, nombre in versiones.items():
+            if anterior < version:
+                os.remove(os.path.join(carpeta, nombre))
+    return ruta
+
+def snapshot_vigente():
+    """
+    Instantánea ya construida si ningún worker confirmó cambios después de
+    ella, o None si hay que pasar por snapshot_red(). Solo lee el contador
+    compartido, sin tocar la base de datos.
+    """
+    local = _sincronizacion['version']
+    red = _snapshot['red']
+    if (app.config['NETWORK_SNAPSHOT'] and red is not None and local is not None
+            and red.version >= local and contador_version_red.leer() <= local):
+        return red
+    return None
+
+def _reconstruir_snapshot():
+    """Construye y publica la instantánea de la versión actual; None si no se pudo"""
+    try:
+        # La versión se lee en la misma transacción que los datos que la forman
+        with lectura_consistente() as conexion:
+            version = version_red(conexion)
+            red = _snapshot['red']
+            if red is None or red.version < version:
+                red = SnapshotRed(construir_snapshot_red(version, conexion))
+                _snapshot['red'] = red
+        _snapshot['fallo'] = None
+        return red
+    except Exception:
+        # Cualquier error (disco, base de datos) deja la instantánea anterior o el camino del ORM
+        app.logger.exception("No se pudo construir la instantánea de la red")
+        _snapshot['fallo'] = time.monotonic()
+        db.session.rollback()
+        return None
+
+def _reconstruir_snapshot_en_segundo_plano():
+    try:
+        with app.app_context():
+            try:
+                _reconstruir_snapshot()
+            finally:
+                db.session.remove()
+    finally:
+        with _snapshot_lock:
+            _snapshot['construyendo'] = False
+
+def snapshot_red(actual=False):
+    """
+    Instantánea de la red, o None si está desactivada o no se pudo construir.
+    Si quedó atrás se reconstruye en un hilo aparte y mientras tanto se sigue
+    sirviendo la anterior; con actual=True se regresa None en ese caso, para
+    quien necesita los datos de la versión nueva (p. ej. al reindexar).
+    """
+    if not app.config['NETWORK_SNAPSHOT']:
+        return None
+    requerida = _sincronizacion['version']
+    red = _snapshot['red']
+    if red is not None and requerida is not None and red.version >= requerida:
+        return red
+
+    with _snapshot_lock:
+        red = _snapshot['red']
+        fallo = _snapshot['fallo']
+        reintentar = fallo is None or time.monotonic() - fallo >= app.config['NETWORK_SNAPSHOT_RETRY']
+        if red is not None:
+            if reintentar and not _snapshot['construyendo']:
+                _snapshot['construyendo'] = True
+                threading.Thread(target=_reconstruir_snapshot_en_segundo_plano, daemon=True).start()
+            return None if actual else red
+        if not reintentar:
+            return None
+
+        # La primera no tiene una anterior que servir mientras se construye.
+        # Versión y datos se leen de la primaria para que el archivo no quede atrás
+        with lecturas_en_primaria():
+            return _reconstruir_snapshot()
+
+@app.cli.command('build-snapshot')
+def build_snapshot_command():
+    """Escribe la instantánea binaria de la versión actual de la red"""
+    with lectura_consistente() as conexion:
+        red = SnapshotRed(construir_snapshot_red(version_red(conexion), conexion))
+    tamano = os.path.getsize(os.path.join(_carpeta_snapshots(), f"red_{red.version}.bin"))
+    print(f"Instantánea v{red.version}: {len(red.ids_rutas)} rutas, {len(red.lats)} coordenadas, "
+          f"{len(red.ids_paradas)} paradas, {len(red.enlaces)} enlaces ({tamano // 1024} KB)")
+
+# --- Búsqueda de Rutas, Paradas y Bases ---
+
+def normalizar_texto(texto):
+    """Minúsculas, sin acentos ni signos: 'Zócalo, Centro' -> 'zocalo centro'"""
+    descompuesto = unicodedata.normalize('NFKD', texto or '')
+    sin_acentos = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', ' ', sin_acentos.lower()).strip()
+
+def _trigramas(texto):
+    relleno = f"  {texto} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+class DatosBusqueda:
+    """
+    Documentos y listas de coincidencias de IndiceBusqueda. Una copia
+    (DatosBusqueda(base)) comparte las listas con la versión publicada y
+    copia cada una antes de modificarla.
+    """
+    MAX_PREFIJO = 15
+    PESO_TIPO = {'route': 3, 'stop': 2, 'base': 1}
+
+    def __init__(self, base=None):
+        self.documentos = dict(base.documentos) if base else {}
+        self.prefijos_nombre = dict(base.prefijos_nombre) if base else {}
+        self.prefijos_descripcion = dict(base.prefijos_descripcion) if base else {}
+        self.trigramas = dict(base.trigramas) if base else {}
+        # (id del índice, llave) de las listas que ya son de esta copia; None si todas lo son
+        self.propias = set() if base else None
+
+    def _lista(self, indice, llave, crear):
+        claves = indice.get(llave)
+        if self.propias is None or (id(indice), llave) in self.propias:
+            if claves is None and crear:
+                claves = indice[llave] = set()
+            return claves
+        if claves is None and not crear:
+            return None
+        claves = indice[llave] = set(claves or ())
+        self.propias.add((id(indice), llave))
+        return claves
+
+    def _agregar_a(self, indice, llave, clave):
+        self._lista(indice, llave, crear=True).add(clave)
+
+    def _quitar_de(self, indice, llave, clave):
+        claves = self._lista(indice, llave, crear=False)
+        if claves is not None:
+            claves.discard(clave)
+            if not claves:
+                del indice[llave]
+
+    def _prefijos(self, palabras):
+        return {w[:i] for w in palabras for i in range(1, min(len(w), self.MAX_PREFIJO) + 1)}
+
+    def agregar(self, tipo, entidad_id, nombre, descripcion=None, **extra):
+        clave = (tipo, entidad_id)
+        self.quitar(clave)
+        nombre_norm = normalizar_texto(nombre)
+        documento = {
+            'type': tipo,
+            'id': entidad_id,
+            'name': nombre,
+            'nombre_norm': nombre_norm,
+            'palabras': nombre_norm.split(),
+            'palabras_desc': normalizar_texto(descripcion).split(),
+            'extra': extra
+        }
+        documento['prefijos'] = self._prefijos(documento['palabras'])
+        self.documentos[clave] = documento
+        for prefijo in documento['prefijos']:
+            self._agregar_a(self.prefijos_nombre, prefijo, clave)
+        for prefijo in self._prefijos(documento['palabras_desc']):
+            self._agregar_a(self.prefijos_descripcion, prefijo, clave)
+        for trigrama in _trigramas(nombre_norm):
+            self._agregar_a(self.trigramas, trigrama, clave)
+
+    def quitar(self, clave):
+        documento = self.documentos.pop(clave, None)
+        if documento is None:
+            return
+        for prefijo in documento['prefijos']:
+            self._quitar_de(self.prefijos_nombre, prefijo, clave)
+        for prefijo in self._prefijos(documento['palabras_desc']):
+            self._quitar_de(self.prefijos_descripcion, prefijo, clave)
+        for trigrama in _trigramas(documento['nombre_norm']):
+            self._quitar_de(self.trigramas, trigrama, clave)
+
+    def _puntuar(self, documento, consulta, palabras):
+        puntos = self.PESO_TIPO[documento['type']]
+        if documento['nombre_norm'] == consulta:
+            puntos += 200
+        elif documento['nombre_norm'].startswith(consulta):
+            puntos += 100
+        en_nombre = sum(1 for p in palabras if p in documento['prefijos'])
+        puntos += 40 * en_nombre + 10 * (len(palabras) - en_nombre)
+        # A igualdad, preferir nombres cortos (más específicos)
+        return puntos - len(documento['nombre_norm']) / 100
+
+    def buscar(self, consulta, limite=10, tipos=None):
+        consulta = normalizar_texto(consulta)
+        palabras = [p[:self.MAX_PREFIJO] for p in consulta.split()]
+        if not palabras:
+            return []
+
+        # Cada palabra debe ser prefijo de alguna palabra del nombre o la descripción;
+        # se parte de la lista de coincidencias más corta y se filtra con las demás
+        vacio = frozenset()
+        listas = sorted(
+            ((self.prefijos_nombre.get(p, vacio), self.prefijos_descripcion.get(p, vacio)) for p in palabras),
+            key=lambda par: len(par[0]) + len(par[1])
+        )
+        candidatos = listas[0][0] | listas[0][1]
+        for en_nombre, en_descripcion in listas[1:]:
+            candidatos = {c for c in candidatos if c in en_nombre or c in en_descripcion}
+
+        if candidatos:
+            puntuados = [(self._puntuar(self.documentos[c], consulta, palabras), c) for c in candidatos]
+        else:
+            # Sin coincidencias exactas: similitud por trigramas ('zocalo' ~ 'zokalo')
+            trigramas = _trigramas(consulta)
+            conteo = {}
+            for trigrama in trigramas:
+                for clave in self.trigramas.get(trigrama, ()):
+                    conteo[clave] = conteo.get(clave, 0) + 1
+            minimo = len(trigramas) / 2
+            puntuados = [(comunes / len(trigramas) * 50 + self.PESO_TIPO[clave[0]], clave)
+                         for clave, comunes in conteo.items() if comunes >= minimo]
+
+        if tipos:
+            puntuados = [p for p in puntuados if p[1][0] in tipos]
+        mejores = heapq.nlargest(limite, puntuados, key=lambda p: (p[0], -p[1][1]))
+        resultados = []
+        for puntos, clave in mejores:
+            documento = self.documentos[clave]
+            resultados.append({'type': documento['type'], 'id': documento['id'], 'name': documento['name'],
+                               'score': round(puntos, 2), **documento['extra']})
+        return resultados
+
+class IndiceBusqueda(IndiceEnMemoria):
+    """
+    Índice en memoria para autocompletar: prefijos de cada palabra del nombre
+    y de la descripción, más trigramas del nombre para tolerar errores de
+    escritura. Los cambios de la red marcan entradas pendientes que se
+    recargan en la siguiente búsqueda.
+    """
+
+    def _indexar_ruta(self, datos, ruta):
+        if ruta is None or not ruta.activa:
+            return
+        datos.agregar('route', ruta.id, ruta.nombre, ruta.descripcion, color=ruta.color)
+
+    def _indexar_parada(self, datos, parada):
+        if parada is not None:
+            datos.agregar('stop', parada.id, parada.nombre, lat=float(parada.latitud), lon=float(parada.longitud))
+
+    def _construir(self):
+        datos = DatosBusqueda()
+        for ruta in Ruta.query.filter_by(activa=True):
+            self._indexar_ruta(datos, ruta)
+        for parada in Parada.query:
+            self._indexar_parada(datos, parada)
+        for base in Base.query:
+            datos.agregar('base', base.id, base.nombre, base.descripcion,
+                          lat=float(base.latitud), lon=float(base.longitud))
+        return datos
+
+    def _aplicar(self, datos, pendientes):
+        """Recarga solo las rutas y paradas que cambiaron desde la última búsqueda"""
+        datos = DatosBusqueda(datos)
+        for entidad, entidad_id in pendientes:
+            if entidad == 'ruta':
+                datos.quitar(('route', entidad_id))
+                self._indexar_ruta(datos, db.session.get(Ruta, entidad_id))
+            elif entidad == 'parada':
+                datos.quitar(('stop', entidad_id))
+                self._indexar_parada(datos, db.session.get(Parada, entidad_id))
+        return datos
+
+    def buscar(self, consulta, limite=10, tipos=None):
+        datos = self.datos
+        return datos.buscar(consulta, limite, tipos) if datos is not None else []
+
+indice_busqueda = IndiceBusqueda()
+al_cambiar_red(indice_busqueda.marcar)
+
+@app.route('/api/search')
+def search():
+    """Autocompletado de rutas, paradas y bases (sin acentos ni mayúsculas)"""
+    consulta = request.args.get('q', '')
+    try:
+        limite = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'Límite inválido'}), 400
+    tipos = {t for t in request.args.get('types', '').split(',') if t} or None
+
+    indice_busqueda.actualizar()
+    return jsonify(indice_busqueda.buscar(consulta, limite, tipos))
+
+# --- Vehículos en Tiempo Real ---
+
+RADIO_TIERRA_M = 6371000.0
+METROS_POR_GRADO = RADIO_TIERRA_M * math.pi / 180
+
+# La última posición y el recorrido reciente de cada vehículo viven en un
+# archivo mmap compartido por los workers (TablaVehiculos): una lectura que
+# llega a cualquier worker la ven todos los clientes de /api/vehicles/stream.
+# El historial se escribe a la base de datos por lotes desde cada proceso.
+
+class TablaVehiculos:
+    """
+    Ranuras de tamaño fijo, una por vehículo, con su última posición y un
+    buffer circular de puntos recientes. La cabecera lleva una secuencia que
+    sube con cada posición nueva; los streams la comparan para saber si hay
+    cambios sin tomar el bloqueo.
+    """
+
+    _CABECERA = struct.Struct('<8sQII')            # magia, secuencia, ranuras, puntos por recorrido
+    # secuencia, id (bytes y largo), ruta, segmento, lat, lon, ajustada, distancia, desvío, ts,
+    # última escritura (reloj local) e inicio y largo del recorrido
+    _VEHICULO = struct.Struct('<Q200sBiiddBddddII')
+    _LLAVE = struct.Struct('<Q200sB')              # inicio de _VEHICULO: secuencia (0 = libre) e id
+    _PUNTO = struct.Struct('<ddd')                 # lat, lon, ts
+    _MAGIA = b'CMVEH001'
+
+    def __init__(self, ruta, ranuras, puntos):
+        self.ruta = ruta
+        self.ranuras = ranuras
+        self.puntos = puntos
+        self.mapa = None
+        self.posiciones_por_id = {}    # vehiculo_id -> desplazamiento de su ranura (se valida al usarlo)
+
+    def _tamano_ranura(self):
+        return self._VEHICULO.size + self.puntos * self._PUNTO.size
+
+    def _abrir(self):
+        if self.mapa is None:
+            tamano = self._CABECERA.size + self.ranuras * self._tamano_ranura()
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+            fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                cabecera = os.pread(fd, self._CABECERA.size, 0).ljust(self._CABECERA.size, b'\0')
+                magia, _, ranuras, puntos = self._CABECERA.unpack(cabecera)
+                if (magia, ranuras, puntos) != (self._MAGIA, self.ranuras, self.puntos) or os.fstat(fd).st_size != tamano:
+                    # Archivo nuevo o de otra configuración: se reinicia en ceros
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, tamano)
+                    os.pwrite(fd, self._CABECERA.pack(self._MAGIA, 0, self.ranuras, self.puntos), 0)
+                self.mapa = mmap.mmap(fd, tamano)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        return self.mapa
+
+    @contextmanager
+    def _bloqueo(self, modo):
+        mapa = self._abrir()
+        with open(self.ruta, 'rb') as candado:
+            fcntl.flock(candado, modo)
+            try:
+                yield mapa
+            finally:
+                fcntl.flock(candado, fcntl.LOCK_UN)
+
+    def _inicios(self):
+        tamano = self._tamano_ranura()
+        return range(self._CABECERA.size, self._CABECERA.size + self.ranuras * tamano, tamano)
+
+    def _es_de(self, mapa, inicio, clave):
+        seq, guardada, largo = self._LLAVE.unpack_from(mapa, inicio)
+        return bool(seq) and guardada[:largo] == clave
+
+    def _ranura(self, mapa, vehiculo_id):
+        """Desplazamiento de la ranura del vehículo, o None (con el bloqueo tomado)"""
+        clave = vehiculo_id.encode()
+        inicio = self.posiciones_por_id.get(vehiculo_id)
+        if inicio is None or not self._es_de(mapa, inicio, clave):
+            inicio = next((i for i in self._inicios() if self._es_de(mapa, i, clave)), None)
+            if inicio is not None:
+                self._recordar(vehiculo_id, inicio)
+        return inicio
+
+    def _recordar(self, vehiculo_id, inicio):
+        if len(self.posiciones_por_id) >= 2 * self.ranuras:
+            # Los vehículos desalojados dejan entradas que ya no sirven
+            self.posiciones_por_id.clear()
+        self.posiciones_por_id[vehiculo_id] = inicio
+
+    def _leer(self, mapa, inicio, con_recorrido=False):
+        (seq, clave, largo, ruta_id, segmento, lat, lon, ajustada, distancia, desvio, ts, _,
+         primero, puntos) = self._VEHICULO.unpack_from(mapa, inicio)
+        posicion = {
+            'vehicle_id': clave[:largo].decode(errors='replace'),
+            'route_id': ruta_id if ruta_id >= 0 else None,
+            'lat': lat,
+            'lon': lon,
+            'snapped': bool(ajustada),
+            'distance_along': None if math.isnan(distancia) else distancia,
+            'offset_m': None if math.isnan(desvio) else desvio,
+            'ts': ts,
+            'segment': segmento if segmento >= 0 else None
+        }
+        if con_recorrido:
+            base = inicio + self._VEHICULO.size
+            posicion['trail'] = [list(self._PUNTO.unpack_from(mapa, base + (primero + k) % self.puntos * self._PUNTO.size))
+                                 for k in range(puntos)]
+        return seq, posicion
+
+    def _ranura_nueva(self, mapa, ttl, ahora):
+        """Ranura libre o vencida; si no hay, la del vehículo que lleva más tiempo sin reportar"""
+        def ultima_escritura(inicio):
+            registro = self._VEHICULO.unpack_from(mapa, inicio)
+            return registro[11] if registro[0] and ahora - registro[11] < ttl else -1.0
+        inicio = min(self._inicios(), key=ultima_escritura)
+        mapa[inicio:inicio + self._tamano_ranura()] = bytes(self._tamano_ranura())
+        return inicio
+
+    def secuencia(self):
+        return self._CABECERA.unpack_from(self._abrir())[1]
+
+    def ultima(self, vehiculo_id):
+        """Última posición registrada del vehículo, o None"""
+        with self._bloqueo(fcntl.LOCK_SH) as mapa:
+            inicio = self._ranura(mapa, vehiculo_id)
+            return self._leer(mapa, inicio)[1] if inicio is not None else None
+
+    def registrar(self, posiciones, ttl):
+        """
+        Agrega las posiciones (ordenadas por ts) al recorrido de cada vehículo
+        y actualiza su última posición si es más reciente. Un vehículo nuevo
+        toma una ranura libre o sin escrituras en `ttl` segundos; si no hay,
+        reemplaza al que lleva más tiempo sin reportar.
+        """
+        with self._bloqueo(fcntl.LOCK_EX) as mapa:
+            magia, seq, ranuras, puntos_max = self._CABECERA.unpack_from(mapa)
+            ahora = time.time()
+            for posicion in posiciones:
+                clave = posicion['vehicle_id'].encode()
+                inicio = self._ranura(mapa, posicion['vehicle_id'])
+                if inicio is None:
+                    inicio = self._ranura_nueva(mapa, ttl, ahora)
+                    self._recordar(posicion['vehicle_id'], inicio)
+                    registro = None
+                    primero = puntos = 0
+                else:
+                    registro = list(self._VEHICULO.unpack_from(mapa, inicio))
+                    primero, puntos = registro[12], registro[13]
+
+                self._PUNTO.pack_into(mapa, inicio + self._VEHICULO.size + (primero + puntos) % self.puntos * self._PUNTO.size,
+                                      posicion['lat'], posicion['lon'], posicion['ts'])
+                if puntos < self.puntos:
+                    puntos += 1
+                else:
+                    primero = (primero + 1) % self.puntos
+
+                if registro is None or registro[10] <= posicion['ts']:
+                    seq += 1
+                    registro = [
+                        seq, clave, len(clave),
+                        posicion['route_id'] if posicion['route_id'] is not None else -1,
+                        posicion['segment'] if posicion['segment'] is not None else -1,
+                        posicion['lat'], posicion['lon'], posicion['snapped'],
+                        math.nan if posicion['distance_along'] is None else posicion['distance_along'],
+                        math.nan if posicion['offset_m'] is None else posicion['offset_m'],
+                        posicion['ts'], ahora, primero, puntos]
+                else:
+                    registro[11:14] = ahora, primero, puntos
+                self._VEHICULO.pack_into(mapa, inicio, *registro)
+            self._CABECERA.pack_into(mapa, 0, magia, seq, ranuras, puntos_max)
+
+    def posiciones(self, desde_seq=0, con_recorrido=False):
+        """(secuencia actual, [posiciones con secuencia mayor a desde_seq])"""
+        with self._bloqueo(fcntl.LOCK_SH) as mapa:
+            resultado = [self._leer(mapa, inicio, con_recorrido)[1] for inicio in self._inicios()
+                         if self._LLAVE.unpack_from(mapa, inicio)[0] > desde_seq]
+            return self._CABECERA.unpack_from(mapa)[1], resultado
+
+tabla_vehiculos = TablaVehiculos(app.config['VEHICLE_STATE_FILE'], app.config['VEHICLE_MAX_TRACKED'],
+                                 app.config['VEHICLE_BUFFER_SIZE'])
+_vehiculos_lock = threading.Lock()
+_historial_pendiente = []
+_ultimo_volcado = time.monotonic()
+_geometrias_ruta = {}        # ruta_id -> (lats, lons, distancias acumuladas) de rutas existentes
+
+def distancia_haversine(lat1, lon1, lat2, lon2):
+    """Distancia en metros entre dos puntos"""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+
+def geometria_ruta(ruta_id):
+    """Regresa (lats, lons, acumulado) de la ruta, o None si no existe"""
+    red = snapshot_red(actual=True)
+    if red is not None:
+        vista = red.ruta(ruta_id)
+        return vista.geometria() if vista is not None else None
+
+    if ruta_id in _geometrias_ruta:
+        return _geometrias_ruta[ruta_id]
+
+    # Solo se guardan rutas que existen: el cache no crece más que la red
+    # aunque los vehículos reporten route_id inventados
+    with lecturas_en_primaria():
+        if db.session.get(Ruta, ruta_id) is None:
+            return None
+        filas = db.session.query(RutaCoordenada.latitud, RutaCoordenada.longitud)\
+            .filter_by(ruta_id=ruta_id).order_by(RutaCoordenada.orden).all()
+    lats = [float(f[0]) for f in filas]
+    lons = [float(f[1]) for f in filas]
+    acumulado = [0.0]
+    for i in range(1, len(lats)):
+        acumulado.append(acumulado[-1] + distancia_haversine(lats[i - 1], lons[i - 1], lats[i], lons[i]))
+    geometria = (lats, lons, acumulado)
+
+    _geometrias_ruta[ruta_id] = geometria
+    return geometria
+
+def invalidar_geometria_ruta(ruta_id):
+    """Descarta la geometría cacheada de una ruta modificada"""
+    _geometrias_ruta.pop(ruta_id, None)
+
+@al_cambiar_red
+def _invalidar_geometrias(cambios):
+    if cambios is None:
+        _geometrias_ruta.clear()
+        return
+    for entidad, entidad_id, _ in cambios:
+        if entidad == 'ruta':
+            invalidar_geometria_ruta(entidad_id)
+
+def proyectar_en_ruta(geometria, lat, lon, inicio=0, fin=None):
+    """
+    Proyecta un punto sobre la polilínea de la ruta.
+    Regresa (lat, lon, distancia_ruta, desvio, segmento) en metros.
+    """
+    lats, lons, acumulado = geometria
+    n = len(lats)
+    if n == 0:
+        return None
+    if n == 1:
+        return lats[0], lons[0], 0.0, distancia_haversine(lat, lon, lats[0], lons[0]), 0
+
+    # Plano local equirectangular centrado en el punto (suficiente a escala urbana)
+    escala_x = math.cos(math.radians(lat)) * METROS_POR_GRADO
+    escala_y = METROS_POR_GRADO
+    inicio = max(inicio, 0)
+    fin = n - 1 if fin is None else min(fin, n - 1)
+
+    mejor_d2, mejor_i, mejor_t = None, 0, 0.0
+    bx = (lons[inicio] - lon) * escala_x
+    by = (lats[inicio] - lat) * escala_y
+    for i in range(inicio, fin):
+        ax, ay = bx, by
+        bx = (lons[i + 1] - lon) * escala_x
+        by = (lats[i + 1] - lat) * escala_y
+        dx = bx - ax
+        dy = by - ay
+        largo2 = dx * dx + dy * dy
+        t = 0.0 if largo2 == 0 else min(1.0, max(0.0, -(ax * dx + ay * dy) / largo2))
+        px = ax + t * dx
+        py = ay + t * dy
+        d2 = px * px + py * py
+        if mejor_d2 is None or d2 < mejor_d2:
+            mejor_d2, mejor_i, mejor_t = d2, i, t
+
+    if mejor_d2 is None:
+        return None
+
+    i, t = mejor_i, mejor_t
+    return (
+        lats[i] + t * (lats[i + 1] - lats[i]),
+        lons[i] + t * (lons[i + 1] - lons[i]),
+        acumulado[i] + t * (acumulado[i + 1] - acumulado[i]),
+        math.sqrt(mejor_d2),
+        i
+    )
+
+def _parsear_fix(fix, ahora):
+    """Valida una lectura GPS; lanza ValueError si es inválida"""
+    vehiculo_id = str(fix.get('vehicle_id') or '').strip()[:50]
+    if not vehiculo_id:
+        raise ValueError('vehicle_id requerido')
+
+    lat = float(fix['lat'])
+    lon = float(fix['lon'])
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('coordenadas fuera de rango')
+
+    ts = fix.get('ts')
+    if ts is None:
+        registrado = ahora
+    elif isinstance(ts, (int, float)):
+        registrado = datetime.datetime.utcfromtimestamp(ts)
+    else:
+        registrado = datetime.datetime.fromisoformat(str(ts).replace('Z', '+00:00'))
+        if registrado.tzinfo is not None:
+            registrado = registrado.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    ruta_id = fix.get('route_id')
+    return {
+        'vehicle_id': vehiculo_id,
+        'route_id': int(ruta_id) if ruta_id is not None else None,
+        'lat': lat,
+        'lon': lon,
+        'registrado': registrado
+    }
+
+def _ajustar_a_ruta(posicion, anterior):
+    """Ajusta la posición a la polilínea de su ruta, buscando primero cerca del último segmento"""
+    geometria = geometria_ruta(posicion['route_id']) if posicion['route_id'] else None
+    if geometria is None:
+        posicion['route_id'] = None
+        return None
+
+    tolerancia = app.config['VEHICLE_SNAP_TOLERANCE']
+    proyeccion = None
+    if anterior and anterior.get('route_id') == posicion['route_id'] and anterior.get('segment') is not None:
+        segmento = anterior['segment']
+        proyeccion = proyectar_en_ruta(geometria, posicion['lat'], posicion['lon'], segmento - 10, segmento + 60)
+        if proyeccion and proyeccion[3] > tolerancia:
+            proyeccion = None
+    if proyeccion is None:
+        proyeccion = proyectar_en_ruta(geometria, posicion['lat'], posicion['lon'])
+    return proyeccion
+
+def registrar_posiciones(fixes):
+    """Procesa un lote de lecturas GPS; regresa (aceptadas, rechazadas)"""
+    ahora = datetime.datetime.utcnow()
+    tolerancia = app.config['VEHICLE_SNAP_TOLERANCE']
+
+    posiciones = []
+    rechazadas = 0
+    for fix in fixes:
+        try:
+            posiciones.append(_parsear_fix(fix, ahora))
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            rechazadas += 1
+    posiciones.sort(key=lambda p: p['registrado'])
+
+    # El ajuste a la ruta se hace fuera del candado (puede consultar la BD)
+    ultimos = {}
+    for posicion in posiciones:
+        anterior = ultimos.get(posicion['vehicle_id'])
+        if anterior is None:
+            anterior = tabla_vehiculos.ultima(posicion['vehicle_id'])
+        if posicion['route_id'] is None and anterior:
+            posicion['route_id'] = anterior.get('route_id')
+
+        proyeccion = _ajustar_a_ruta(posicion, anterior)
+        posicion['snapped'] = bool(proyeccion and proyeccion[3] <= tolerancia)
+        posicion['segment'] = proyeccion[4] if proyeccion else None
+        posicion['distance_along'] = round(proyeccion[2], 1) if proyeccion else None
+        posicion['offset_m'] = round(proyeccion[3], 1) if proyeccion else None
+        posicion['raw_lat'] = posicion['lat']
+        posicion['raw_lon'] = posicion['lon']
+        if posicion['snapped']:
+            posicion['lat'], posicion['lon'] = proyeccion[0], proyeccion[1]
+        posicion['ts'] = posicion['registrado'].replace(tzinfo=datetime.timezone.utc).timestamp()
+        ultimos[posicion['vehicle_id']] = posicion
+
+    if posiciones:
+        tabla_vehiculos.registrar(posiciones, app.config['VEHICLE_TTL_SECONDS'])
+    with _vehiculos_lock:
+        _historial_pendiente.extend({
+            'vehiculo_id': posicion['vehicle_id'],
+            'ruta_id': posicion['route_id'],
+            'latitud': posicion['raw_lat'],
+            'longitud': posicion['raw_lon'],
+            'distancia_ruta': posicion['distance_along'],
+            'desvio': posicion['offset_m'],
+            'registrado': posicion['registrado']
+        } for posicion in posiciones)
+
+    return len(posiciones), rechazadas
+
+def volcar_historial_vehiculos(forzar=False):
+    """Escribe el historial pendiente en un solo INSERT por lotes"""
+    global _ultimo_volcado
+    with _vehiculos_lock:
+        if not _historial_pendiente:
+            return 0
+        vencido = time.monotonic() - _ultimo_volcado >= app.config['VEHICLE_FLUSH_SECONDS']
+        if not forzar and not vencido and len(_historial_pendiente) < app.config['VEHICLE_FLUSH_SIZE']:
+            return 0
+        lote = list(_historial_pendiente)
+        _historial_pendiente.clear()
+        _ultimo_volcado = time.monotonic()
+
+    try:
+        db.session.execute(db.insert(VehiculoPosicion), lote)
+        db.session.commit()
+        return len(lote)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al guardar historial de vehículos: {e}")
+        # Reintentar en el próximo volcado sin dejar crecer la cola sin límite
+        with _vehiculos_lock:
+            _historial_pendiente[:0] = lote[-app.config['VEHICLE_FLUSH_SIZE'] * 10:]
+        return 0
+
+@atexit.register
+def _volcar_historial_al_salir():
+    try:
+        with app.app_context():
+            volcar_historial_vehiculos(forzar=True)
+    except Exception as e:
+        print(f"No se pudo guardar el historial de vehículos al salir: {e}")
+
+def ids_de_rutas(valor):
+    """Convierte '1,2,3' en un conjunto de IDs de ruta (vacío = todas)"""
+    if not valor:
+        return set()
+    return {int(v) for v in valor.split(',') if v.strip().isdigit()}
+
+def posiciones_visibles(rutas, desde_seq=0, con_recorrido=False):
+    """(secuencia, últimas posiciones no vencidas filtradas por ruta con secuencia mayor a desde_seq)"""
+    limite = time.time() - app.config['VEHICLE_STALE_SECONDS']
+    seq, posiciones = tabla_vehiculos.posiciones(desde_seq, con_recorrido)
+    return seq, [
+        _posicion_publica(posicion)
+        for posicion in posiciones
+        if posicion['ts'] >= limite and (not rutas or posicion['route_id'] in rutas)
+    ]
+
+def _posicion_publica(posicion):
+    publica = {
+        'vehicle_id': posicion['vehicle_id'],
+        'route_id': posicion['route_id'],
+        'lat': posicion['lat'],
+        'lon': posicion['lon'],
+        'snapped': posicion['snapped'],
+        'distance_along': posicion['distance_along'],
+        'offset_m': posicion['offset_m'],
+        'ts': posicion['ts']
+    }
+    if 'trail' in posicion:
+        publica['trail'] = posicion['trail']
+    return publica
+
+def eventos_vehiculos(rutas, ultimo_seq):
+    """(secuencia, texto SSE) con los cambios desde ultimo_seq, o un keepalive si no hay"""
+    seq, cambios = posiciones_visibles(rutas, ultimo_seq)
+    if cambios:
+        return seq, f"event: positions\ndata: {json.dumps(cambios)}\n\n"
+    return seq, ': keepalive\n\n'
+
+@app.route('/api/vehicles/ping', methods=['POST'])
+def vehicles_ping():
+    """Recibe lecturas GPS de los vehículos (una o un lote en 'fixes')"""
+    clave = app.config['VEHICLE_API_KEY']
+    if not clave:
+        return jsonify({'message': 'Recepción de posiciones deshabilitada: falta COMBIMAP_VEHICLE_KEY'}), 503
+    if not hmac.compare_digest(request.headers.get('x-vehicle-key', ''), clave):
+        return jsonify({'message': 'Clave de vehículo inválida'}), 401
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        fixes = data.get('fixes', [data])
+    elif isinstance(data, list):
+        fixes = data
+    else:
+        return jsonify({'message': 'Missing data'}), 400
+    if not isinstance(fixes, list):
+        return jsonify({'message': 'Missing data'}), 400
+    if len(fixes) > app.config['VEHICLE_MAX_FIXES']:
+        return jsonify({'message': f"Máximo {app.config['VEHICLE_MAX_FIXES']} lecturas por petición"}), 413
+
+    aceptadas, rechazadas = registrar_posiciones([f for f in fixes if isinstance(f, dict)])
+    rechazadas += sum(1 for f in fixes if not isinstance(f, dict))
+    volcar_historial_vehiculos()
+
+    return jsonify({'accepted': aceptadas, 'rejected': rechazadas}), 202
+
+@app.route('/api/vehicles')
+def get_vehicles():
+    """Últimas posiciones conocidas; ?trail=1 incluye el buffer reciente"""
+    rutas = ids_de_rutas(request.args.get('routes'))
+    _, vehiculos = posiciones_visibles(rutas, con_recorrido=bool(request.args.get('trail')))
+    return jsonify(vehiculos)
+
+def modo_vehiculos():
+    """
+    Cómo sigue el mapa a los vehículos: 'stream' (SSE, solo con el worker
+    ASGI), 'poll' (consultas periódicas a /api/vehicles) o None si no se
+    reciben posiciones porque falta COMBIMAP_VEHICLE_KEY.
+    """
+    if not app.config['VEHICLE_API_KEY']:
+        return None
+    return 'stream' if app.config['VEHICLE_STREAM_ASYNC'] else 'poll'
+
+@app.route('/api/vehicles/stream')
+def vehicles_stream():
+    """
+    Server-Sent Events de posiciones: los atiende asgi.py en el event loop.
+    Con gunicorn síncrono cada cliente ocuparía un hilo para siempre, así que
+    aquí se rechaza y el mapa consulta /api/vehicles periódicamente.
+    """
+    return jsonify({'message': 'El stream de vehículos requiere el worker ASGI; usa /api/vehicles'}), 503
+
+# --- Rutas Cercanas a un Punto ---
+
+class DatosSegmentos:
+    """
+    Rejilla de IndiceSegmentos. Las celdas guardan tuplas que se reemplazan
+    en lugar de modificarse, así que una copia (DatosSegmentos(base)) puede
+    compartirlas con la versión publicada.
+    """
+
+    def __init__(self, base=None):
+        self.celdas = dict(base.celdas) if base else {}
+        self.celdas_por_ruta = dict(base.celdas_por_ruta) if base else {}
+        self.rutas = dict(base.rutas) if base else {}       # ruta_id -> (nombre, color, geometría)
+
+    def quitar_ruta(self, ruta_id):
+        for celda in self.celdas_por_ruta.pop(ruta_id, ()):
+            segmentos = tuple(s for s in self.celdas.get(celda, ()) if s[0] != ruta_id)
+            if segmentos:
+                self.celdas[celda] = segmentos
+            else:
+                self.celdas.pop(celda, None)
+        self.rutas.pop(ruta_id, None)
+
+class IndiceSegmentos(IndiceEnMemoria):
+    """
+    Rejilla uniforme con los segmentos de los trazos de las rutas activas.
+    Cada celda guarda (ruta_id, índice de segmento) de los segmentos cuyo
+    rectángulo la toca; una consulta solo revisa las celdas del radio.
+    """
+    TAMANO_CELDA = 0.002  # grados (~220 m en Teziutlán)
+
+    def _celda(self, lat, lon):
+        return int(math.floor(lat / self.TAMANO_CELDA)), int(math.floor(lon / self.TAMANO_CELDA))
+
+    def _indexar_ruta(self, datos, ruta):
+        datos.quitar_ruta(ruta.id)
+        geometria = geometria_ruta(ruta.id)
+        if not ruta.activa or not geometria or len(geometria[0]) < 2:
+            return
+        # Copia de los memoryviews de la instantánea: el índice dura más que el
+        # archivo mapeado, que así se libera al publicarse la siguiente versión
+        lats, lons, acumulado = (array('d', valores) for valores in geometria)
+        nuevos = {}
+        for i in range(len(lats) - 1):
+            y1, x1 = self._celda(min(lats[i], lats[i + 1]), min(lons[i], lons[i + 1]))
+            y2, x2 = self._celda(max(lats[i], lats[i + 1]), max(lons[i], lons[i + 1]))
+            for cy in range(y1, y2 + 1):
+                for cx in range(x1, x2 + 1):
+                    nuevos.setdefault((cy, cx), []).append((ruta.id, i))
+        for celda, segmentos in nuevos.items():
+            datos.celdas[celda] = datos.celdas.get(celda, ()) + tuple(segmentos)
+        datos.celdas_por_ruta[ruta.id] = set(nuevos)
+        datos.rutas[ruta.id] = (ruta.nombre, ruta.color, (lats, lons, acumulado))
+
+    def _construir(self):
+        datos = DatosSegmentos()
+        for ruta in Ruta.query.filter_by(activa=True):
+            self._indexar_ruta(datos, ruta)
+        return datos
+
+    def _pendientes(self, cambios):
+        return {entidad_id for entidad, entidad_id, _ in cambios if entidad == 'ruta'}
+
+    def _aplicar(self, datos, pendientes):
+        """Reindexa solo las rutas cuyo trazo o estado cambió"""
+        datos = DatosSegmentos(datos)
+        for ruta_id in pendientes:
+            ruta = db.session.get(Ruta, ruta_id)
+            if ruta is None:
+                datos.quitar_ruta(ruta_id)
+            else:
+                self._indexar_ruta(datos, ruta)
+        return datos
+
+    def cercanas(self, lat, lon, radio_m):
+        """Rutas con algún segmento a menos de radio_m; la proyección más cercana de cada una"""
+        datos = self.datos
+        if datos is None:
+            return []
+        d_lat = radio_m / METROS_POR_GRADO
+        d_lon = radio_m / (METROS_POR_GRADO * max(math.cos(math.radians(lat)), 0.01))
+        y1, x1 = self._celda(lat - d_lat, lon - d_lon)
+        y2, x2 = self._celda(lat + d_lat, lon + d_lon)
+
+        revisados = set()
+        mejores = {}
+        for cy in range(y1, y2 + 1):
+            for cx in range(x1, x2 + 1):
+                for segmento in datos.celdas.get((cy, cx), ()):
+                    if segmento in revisados:
+                        continue
+                    revisados.add(segmento)
+                    ruta_id, i = segmento
+                    proyeccion = proyectar_en_ruta(datos.rutas[ruta_id][2], lat, lon, i, i + 1)
+                    if proyeccion and proyeccion[3] <= radio_m and (
+                            ruta_id not in mejores or proyeccion[3] < mejores[ruta_id][3]):
+                        mejores[ruta_id] = proyeccion
+
+        resultados = []
+        for ruta_id, (p_lat, p_lon, a_lo_largo, distancia, _) in mejores.items():
+            nombre, color, _ = datos.rutas[ruta_id]
+            resultados.append({
+                'route_id': ruta_id,
+                'name': nombre,
+                'color': color,
+                'distance_m': round(distancia, 1),
+                'closest': {'lat': p_lat, 'lon': p_lon},
+                'distance_along_m': round(a_lo_largo, 1)
+            })
+        resultados.sort(key=lambda r: r['distance_m'])
+        return resultados
+
+indice_segmentos = IndiceSegmentos()
+al_cambiar_red(indice_segmentos.marcar)
+
+@app.route('/api/routes/near')
+def routes_near():
+    """Rutas que pasan a menos de radius_m metros (400 por defecto) del punto"""
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radio = float(request.args.get('radius_m', 400))
+    except (KeyError, ValueError):
+        return jsonify({"error": "Latitud y longitud son requeridas"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or not 0 < radio <= 3000:
+        return jsonify({"error": "Coordenadas o radio fuera de rango (máximo 3000 m)"}), 400
+
+    indice_segmentos.actualizar()
+    return jsonify(indice_segmentos.cercanas(lat, lon, radio))
+
+# --- Agrupación de Paradas por Nivel de Zoom ---
+
+def _mercator_x(lon):
+    return lon / 360 + 0.5
+
+def _mercator_y(lat):
+    seno = math.sin(math.radians(max(min(lat, 85.0511), -85.0511)))
+    return 0.5 - 0.25 * math.log((1 + seno) / (1 - seno)) / math.pi
+
+def _latitud_mercator(y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+class IndiceClusters:
+    """
+    Jerarquía de grupos de paradas al estilo supercluster: cada nivel de zoom
+    se construye agrupando los puntos del nivel inmediato superior dentro de
+    un radio fijo en píxeles. Los puntos de cada nivel se guardan ordenados
+    por x para recortar la vista con bisect.
+    """
+
+    def __init__(self, paradas, radio_px, zoom_min, zoom_max):
+        self.zoom_min = zoom_min
+        self.zoom_max = zoom_max
+        self.niveles = {}
+        # [x, y, cantidad, id, parada o None, zoom de expansión]
+        puntos = [[_mercator_x(float(p.longitud)), _mercator_y(float(p.latitud)), 1, p.id,
+                   serializar_parada(p), zoom_max + 1] for p in paradas]
+        self._guardar_nivel(zoom_max + 1, puntos)
+        siguiente_id = -1
+        for zoom in range(zoom_max, zoom_min - 1, -1):
+            puntos, siguiente_id = self._agrupar(puntos, radio_px / (256 * 2 ** zoom), zoom, siguiente_id)
+            self._guardar_nivel(zoom, puntos)
+
+    def _guardar_nivel(self, zoom, puntos):
+        puntos.sort(key=lambda p: p[0])
+        self.niveles[zoom] = (puntos, [p[0] for p in puntos])
+
+    @staticmethod
+    def _agrupar(puntos, radio, zoom, siguiente_id):
+        celdas = {}
+        for indice, punto in enumerate(puntos):
+            celdas.setdefault((int(punto[0] / radio), int(punto[1] / radio)), []).append(indice)
+
+        usados = [False] * len(puntos)
+        agrupados = []
+        for indice, punto in enumerate(puntos):
+            if usados[indice]:
+                continue
+            usados[indice] = True
+            cx, cy = int(punto[0] / radio), int(punto[1] / radio)
+            vecinos = []
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for otro in celdas.get((cx + dx, cy + dy), ()):
+                        if not usados[otro]:
+                            ox, oy = puntos[otro][0], puntos[otro][1]
+                            if (ox - punto[0]) ** 2 + (oy - punto[1]) ** 2 <= radio * radio:
+                                vecinos.append(otro)
+            if not vecinos:
+                agrupados.append(punto)
+                continue
+
+            cantidad = punto[2]
+            x, y = punto[0] * punto[2], punto[1] * punto[2]
+            for otro in vecinos:
+                usados[otro] = True
+                x += puntos[otro][0] * puntos[otro][2]
+                y += puntos[otro][1] * puntos[otro][2]
+                cantidad += puntos[otro][2]
+            agrupados.append([x / cantidad, y / cantidad, cantidad, siguiente_id, None, zoom + 1])
+            siguiente_id -= 1
+        return agrupados, siguiente_id
+
+    def obtener(self, zoom, oeste, sur, este, norte):
+        zoom = max(self.zoom_min, min(zoom, self.zoom_max + 1))
+        puntos, xs = self.niveles[zoom]
+        x1, x2 = _mercator_x(oeste), _mercator_x(este)
+        y1, y2 = _mercator_y(norte), _mercator_y(sur)
+
+        resultado = []
+        for punto in puntos[bisect_left(xs, x1):bisect_right(xs, x2)]:
+            if not y1 <= punto[1] <= y2:
+                continue
+            if punto[4] is not None:
+                resultado.append({'type': 'stop', **punto[4]})
+            else:
+                resultado.append({
+                    'type': 'cluster',
+                    'id': punto[3],
+                    'count': punto[2],
+                    'lat': _latitud_mercator(punto[1]),
+                    'lon': (punto[0] - 0.5) * 360,
+                    'expansion_zoom': punto[5]
+                })
+        return resultado
+
+_clusters_lock = threading.Lock()
+_clusters = {'version': None, 'indice': None}
+
+def indice_clusters():
+    """Índice de grupos de la versión actual de la red; se reconstruye al cambiar"""
+    version = version_sincronizada()
+    if _clusters['version'] == version:
+        return _clusters['indice']
+    with _clusters_lock, lecturas_en_primaria():
+        if _clusters['version'] != version:
+            _clusters['indice'] = IndiceClusters(
+                Parada.query.all(),
+                app.config['CLUSTER_RADIUS_PX'],
+                app.config['CLUSTER_MIN_ZOOM'],
+                app.config['CLUSTER_MAX_ZOOM'])
+            _clusters['version'] = version
+        return _clusters['indice']
+
+def _normalizar_longitud(lon):
+    return lon if -180 <= lon <= 180 else (lon + 180) % 360 - 180
+
+@app.route('/api/stops/clusters')
+def get_stop_clusters():
+    """Grupos de paradas (cantidad y centroide) visibles en bbox=oeste,sur,este,norte"""
+    try:
+        # Los mapas con zoom fraccionario piden, p. ej., zoom=13.5: se usa el nivel entero inferior
+        zoom = math.floor(float(request.args['zoom']))
+        oeste, sur, este, norte = (float(v) for v in request.args['bbox'].split(','))
+    except (KeyError, ValueError, OverflowError):
+        return jsonify({"error": "Se requieren zoom y bbox=oeste,sur,este,norte"}), 400
+    if sur > norte or not all(map(math.isfinite, (oeste, sur, este, norte))):
+        return jsonify({"error": "bbox inválido"}), 400
+    if este - oeste >= 360:
+        oeste, este = -180, 180
+    else:
+        # Al desplazar el mapa más allá de ±180 las longitudes siguen creciendo; se regresan al rango
+        oeste, este = _normalizar_longitud(oeste), _normalizar_longitud(este)
+
+    indice = indice_clusters()
+    if oeste > este:
+        # La vista cruza el antimeridiano
+        resultado = indice.obtener(zoom, oeste, sur, 180, norte) + indice.obtener(zoom, -180, sur, este, norte)
+    else:
+        resultado = indice.obtener(zoom, oeste, sur, este, norte)
+    return jsonify(resultado)
+
+# --- Exportación GTFS ---
+
+app.config['GTFS_AGENCY_NAME'] = 'CombiMap Teziutlán'
+app.config['GTFS_AGENCY_URL'] = 'https://combimap.mx'
+app.config['GTFS_TIMEZONE'] = 'America/Mexico_City'
+app.config['GTFS_DEFAULT_HOURS'] = ('06:00', '21:00')   # si la ruta no tiene horario
+app.config['GTFS_HEADWAY_MINUTES'] = 15
+app.config['GTFS_SPEED_KMH'] = 20
+app.config['GTFS_YIELD_PER'] = 2000
+
+class _SalidaStreaming(io.RawIOBase):
+    """Destino no posicionable para zipfile que acumula bytes hasta vaciarlos"""
+    def __init__(self):
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes.clear()
+        return datos
+
+def _hora_gtfs(segundos):
+    """Formato HH:MM:SS de GTFS (las horas pueden pasar de 24)"""
+    segundos = int(round(segundos))
+    return f"{segundos // 3600:02d}:{segundos % 3600 // 60:02d}:{segundos % 60:02d}"
+
+def _segundos_del_dia(hora):
+    if isinstance(hora, str):
+        hora = datetime.time.fromisoformat(hora)
+    return hora.hour * 3600 + hora.minute * 60 + hora.second
+
+def _filas_en_lotes(consulta):
+    """Itera filas con cursor del lado del servidor, sin cargarlas todas en memoria"""
+    return db.session.execute(consulta.execution_options(yield_per=app.config['GTFS_YIELD_PER']))
+
+def _tablas_gtfs():
+    """Genera (nombre de archivo, encabezado, iterador de filas) de cada tabla GTFS"""
+    hoy = datetime.date.today()
+    rutas_activas = db.select(Ruta.id).where(Ruta.activa == True)
+    # Solo las rutas con al menos dos paradas pueden tener viajes
+    con_viajes = {
+        ruta_id for ruta_id, total in db.session.execute(
+            db.select(RutaParada.ruta_id, db.func.count(RutaParada.id))
+            .where(RutaParada.ruta_id.in_(rutas_activas))
+            .group_by(RutaParada.ruta_id)
+        ) if total >= 2
+    }
+    con_trazo = {
+        ruta_id for (ruta_id,) in db.session.execute(
+            db.select(RutaCoordenada.ruta_id).where(RutaCoordenada.ruta_id.in_(rutas_activas)).distinct()
+        )
+    }
+
+    yield 'agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang'], [
+        ['combimap', app.config['GTFS_AGENCY_NAME'], app.config['GTFS_AGENCY_URL'], app.config['GTFS_TIMEZONE'], 'es']
+    ]
+
+    yield 'calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                           'saturday', 'sunday', 'start_date', 'end_date'], [
+        ['diario', 1, 1, 1, 1, 1, 1, 1, hoy.strftime('%Y%m%d'), (hoy + datetime.timedelta(days=365)).strftime('%Y%m%d')]
+    ]
+
+    yield 'stops.txt', ['stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon'], (
+        [p.id, p.nombre, p.descripcion or '', f"{float(p.latitud):.6f}", f"{float(p.longitud):.6f}"]
+        for p in _filas_en_lotes(db.select(Parada.id, Parada.nombre, Parada.descripcion, Parada.latitud, Parada.longitud)
+                                 .order_by(Parada.id))
+    )
+
+    consulta_rutas = db.select(Ruta.id, Ruta.nombre, Ruta.descripcion, Ruta.color, Ruta.horario_inicio, Ruta.horario_fin)\
+        .where(Ruta.activa == True).order_by(Ruta.id)
+
+    yield 'routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc',
+                         'route_type', 'route_color', 'route_text_color'], (
+        [r.id, 'combimap', r.nombre[:12], r.nombre, r.descripcion or '', 3,
+         (r.color or '#FF0000').lstrip('#').upper(), 'FFFFFF']
+        for r in _filas_en_lotes(consulta_rutas)
+    )
+
+    yield 'trips.txt', ['route_id', 'service_id', 'trip_id', 'shape_id'], (
+        [r.id, 'diario', f"ruta_{r.id}", f"trazo_{r.id}" if r.id in con_trazo else '']
+        for r in _filas_en_lotes(consulta_rutas) if r.id in con_viajes
+    )
+
+    yield 'stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'], \
+        _filas_stop_times(consulta_rutas, con_viajes)
+
+    yield 'frequencies.txt', ['trip_id', 'start_time', 'end_time', 'headway_secs', 'exact_times'], \
+        _filas_frecuencias(consulta_rutas, con_viajes)
+
+    yield 'shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence', 'shape_dist_traveled'], \
+        _filas_trazos(rutas_activas)
+
+def _inicio_servicio(ruta):
+    return _segundos_del_dia(ruta.horario_inicio or app.config['GTFS_DEFAULT_HOURS'][0])
+
+def _filas_stop_times(consulta_rutas, con_viajes):
+    """Horarios relativos al inicio del servicio, estimados por distancia entre paradas"""
+    inicios = {r.id: _inicio_servicio(r) for r in _filas_en_lotes(consulta_rutas) if r.id in con_viajes}
+    velocidad = app.config['GTFS_SPEED_KMH'] / 3.6
+    consulta = db.select(RutaParada.ruta_id, RutaParada.parada_id, Parada.latitud, Parada.longitud)\
+        .join(Parada, Parada.id == RutaParada.parada_id)\
+        .where(RutaParada.ruta_id.in_(list(inicios)))\
+        .order_by(RutaParada.ruta_id, RutaParada.orden)
+
+    ruta_actual, secuencia, tiempo, anterior = None, 0, 0.0, None
+    for fila in _filas_en_lotes(consulta):
+        lat, lon = float(fila.latitud), float(fila.longitud)
+        if fila.ruta_id != ruta_actual:
+            ruta_actual, secuencia, tiempo, anterior = fila.ruta_id, 0, float(inicios[fila.ruta_id]), None
+        if anterior:
+            tiempo += distancia_haversine(anterior[0], anterior[1], lat, lon) / velocidad
+        secuencia += 1
+        hora = _hora_gtfs(tiempo)
+        yield [f"ruta_{fila.ruta_id}", hora, hora, fila.parada_id, secuencia]
+        anterior = (lat, lon)
+
+def _filas_frecuencias(consulta_rutas, con_viajes):
+    headway = app.config['GTFS_HEADWAY_MINUTES'] * 60
+    for r in _filas_en_lotes(consulta_rutas):
+        if r.id not in con_viajes:
+            continue
+        inicio = _inicio_servicio(r)
+        fin = _segundos_del_dia(r.horario_fin or app.config['GTFS_DEFAULT_HOURS'][1])
+        if fin <= inicio:
+            fin += 24 * 3600  # servicio que cruza la medianoche
+        yield [f"ruta_{r.id}", _hora_gtfs(inicio), _hora_gtfs(fin), headway, 0]
+
+def _filas_trazos(rutas_activas):
+    consulta = db.select(RutaCoordenada.ruta_id, RutaCoordenada.latitud, RutaCoordenada.longitud)\
+        .where(RutaCoordenada.ruta_id.in_(rutas_activas))\
+        .order_by(RutaCoordenada.ruta_id, RutaCoordenada.orden)
+
+    ruta_actual, secuencia, distancia, anterior = None, 0, 0.0, None
+    for fila in _filas_en_lotes(consulta):
+        lat, lon = float(fila.latitud), float(fila.longitud)
+        if fila.ruta_id != ruta_actual:
+            ruta_actual, secuencia, distancia, anterior = fila.ruta_id, 0, 0.0, None
+        if anterior:
+            distancia += distancia_haversine(anterior[0], anterior[1], lat, lon)
+        secuencia += 1
+        yield [f"trazo_{fila.ruta_id}", f"{lat:.6f}", f"{lon:.6f}", secuencia, f"{distancia:.1f}"]
+        anterior = (lat, lon)
+
+def generar_zip_gtfs(filas_por_bloque=1000):
+    """Escribe el feed GTFS como zip y entrega los bytes por partes conforme se generan"""
+    salida = _SalidaStreaming()
+    with zipfile.ZipFile(salida, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for nombre, encabezado, filas in _tablas_gtfs():
+            with zf.open(nombre, 'w', force_zip64=True) as destino:
+                texto = io.TextIOWrapper(destino, encoding='utf-8', newline='')
+                escritor = csv.writer(texto, lineterminator='\n')
+                escritor.writerow(encabezado)
+                for i, fila in enumerate(filas, 1):
+                    escritor.writerow(fila)
+                    if i % filas_por_bloque == 0:
+                        texto.flush()
+                        yield salida.vaciar()
+                texto.flush()
+                texto.detach()
+            yield salida.vaciar()
+    yield salida.vaciar()
+
+def _guardar_en_cache(partes, ruta_final):
+    """Copia las partes a un archivo temporal y lo publica al terminar sin errores"""
+    carpeta = os.path.dirname(ruta_final)
+    os.makedirs(carpeta, exist_ok=True)
+    fd, temporal = tempfile.mkstemp(dir=carpeta, suffix='.tmp')
+    completo = False
+    try:
+        with os.fdopen(fd, 'wb') as archivo:
+            for parte in partes:
+                if parte:
+                    archivo.write(parte)
+                    yield parte
+        os.replace(temporal, ruta_final)
+        completo = True
+        # Descartar exportaciones de versiones anteriores
+        for nombre in os.listdir(carpeta):
+            viejo = os.path.join(carpeta, nombre)
+            if nombre.startswith('gtfs_') and nombre.endswith('.zip') and viejo != ruta_final:
+                os.remove(viejo)
+    finally:
+        if not completo and os.path.exists(temporal):
+            os.remove(temporal)
+
+@app.route('/api/export/gtfs.zip')
+def export_gtfs():
+    """Feed GTFS de la red completa, generado en streaming y cacheado por versión de datos"""
+    version = version_red()
+    etag = f"gtfs-{version}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    archivo = os.path.join(app.config['CACHE_FOLDER'], 'gtfs', f"gtfs_{version}.zip")
+    if os.path.exists(archivo):
+        respuesta = send_file(archivo, mimetype='application/zip', as_attachment=True,
+                              download_name='combimap_gtfs.zip', etag=etag, conditional=True)
+        respuesta.headers['Cache-Control'] = 'public, max-age=300'
+        return respuesta
+
+    partes = _guardar_en_cache(generar_zip_gtfs(), archivo)
+    return Response(stream_with_context(partes), mimetype='application/zip', headers={
+        'Content-Disposition': 'attachment; filename=combimap_gtfs.zip',
+        'ETag': f'"{etag}"',
+        'Cache-Control': 'public, max-age=300'
+    })
+
+# --- Isócronas (Caminata + Combi) ---
+
+app.config['ISOCHRONE_WALK_KMH'] = 4.8        # velocidad a pie
+app.config['ISOCHRONE_DETOUR'] = 1.3          # factor de rodeo de las calles sobre la línea recta
+app.config['ISOCHRONE_CELL_M'] = 100          # tamaño de celda del ráster
+app.config['ISOCHRONE_TRANSFER_M'] = 500      # caminata máxima para transbordar entre paradas
+app.config['ISOCHRONE_MAX_MINUTES'] = 90
+app.config['ISOCHRONE_CACHE_SIZE'] = 256      # isócronas guardadas (por celda de origen y minutos)
+# La velocidad de la combi y la espera (medio intervalo) se toman de GTFS_SPEED_KMH y GTFS_HEADWAY_MINUTES
+
+class RedIsocronas:
+    """
+    Paradas (en arreglos NumPy) y recorridos de las rutas activas con la
+    distancia de cada parada a lo largo del trazo; se arma una vez por
+    versión de la red.
+    """
+
+    def __init__(self):
+        paradas = db.session.query(Parada.id, Parada.latitud, Parada.longitud).order_by(Parada.id).all()
+        self.ids = [p.id for p in paradas]
+        indice = {parada_id: i for i, parada_id in enumerate(self.ids)}
+        self.lats = np.array([float(p.latitud) for p in paradas], dtype=float)
+        self.lons = np.array([float(p.longitud) for p in paradas], dtype=float)
+
+        # Recorridos: (ruta_id, índices de parada, distancia acumulada en metros)
+        self.recorridos = []
+        self.por_parada = [[] for _ in self.ids]
+        filas = db.session.query(RutaParada.ruta_id, RutaParada.parada_id)\
+            .join(Ruta, Ruta.id == RutaParada.ruta_id).filter(Ruta.activa == True)\
+            .order_by(RutaParada.ruta_id, RutaParada.orden).all()
+        paradas_por_ruta = {}
+        for ruta_id, parada_id in filas:
+            paradas_por_ruta.setdefault(ruta_id, []).append(indice[parada_id])
+
+        for ruta_id, secuencia in paradas_por_ruta.items():
+            if len(secuencia) < 2:
+                continue
+            distancias = self._distancias_en_ruta(geometria_ruta(ruta_id), secuencia)
+            numero = len(self.recorridos)
+            self.recorridos.append((ruta_id, secuencia, distancias))
+            for posicion, i in enumerate(secuencia):
+                self.por_parada[i].append((numero, posicion))
+
+    def _distancias_en_ruta(self, geometria, secuencia):
+        """Distancia a lo largo del trazo de cada parada; avanza sin retroceder por el trazo"""
+        distancias = []
+        segmento = 0
+        anterior = None
+        for i in secuencia:
+            lat, lon = float(self.lats[i]), float(self.lons[i])
+            if geometria and len(geometria[0]) >= 2:
+                proyeccion = proyectar_en_ruta(geometria, lat, lon, inicio=segmento)
+                distancia, segmento = proyeccion[2], proyeccion[4]
+            elif anterior is None:
+                distancia = 0.0
+            else:
+                distancia = distancias[-1] + distancia_haversine(anterior[0], anterior[1], lat, lon)
+            distancias.append(max(distancia, distancias[-1]) if distancias else distancia)
+            anterior = (lat, lon)
+        return distancias
+
+    def tiempos_a_paradas(self, xs, ys, minutos, caminar, rodar, espera, detour, transbordo):
+        """Dijkstra sobre paradas: caminata desde el origen, viajes en combi y transbordos a pie"""
+        mejor = np.hypot(xs, ys) * detour / caminar
+        mejor[mejor > minutos] = np.inf
+        monticulo = [(float(t), int(i)) for i, t in enumerate(mejor) if t <= minutos]
+        heapq.heapify(monticulo)
+
+        while monticulo:
+            t, i = heapq.heappop(monticulo)
+            if t > mejor[i]:
+                continue
+
+            for numero, posicion in self.por_parada[i]:
+                _, secuencia, distancias = self.recorridos[numero]
+                salida = t + espera
+                for j in range(posicion + 1, len(secuencia)):
+                    llegada = salida + (distancias[j] - distancias[posicion]) / rodar
+                    if llegada > minutos:
+                        break
+                    destino = secuencia[j]
+                    if llegada < mejor[destino]:
+                        mejor[destino] = llegada
+                        heapq.heappush(monticulo, (llegada, destino))
+
+            caminata = np.hypot(xs - xs[i], ys - ys[i]) * detour
+            llegadas = t + caminata / caminar
+            for j in np.nonzero((caminata <= transbordo) & (llegadas < mejor) & (llegadas <= minutos))[0]:
+                mejor[j] = llegadas[j]
+                heapq.heappush(monticulo, (float(llegadas[j]), int(j)))
+
+        return mejor
+
+_isocronas_lock = threading.Lock()
+_red_isocronas = {'version': None, 'red': None}
+_isocronas_cache = OrderedDict()
+
+def red_isocronas():
+    version = version_sincronizada()
+    if _red_isocronas['version'] == version:
+        return _red_isocronas['red'], version
+    with _isocronas_lock, lecturas_en_primaria():
+        if _red_isocronas['version'] != version:
+            _red_isocronas['red'] = RedIsocronas()
+            _red_isocronas['version'] = version
+            _isocronas_cache.clear()
+        return _red_isocronas['red'], version
+
+def _rectangulos_de_mascara(mascara):
+    """Cubre la máscara con rectángulos: tramos por fila fusionados con las filas siguientes idénticas"""
+    rectangulos = []
+    abiertos = {}
+    for fila in range(mascara.shape[0] + 1):
+        tramos = set()
+        if fila < mascara.shape[0]:
+            cambios = np.diff(np.concatenate(([0], mascara[fila].view(np.int8), [0])))
+            tramos = set(zip(np.nonzero(cambios == 1)[0].tolist(), np.nonzero(cambios == -1)[0].tolist()))
+        for tramo in list(abiertos):
+            if tramo not in tramos:
+                rectangulos.append((abiertos.pop(tramo), fila, tramo[0], tramo[1]))
+        for tramo in tramos:
+            abiertos.setdefault(tramo, fila)
+    return rectangulos
+
+def calcular_isocrona(lat, lon, minutos, red):
+    """Ráster de tiempos (caminata desde el origen y desde cada parada alcanzada) como MultiPolygon"""
+    caminar = app.config['ISOCHRONE_WALK_KMH'] * 1000 / 60
+    rodar = app.config['GTFS_SPEED_KMH'] * 1000 / 60
+    espera = app.config['GTFS_HEADWAY_MINUTES'] / 2
+    detour = app.config['ISOCHRONE_DETOUR']
+    celda = app.config['ISOCHRONE_CELL_M']
+
+    # Plano local en metros centrado en el origen
+    escala_x = math.cos(math.radians(lat)) * METROS_POR_GRADO
+    xs = (red.lons - lon) * escala_x
+    ys = (red.lats - lat) * METROS_POR_GRADO
+    tiempos = red.tiempos_a_paradas(xs, ys, minutos, caminar, rodar, espera, detour,
+                                    app.config['ISOCHRONE_TRANSFER_M'])
+
+    alcanzadas = np.nonzero(np.isfinite(tiempos))[0]
+    fuentes_x = np.concatenate(([0.0], xs[alcanzadas]))
+    fuentes_y = np.concatenate(([0.0], ys[alcanzadas]))
+    fuentes_t = np.concatenate(([0.0], tiempos[alcanzadas]))
+    alcance = (minutos - fuentes_t) * caminar / detour
+
+    x0 = math.floor(float(np.min(fuentes_x - alcance)) / celda) * celda
+    y0 = math.floor(float(np.min(fuentes_y - alcance)) / celda) * celda
+    columnas = int(math.ceil((float(np.max(fuentes_x + alcance)) - x0) / celda)) + 1
+    filas = int(math.ceil((float(np.max(fuentes_y + alcance)) - y0) / celda)) + 1
+    centros_x = x0 + (np.arange(columnas) + 0.5) * celda
+    centros_y = y0 + (np.arange(filas) + 0.5) * celda
+
+    raster = np.full((filas, columnas), np.inf)
+    for fx, fy, ft, radio in zip(fuentes_x, fuentes_y, fuentes_t, alcance):
+        c1, c2 = int((fx - radio - x0) // celda), int((fx + radio - x0) // celda) + 1
+        f1, f2 = int((fy - radio - y0) // celda), int((fy + radio - y0) // celda) + 1
+        dx = centros_x[c1:c2] - fx
+        dy = centros_y[f1:f2, None] - fy
+        np.minimum(raster[f1:f2, c1:c2], ft + np.hypot(dx, dy) * detour / caminar, out=raster[f1:f2, c1:c2])
+
+    poligonos = []
+    for f1, f2, c1, c2 in _rectangulos_de_mascara(raster <= minutos):
+        oeste = lon + (x0 + c1 * celda) / escala_x
+        este = lon + (x0 + c2 * celda) / escala_x
+        sur = lat + (y0 + f1 * celda) / METROS_POR_GRADO
+        norte = lat + (y0 + f2 * celda) / METROS_POR_GRADO
+        poligonos.append([[[round(oeste, 6), round(sur, 6)], [round(este, 6), round(sur, 6)],
+                           [round(este, 6), round(norte, 6)], [round(oeste, 6), round(norte, 6)],
+                           [round(oeste, 6), round(sur, 6)]]])
+
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'MultiPolygon', 'coordinates': poligonos},
+        'properties': {
+            'origin': {'lat': lat, 'lon': lon},
+            'minutes': minutos,
+            'cell_m': celda,
+            'stops': [{'id': red.ids[i], 'minutes': round(float(tiempos[i]), 1)} for i in alcanzadas]
+        }
+    }
+
+@app.route('/api/isochrone')
+def isochrone():
+    """Área alcanzable en `minutes` caminando y en combi desde el punto (GeoJSON)"""
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        minutos = int(request.args.get('minutes', 30))
+    except (KeyError, ValueError):
+        return jsonify({"error": "Latitud y longitud son requeridas"}), 400
+    if not (-85 <= lat <= 85 and -180 <= lon <= 180) or not 1 <= minutos <= app.config['ISOCHRONE_MAX_MINUTES']:
+        return jsonify({"error": f"Coordenadas o minutos fuera de rango (máximo {app.config['ISOCHRONE_MAX_MINUTES']})"}), 400
+
+    # El origen se ajusta al centro de su celda para que consultas cercanas compartan resultado
+    paso_lat = app.config['ISOCHRONE_CELL_M'] / METROS_POR_GRADO
+    paso_lon = paso_lat / math.cos(math.radians(lat))
+    celda = (math.floor(lat / paso_lat), math.floor(lon / paso_lon))
+    lat = (celda[0] + 0.5) * paso_lat
+    lon = (celda[1] + 0.5) * paso_lon
+
+    red, version = red_isocronas()
+    llave = (version, celda, minutos)
+    with _isocronas_lock:
+        cuerpo = _isocronas_cache.get(llave)
+        if cuerpo is not None:
+            _isocronas_cache.move_to_end(llave)
+    if cuerpo is None:
+        cuerpo = json.dumps(calcular_isocrona(lat, lon, minutos, red))
+        with _isocronas_lock:
+            _isocronas_cache[llave] = cuerpo
+            while len(_isocronas_cache) > app.config['ISOCHRONE_CACHE_SIZE']:
+                _isocronas_cache.popitem(last=False)
+    return Response(cuerpo, mimetype='application/geo+json')
+
+# --- Horarios y Próximas Salidas ---
+
+TIPOS_DE_DIA = ('laborable', 'sabado', 'domingo')
+
+def tipo_de_dia(fecha):
+    dia = fecha.weekday()
+    return 'sabado' if dia == 5 else 'domingo' if dia == 6 else 'laborable'
+
+def _bandas_de_ruta(ruta):
+    """Bandas (inicio, fin, intervalo) en segundos por tipo de día; sin servicios usa el horario de la ruta"""
+    bandas = {tipo: [] for tipo in TIPOS_DE_DIA}
+    for servicio in ruta.servicios:
+        inicio = _segundos_del_dia(servicio.hora_inicio)
+        fin = _segundos_del_dia(servicio.hora_fin)
+        if fin <= inicio:
+            fin += 24 * 3600  # banda que cruza la medianoche
+        bandas[servicio.tipo_dia].append((inicio, fin, servicio.intervalo_minutos * 60))
+    if ruta.servicios:
+        return bandas, 'services'
+
+    inicio = _inicio_servicio(ruta)
+    fin = _segundos_del_dia(ruta.horario_fin or app.config['GTFS_DEFAULT_HOURS'][1])
+    if fin <= inicio:
+        fin += 24 * 3600
+    intervalo = app.config['GTFS_HEADWAY_MINUTES'] * 60
+    return {tipo: [(inicio, fin, intervalo)] for tipo in TIPOS_DE_DIA}, 'default'
+
+class Horarios:
+    """
+    Salidas de las rutas activas precalculadas por versión de la red:
+    por cada (ruta, parada, tipo de día) un arreglo ordenado de segundos
+    desde la medianoche, y por tipo de día los intervalos en que cada ruta
+    tiene combis en circulación. Las consultas se resuelven con bisect.
+    """
+
+    def __init__(self):
+        rutas = Ruta.query.filter_by(activa=True).options(db.selectinload(Ruta.servicios)).all()
+        self.rutas = {r.id: r.nombre for r in rutas}
+        self.origen = {}
+        self.desfases = self._desfases_por_parada(list(self.rutas))
+        self.salidas = {}
+        en_servicio = {tipo: [] for tipo in TIPOS_DE_DIA}
+
+        for ruta in rutas:
+            bandas, origen = _bandas_de_ruta(ruta)
+            self.origen[ruta.id] = origen
+            desfases = self.desfases.get(ruta.id, {})
+            duracion = max(desfases.values(), default=0)
+            for tipo, lista in bandas.items():
+                salidas = sorted({s for inicio, fin, intervalo in lista for s in range(inicio, fin + 1, intervalo)})
+                for parada_id, desfase in desfases.items():
+                    self.salidas[(ruta.id, parada_id, tipo)] = array('i', (s + desfase for s in salidas))
+                self.salidas[(ruta.id, None, tipo)] = array('i', salidas)
+                for inicio, fin, _ in lista:
+                    en_servicio[tipo].append((inicio, fin + duracion, ruta.id))
+
+        self.en_servicio = {}
+        for tipo, intervalos in en_servicio.items():
+            intervalos.sort()
+            self.en_servicio[tipo] = ([i[0] for i in intervalos], intervalos)
+
+    @staticmethod
+    def _desfases_por_parada(ruta_ids):
+        """Segundos desde la salida hasta cada parada, estimados igual que en la exportación GTFS"""
+        velocidad = app.config['GTFS_SPEED_KMH'] / 3.6
+        consulta = db.select(RutaParada.ruta_id, RutaParada.parada_id, Parada.latitud, Parada.longitud)\
+            .join(Parada, Parada.id == RutaParada.parada_id)\
+            .where(RutaParada.ruta_id.in_(ruta_ids))\
+            .order_by(RutaParada.ruta_id, RutaParada.orden)
+        desfases = {}
+        ruta_actual, tiempo, anterior = None, 0.0, None
+        for fila in db.session.execute(consulta):
+            lat, lon = float(fila.latitud), float(fila.longitud)
+            if fila.ruta_id != ruta_actual:
+                ruta_actual, tiempo, anterior = fila.ruta_id, 0.0, None
+            if anterior:
+                tiempo += distancia_haversine(anterior[0], anterior[1], lat, lon) / velocidad
+            desfases.setdefault(fila.ruta_id, {}).setdefault(fila.parada_id, int(round(tiempo)))
+            anterior = (lat, lon)
+        return desfases
+
+    def proximas(self, ruta_id, parada_id, momento, limite):
+        """Próximas salidas (en segundos relativos a la medianoche de `momento`)"""
+        segundos = momento.hour * 3600 + momento.minute * 60 + momento.second
+        resultado = []
+        # Salidas del día anterior que pasan de medianoche, las de hoy y las de mañana
+        for dias in (-1, 0, 1):
+            tipo = tipo_de_dia(momento + datetime.timedelta(days=dias))
+            salidas = self.salidas.get((ruta_id, parada_id, tipo), ())
+            desplazamiento = dias * 24 * 3600
+            inicio = bisect_left(salidas, segundos - desplazamiento)
+            resultado.extend(s + desplazamiento for s in salidas[inicio:inicio + limite])
+        resultado.sort()
+        return resultado[:limite]
+
+    def activas(self, momento):
+        """Rutas con combis en circulación en `momento`"""
+        segundos = momento.hour * 3600 + momento.minute * 60 + momento.second
+        activas = set()
+        for dias, desplazamiento in ((0, 0), (-1, 24 * 3600)):
+            inicios, intervalos = self.en_servicio[tipo_de_dia(momento + datetime.timedelta(days=dias))]
+            t = segundos + desplazamiento
+            for inicio, fin, ruta_id in intervalos[:bisect_right(inicios, t)]:
+                if fin >= t:
+                    activas.add(ruta_id)
+        return sorted(activas)
+
+_horarios_lock = threading.Lock()
+_horarios = {'version': None, 'horarios': None}
+
+def horarios():
+    version = version_sincronizada()
+    if _horarios['version'] == version:
+        return _horarios['horarios']
+    with _horarios_lock, lecturas_en_primaria():
+        if _horarios['version'] != version:
+            _horarios['horarios'] = Horarios()
+            _horarios['version'] = version
+        return _horarios['horarios']
+
+def _momento_consultado():
+    """`at` como HH:MM (hoy) o fecha ISO; por defecto la hora local de la red"""
+    ahora = datetime.datetime.now(ZoneInfo(app.config['GTFS_TIMEZONE'])).replace(tzinfo=None)
+    valor = request.args.get('at')
+    if not valor:
+        return ahora
+    if 'T' in valor or '-' in valor:
+        momento = datetime.datetime.fromisoformat(valor)
+        if momento.tzinfo is not None:
+            momento = momento.astimezone(ZoneInfo(app.config['GTFS_TIMEZONE'])).replace(tzinfo=None)
+        return momento
+    return datetime.datetime.combine(ahora.date(), datetime.time.fromisoformat(valor))
+
+@app.route('/api/routes/<int:route_id>/next')
+def next_departures(route_id):
+    """Próximas pasadas de la ruta por una parada (o salidas desde el origen si no se indica)"""
+    try:
+        momento = _momento_consultado()
+        parada_id = request.args.get('stop_id', type=int)
+        limite = min(max(int(request.args.get('limit', 3)), 1), 20)
+    except ValueError:
+        return jsonify({"error": "Parámetros inválidos"}), 400
+
+    tabla = horarios()
+    if route_id not in tabla.rutas:
+        return jsonify({"error": "Ruta no encontrada"}), 404
+    if parada_id is not None and parada_id not in tabla.desfases.get(route_id, {}):
+        return jsonify({"error": "La parada no pertenece a la ruta"}), 404
+
+    medianoche = datetime.datetime.combine(momento.date(), datetime.time())
+    salidas = []
+    for segundos in tabla.proximas(route_id, parada_id, momento, limite):
+        salida = medianoche + datetime.timedelta(seconds=segundos)
+        salidas.append({
+            'time': salida.strftime('%H:%M'),
+            'datetime': salida.isoformat(timespec='minutes'),
+            'in_minutes': int((salida - momento).total_seconds() // 60)
+        })
+    return jsonify({
+        'route_id': route_id,
+        'stop_id': parada_id,
+        'source': tabla.origen[route_id],
+        'departures': salidas
+    })
+
+@app.route('/api/routes/active')
+def routes_running():
+    """Rutas con servicio en el momento indicado (ahora por defecto)"""
+    try:
+        momento = _momento_consultado()
+    except ValueError:
+        return jsonify({"error": "Fecha u hora inválida"}), 400
+
+    tabla = horarios()
+    return jsonify({
+        'at': momento.isoformat(timespec='minutes'),
+        'day_type': tipo_de_dia(momento),
+        'routes': [{'id': ruta_id, 'name': tabla.rutas[ruta_id]} for ruta_id in tabla.activas(momento)]
+    })
+
+# --- Imágenes Responsivas ---
+
+app.config['MEDIA_FOLDER'] = os.path.join(app.root_path, 'cache', 'media')
+app.config['MEDIA_VERSION_FILE'] = os.path.join(app.root_path, 'cache', 'version_media.bin')
+app.config['IMAGE_WIDTHS'] = (320, 640, 1024, 1600)   # anchos de los derivados
+app.config['IMAGE_FORMATS'] = ('webp', 'jpeg')
+app.config['IMAGE_QUALITY'] = 80
+app.config['IMAGE_EXTENSIONS'] = {'jpg', 'jpeg', 'png', 'webp'}
+
+# Los derivados se nombran con el hash del contenido original
+# (<nombre>-<hash>-<ancho>.<ext>), así se sirven con caché de un año y una
+# imagen reemplazada produce URLs nuevas. manifest.json relaciona la ruta
+# del original con sus derivados. Cada escritura del manifiesto sube un
+# contador compartido; los workers lo releen solo cuando el contador cambia.
+
+contador_version_media = ContadorCompartido(app.config['MEDIA_VERSION_FILE'])
+_manifiesto_lock = threading.Lock()
+_manifiesto = {'version': None, 'datos': {}}
+
+def _ruta_manifiesto():
+    return os.path.join(app.config['MEDIA_FOLDER'], 'manifest.json')
+
+def _leer_manifiesto():
+    ruta = _ruta_manifiesto()
+    if not os.path.exists(ruta):
+        return {}
+    with open(ruta, encoding='utf-8') as archivo:
+        return json.load(archivo)
+
+def manifiesto_imagenes():
+    """Manifiesto de derivados; se relee solo si otro proceso subió la versión de los medios"""
+    version = contador_version_media.leer()
+    if version == _manifiesto['version']:
+        return _manifiesto['datos']
+    with _manifiesto_lock:
+        if version != _manifiesto['version']:
+            _manifiesto['datos'] = _leer_manifiesto()
+            _manifiesto['version'] = version
+        return _manifiesto['datos']
+
+def _guardar_manifiesto(clave, entrada):
+    # Un solo proceso a la vez lee, agrega y reescribe, así no se pierden entradas de otro
+    with _manifiesto_lock, open(os.path.join(app.config['MEDIA_FOLDER'], '.lock'), 'w') as candado:
+        fcntl.flock(candado, fcntl.LOCK_EX)
+        datos = _leer_manifiesto()
+        datos[clave] = entrada
+        fd, temporal = tempfile.mkstemp(dir=app.config['MEDIA_FOLDER'], suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as archivo:
+            json.dump(datos, archivo, ensure_ascii=False, indent=1)
+        os.replace(temporal, _ruta_manifiesto())
+        version = contador_version_media.leer() + 1
+        contador_version_media.subir(version)
+        _manifiesto['datos'] = datos
+        _manifiesto['version'] = version
+
+def clave_imagen(valor):
+    """Ruta local del original para un valor de `imagenes` (None si es una URL externa)"""
+    if valor.startswith(('http://', 'https://', '//')):
+        return None
+    valor = valor.lstrip('/')
+    if '/' not in valor:
+        valor = os.path.join(app.config['UPLOAD_FOLDER'], 'images', valor)
+    return os.path.normpath(valor).replace(os.sep, '/')
+
+def generar_derivados(clave):
+    """Genera los derivados WebP/JPEG de una imagen y la registra en el manifiesto"""
+    with open(clave, 'rb') as archivo:
+        contenido = archivo.read()
+    huella = hashlib.sha1(contenido).hexdigest()[:12]
+    entrada = manifiesto_imagenes().get(clave)
+    if entrada and entrada['hash'] == huella and all(
+            os.path.exists(os.path.join(app.config['MEDIA_FOLDER'], nombre))
+            for variantes in entrada['variants'].values() for _, nombre in variantes):
+        return entrada
+
+    os.makedirs(app.config['MEDIA_FOLDER'], exist_ok=True)
+    with Image.open(io.BytesIO(contenido)) as imagen:
+        imagen = ImageOps.exif_transpose(imagen).convert('RGB')
+        ancho, alto = imagen.size
+        anchos = sorted({min(w, ancho) for w in app.config['IMAGE_WIDTHS']})
+        base = re.sub(r'[^A-Za-z0-9_-]+', '_', os.path.splitext(os.path.basename(clave))[0])[:40]
+
+        variantes = {formato: [] for formato in app.config['IMAGE_FORMATS']}
+        for w in anchos:
+            reducida = imagen if w == ancho else imagen.resize((w, max(1, round(alto * w / ancho))), Image.LANCZOS)
+            for formato in app.config['IMAGE_FORMATS']:
+                extension = 'jpg' if formato == 'jpeg' else formato
+                nombre = f"{base}-{huella}-{w}.{extension}"
+                destino = os.path.join(app.config['MEDIA_FOLDER'], nombre)
+                if not os.path.exists(destino):
+                    opciones = {'optimize': True, 'progressive': True} if formato == 'jpeg' else {'method': 6}
+                    reducida.save(destino + '.tmp', format=formato.upper(), quality=app.config['IMAGE_QUALITY'], **opciones)
+                    os.replace(destino + '.tmp', destino)
+                variantes[formato].append([w, nombre])
+
+    entrada = {'hash': huella, 'width': ancho, 'height': alto, 'bytes': len(contenido), 'variants': variantes}
+    _guardar_manifiesto(clave, entrada)
+    return entrada
+
+def imagen_responsiva(valor):
+    """src, srcset por formato y dimensiones de una imagen; el original si aún no tiene derivados"""
+    clave = clave_imagen(valor)
+    entrada = manifiesto_imagenes().get(clave) if clave else None
+    if not entrada:
+        src = valor if clave is None else '/' + clave
+        return {'src': src, 'srcset': {}}
+
+    srcset = {
+        formato: ', '.join(f"{url_for('media_file', filename=nombre)} {w}w" for w, nombre in variantes)
+        for formato, variantes in entrada['variants'].items()
+    }
+    respaldo = entrada['variants'].get('jpeg') or next(iter(entrada['variants'].values()))
+    return {
+        'src': url_for('media_file', filename=respaldo[-1][1]),
+        'srcset': srcset,
+        'width': entrada['width'],
+        'height': entrada['height']
+    }
+
+def imagenes_publicas(imagenes):
+    return [imagen_responsiva(valor) for valor in (imagenes or []) if isinstance(valor, str)]
+
+@app.context_processor
+def _utilidades_de_imagenes():
+    def imagen_estatica(nombre, ancho=None):
+        """URL del derivado JPEG de static/<nombre> con al menos `ancho` px (el original si no hay derivados)"""
+        entrada = manifiesto_imagenes().get(f"static/{nombre}")
+        if not entrada:
+            return url_for('static', filename=nombre)
+        variantes = entrada['variants']['jpeg']
+        elegido = next((n for w, n in variantes if ancho and w >= ancho), variantes[-1][1])
+        return url_for('media_file', filename=elegido)
+    return {'imagen_responsiva': imagen_responsiva, 'imagen_estatica': imagen_estatica}
+
+@app.route('/media/<path:filename>')
+def media_file(filename):
+    """Derivados de imágenes con nombre por contenido: caché de un año"""
+    respuesta = send_from_directory(app.config['MEDIA_FOLDER'], filename, max_age=365 * 24 * 3600)
+    respuesta.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return respuesta
+
+@app.route('/uploads/images/<path:filename>')
+def uploaded_image(filename):
+    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), filename)
+
+@app.route('/api/bases')
+def get_bases():
+    bases = Base.query.all()
+    return jsonify([{
+        'id': b.id,
+        'name': b.nombre,
+        'lat': float(b.latitud),
+        'lon': float(b.longitud),
+        'description': b.descripcion,
+        'color': b.color,
+        'images': imagenes_publicas(b.imagenes)
+    } for b in bases])
+
+@app.route('/api/admin/images', methods=['POST'])
+@token_required
+def upload_image(current_user):
+    """Sube una imagen, genera sus derivados y opcionalmente la agrega a una parada o base"""
+    archivo = request.files.get('file')
+    if not archivo or not archivo.filename:
+        return jsonify({'message': 'No se envió ningún archivo'}), 400
+    extension = archivo.filename.rsplit('.', 1)[-1].lower() if '.' in archivo.filename else ''
+    if extension not in app.config['IMAGE_EXTENSIONS']:
+        return jsonify({'message': 'Tipo de imagen no permitido (jpg, png o webp)'}), 400
+
+    entidad = request.form.get('entity')
+    destino = None
+    if entidad:
+        modelo = {'stop': Parada, 'base': Base}.get(entidad)
+        if modelo is None:
+            return jsonify({'message': 'entity debe ser stop o base'}), 400
+        destino = db.get_or_404(modelo, request.form.get('id', type=int))
+
+    carpeta = os.path.join(app.config['UPLOAD_FOLDER'], 'images')
+    os.makedirs(carpeta, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    ruta = os.path.join(carpeta, f"{timestamp}_{secure_filename(archivo.filename)}")
+    archivo.save(ruta)
+    clave = clave_imagen(ruta)
+    try:
+        generar_derivados(clave)
+    except (OSError, Image.DecompressionBombError) as e:
+        os.remove(ruta)
+        return jsonify({'message': f'No se pudo procesar la imagen: {str(e)}'}), 400
+
+    if destino is not None:
+        destino.imagenes = (destino.imagenes or []) + [clave]
+        if entidad == 'stop':
+            registrar_cambio('parada', destino.id, propagar=False)
+        db.session.commit()
+
+    return jsonify({'path': clave, 'image': imagen_responsiva(clave)}), 201
+
+@app.cli.command('build-images')
+def build_images_command():
+    """Genera los derivados de static/img y de las imágenes de paradas y bases"""
+    claves = [f"static/img/{nombre}" for nombre in sorted(os.listdir(os.path.join(app.static_folder, 'img')))
+              if nombre.rsplit('.', 1)[-1].lower() in app.config['IMAGE_EXTENSIONS']]
+    for modelo in (Parada, Base):
+        for (imagenes,) in db.session.query(modelo.imagenes).filter(modelo.imagenes.isnot(None)):
+            claves.extend(c for c in map(clave_imagen, (v for v in imagenes if isinstance(v, str))) if c)
+
+    originales = derivados = 0
+    for clave in dict.fromkeys(claves):
+        if not os.path.exists(clave):
+            click.echo(f"  falta: {clave}")
+            continue
+        entrada = generar_derivados(clave)
+        formato = 'webp' if 'webp' in entrada['variants'] else 'jpeg'
+        ancho, nombre = entrada['variants'][formato][-1]
+        tamano = os.path.getsize(os.path.join(app.config['MEDIA_FOLDER'], nombre))
+        originales += entrada['bytes']
+        derivados += tamano
+        click.echo(f"  {clave}: {entrada['bytes'] // 1024} KB -> {tamano // 1024} KB ({formato}, {ancho}px)")
+    if originales:
+        click.echo(f"Total: {originales // 1024} KB -> {derivados // 1024} KB en el ancho mayor")
+
+# --- API para Administradores ---
+
+@app.route('/api/login', methods=['POST'])
+def login():
+    auth = request.json
+    if not auth or not auth.get('username') or not auth.get('password'):
+        return jsonify({'message': 'No se pudo verificar'}), 401, {'WWW-Authenticate': 'Basic realm="Login required!"'}
+
+    user = User.query.filter_by(username=auth.get('username')).first()
+
+    if not user or not user.check_password(auth.get('password')):
+        return jsonify({'message': 'No se pudo verificar'}), 401, {'WWW-Authenticate': 'Basic realm="Login required!"'}
+
+    token = jwt.encode({
+        'user_id': user.id,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+    }, app.config['SECRET_KEY'], algorithm="HS256")
+
+    return jsonify({'token': token})
+
+class ErrorOperacion(Exception):
+    """Error de validación en una operación de escritura de la API de administración"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def _hora_o_none(valor):
+    return datetime.time.fromisoformat(valor) if valor else None
+
+def _agregar_coordenadas(ruta_id, coordenadas):
+    for i, coord in enumerate(coordenadas):
+        new_coord = RutaCoordenada(
+            ruta_id=ruta_id,
+            latitud=coord[0],
+            longitud=coord[1],
+            orden=i
+        )
+        db.session.add(new_coord)
+
+def _reemplazar_servicios(ruta, servicios):
+    """Sustituye las bandas de servicio de la ruta por las del JSON"""
+    if not isinstance(servicios, list):
+        raise ErrorOperacion('services debe ser una lista')
+    nuevos = []
+    for servicio in servicios:
+        try:
+            tipo = servicio['day_type']
+            inicio = datetime.time.fromisoformat(servicio['start'])
+            fin = datetime.time.fromisoformat(servicio['end'])
+            intervalo = int(servicio['headway_minutes'])
+        except (KeyError, TypeError, ValueError):
+            raise ErrorOperacion('Cada servicio requiere day_type, start, end y headway_minutes')
+        if tipo not in TIPOS_DE_DIA or intervalo <= 0:
+            raise ErrorOperacion(f"day_type debe ser {', '.join(TIPOS_DE_DIA)} y headway_minutes positivo")
+        nuevos.append(RutaServicio(tipo_dia=tipo, hora_inicio=inicio, hora_fin=fin, intervalo_minutos=intervalo))
+    ruta.servicios = nuevos
+
+def _serializar_servicios(ruta):
+    return [{
+        'day_type': s.tipo_dia,
+        'start': s.hora_inicio.isoformat(timespec='minutes'),
+        'end': s.hora_fin.isoformat(timespec='minutes'),
+        'headway_minutes': s.intervalo_minutos
+    } for s in ruta.servicios]
+
+def crear_ruta_desde_datos(data):
+    """Crea una ruta con su trazo a partir del JSON de la API (sin commit)"""
     if not data or not data.get('name') or not data.get('color'):
-        return jsonify({'message': 'Missing data'}), 400
+        raise ErrorOperacion('Missing data')
 
     new_route = Ruta(
         nombre=data['name'],
         color=data['color'],
         descripcion=data.get('description'),
         costo=data.get('cost'),
-        horario_inicio=datetime.time.fromisoformat(data['schedule_start']) if data.get('schedule_start') else None,
-        horario_fin=datetime.time.fromisoformat(data['schedule_end']) if data.get('schedule_end') else None,
+        horario_inicio=_hora_o_none(data.get('schedule_start')),
+        horario_fin=_hora_o_none(data.get('schedule_end')),
         activa=data.get('active', True)
     )
     db.session.add(new_route)
-    db.session.commit()
+    db.session.flush()
 
     if data.get('coordinates'):
-        for i, coord in enumerate(data['coordinates']):
-            new_coord = RutaCoordenada(
-                ruta_id=new_route.id,
-                latitud=coord[0],
-                longitud=coord[1],
-                orden=i
-            )
-            db.session.add(new_coord)
-    
+        _agregar_coordenadas(new_route.id, data['coordinates'])
+    if 'services' in data:
+        _reemplazar_servicios(new_route, data['services'])
+
+    registrar_cambio('ruta', new_route.id)
+    return new_route
+
+def actualizar_ruta_desde_datos(ruta, data):
+    """Aplica los campos presentes en el JSON a la ruta (sin commit)"""
+    if not isinstance(data, dict):
+        raise ErrorOperacion('Missing data')
+
+    ruta.nombre = data.get('name', ruta.nombre)
+    ruta.color = data.get('color', ruta.color)
+    ruta.descripcion = data.get('description', ruta.descripcion)
+    ruta.costo = data.get('cost', ruta.costo)
+    ruta.horario_inicio = _hora_o_none(data.get('schedule_start')) or ruta.horario_inicio
+    ruta.horario_fin = _hora_o_none(data.get('schedule_end')) or ruta.horario_fin
+    ruta.activa = data.get('active', ruta.activa)
+
+    if 'coordinates' in data:
+        # Delete old coordinates
+        RutaCoordenada.query.filter_by(ruta_id=ruta.id).delete()
+        # Add new coordinates
+        _agregar_coordenadas(ruta.id, data['coordinates'])
+    if 'services' in data:
+        _reemplazar_servicios(ruta, data['services'])
+
+    registrar_cambio('ruta', ruta.id)
+
+def crear_parada_desde_datos(data):
+    """Crea una parada a partir del JSON de la API (sin commit)"""
+    if not data or not data.get('name') or not data.get('lat') or not data.get('lon'):
+        raise ErrorOperacion('Missing data')
+
+    new_stop = Parada(
+        nombre=data['name'],
+        latitud=data['lat'],
+        longitud=data['lon'],
+        descripcion=data.get('description'),
+        tipo=data.get('type', 'secundaria')
+    )
+    db.session.add(new_stop)
+    db.session.flush()
+    registrar_cambio('parada', new_stop.id, propagar=False)
+    return new_stop
+
+def actualizar_parada_desde_datos(stop, data):
+    """Aplica los campos presentes en el JSON a la parada (sin commit)"""
+    if not isinstance(data, dict):
+        raise ErrorOperacion('Missing data')
+
+    stop.nombre = data.get('name', stop.nombre)
+    stop.latitud = data.get('lat', stop.latitud)
+    stop.longitud = data.get('lon', stop.longitud)
+    stop.descripcion = data.get('description', stop.descripcion)
+    stop.tipo = data.get('type', stop.tipo)
+
+    registrar_cambio('parada', stop.id)
+
+@app.route('/api/admin/routes', methods=['POST'])
+@token_required
+def create_route(current_user):
+    try:
+        new_route = crear_ruta_desde_datos(request.get_json())
+    except ErrorOperacion as e:
+        db.session.rollback()
+        return jsonify({'message': e.message}), e.status
     db.session.commit()
 
     return jsonify({'message': 'New route created!', 'id': new_route.id}), 201
@@ -271,6 +3834,19 @@ def create_route(current_user):
 @app.route('/api/admin/routes', methods=['GET'])
 @token_required
 def get_admin_routes(current_user):
+    formato = _formato_streaming()
+    if formato is False:
+        return jsonify({'message': 'Formato de streaming no soportado (ndjson o geojson)'}), 400
+    if formato:
+        # El listado de administración no lleva trazo; en GeoJSON va sin geometría
+        lotes = ([{'id': r.id, 'name': r.nombre, 'color': r.color, 'active': r.activa} for r in filas]
+                 for filas in _lotes_de_filas((Ruta.id, Ruta.nombre, Ruta.color, Ruta.activa), Ruta.id))
+        return _respuesta_streaming(lotes, formato, lambda r: {
+            'type': 'Feature', 'id': r['id'], 'geometry': None, 'properties': r
+        })
+    if 'limit' in request.args or 'after' in request.args:
+        return pagina_de_rutas()
+
     rutas = Ruta.query.all()
     rutas_data = []
     for ruta in rutas:
@@ -282,6 +3858,80 @@ def get_admin_routes(current_user):
         })
     return jsonify(rutas_data)
 
+# Listados paginados del editor (ver_rutas y editar_ruta). Paginación por
+# llave: cada página trae el cursor del último elemento y la siguiente
+# empieza después de él, así el costo no crece con la página como OFFSET.
+
+app.config['ADMIN_PAGE_SIZE'] = 100           # elementos por página si no se pide ?limit=
+app.config['ADMIN_PAGE_MAX'] = 1000
+
+def _limite_pagina():
+    limite = request.args.get('limit', app.config['ADMIN_PAGE_SIZE'], type=int)
+    return max(1, min(limite, app.config['ADMIN_PAGE_MAX']))
+
+def pagina_de_rutas():
+    """Rutas por id con sus contadores (sin cargar trazos ni paradas); ?after=<id>&limit="""
+    try:
+        despues = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({'message': 'Cursor inválido'}), 400
+    limite = _limite_pagina()
+    filas = db.session.execute(db.select(
+        Ruta.id, Ruta.nombre, Ruta.color, Ruta.activa, Ruta.costo, Ruta.horario_inicio, Ruta.horario_fin,
+        Ruta.num_coordenadas, Ruta.num_paradas
+    ).where(Ruta.id > despues).order_by(Ruta.id).limit(limite + 1)).all()
+
+    siguiente = filas[limite - 1].id if len(filas) > limite else None
+    return jsonify({
+        'routes': [{
+            'id': r.id,
+            'name': r.nombre,
+            'color': r.color,
+            'active': r.activa,
+            'cost': float(r.costo) if r.costo else None,
+            'schedule': f"{r.horario_inicio.strftime('%H:%M')} - {r.horario_fin.strftime('%H:%M')}" if r.horario_inicio and r.horario_fin else None,
+            'points': r.num_coordenadas,
+            'stops': r.num_paradas
+        } for r in filas[:limite]],
+        'next': siguiente
+    })
+
+@app.route('/api/admin/routes/<int:route_id>/points', methods=['GET'])
+@token_required
+def get_admin_route_points(current_user, route_id):
+    """
+    Puntos del trazado en orden, por páginas. ?after=<orden>:<id> sigue
+    después del último punto recibido y ?bbox=oeste,sur,este,norte deja solo
+    los visibles en el mapa.
+    """
+    ruta = Ruta.query.get_or_404(route_id)
+    consulta = db.select(RutaCoordenada.id, RutaCoordenada.orden, RutaCoordenada.latitud, RutaCoordenada.longitud)\
+        .where(RutaCoordenada.ruta_id == route_id)\
+        .order_by(RutaCoordenada.orden, RutaCoordenada.id)
+    try:
+        if request.args.get('after'):
+            orden, punto_id = (int(v) for v in request.args['after'].split(':'))
+            consulta = consulta.where(db.or_(
+                RutaCoordenada.orden > orden,
+                db.and_(RutaCoordenada.orden == orden, RutaCoordenada.id > punto_id)))
+        if request.args.get('bbox'):
+            oeste, sur, este, norte = (float(v) for v in request.args['bbox'].split(','))
+            consulta = consulta.where(RutaCoordenada.latitud.between(sur, norte),
+                                      RutaCoordenada.longitud.between(oeste, este))
+    except ValueError:
+        return jsonify({'message': 'Se espera after=<orden>:<id> y bbox=oeste,sur,este,norte'}), 400
+
+    limite = _limite_pagina()
+    filas = db.session.execute(consulta.limit(limite + 1)).all()
+    siguiente = f"{filas[limite - 1].orden}:{filas[limite - 1].id}" if len(filas) > limite else None
+    return jsonify({
+        'route_id': ruta.id,
+        'total': ruta.num_coordenadas,
+        'points': [{'id': f.id, 'order': f.orden, 'lat': float(f.latitud), 'lon': float(f.longitud)}
+                   for f in filas[:limite]],
+        'next': siguiente
+    })
+
 @app.route('/api/admin/routes/<int:route_id>', methods=['GET'])
 @token_required
 def get_admin_route(current_user, route_id):
@@ -303,6 +3953,7 @@ def get_admin_route(current_user, route_id):
         'schedule_end': ruta.horario_fin.isoformat() if ruta.horario_fin else None,
         'description': ruta.descripcion,
         'active': ruta.activa,
+        'services': _serializar_servicios(ruta),
         'coordinates': coordenadas,
         'stops': paradas
     }
@@ -312,29 +3963,11 @@ def get_admin_route(current_user, route_id):
 @token_required
 def update_route(current_user, route_id):
     ruta = Ruta.query.get_or_404(route_id)
-    data = request.get_json()
-
-    ruta.nombre = data.get('name', ruta.nombre)
-    ruta.color = data.get('color', ruta.color)
-    ruta.descripcion = data.get('description', ruta.descripcion)
-    ruta.costo = data.get('cost', ruta.costo)
-    ruta.horario_inicio = datetime.time.fromisoformat(data['schedule_start']) if data.get('schedule_start') else ruta.horario_inicio
-    ruta.horario_fin = datetime.time.fromisoformat(data['schedule_end']) if data.get('schedule_end') else ruta.horario_fin
-    ruta.activa = data.get('active', ruta.activa)
-
-    if 'coordinates' in data:
-        # Delete old coordinates
-        RutaCoordenada.query.filter_by(ruta_id=ruta.id).delete()
-        # Add new coordinates
-        for i, coord in enumerate(data['coordinates']):
-            new_coord = RutaCoordenada(
-                ruta_id=ruta.id,
-                latitud=coord[0],
-                longitud=coord[1],
-                orden=i
-            )
-            db.session.add(new_coord)
-
+    try:
+        actualizar_ruta_desde_datos(ruta, request.get_json())
+    except ErrorOperacion as e:
+        db.session.rollback()
+        return jsonify({'message': e.message}), e.status
     db.session.commit()
     return jsonify({'message': 'Route updated!'})
 
@@ -342,6 +3975,7 @@ def update_route(current_user, route_id):
 @token_required
 def delete_route(current_user, route_id):
     ruta = Ruta.query.get_or_404(route_id)
+    registrar_cambio('ruta', ruta.id, 'delete')
     db.session.delete(ruta)
     db.session.commit()
     return jsonify({'message': 'Route deleted!'})
@@ -349,18 +3983,11 @@ def delete_route(current_user, route_id):
 @app.route('/api/admin/stops', methods=['POST'])
 @token_required
 def create_stop(current_user):
-    data = request.get_json()
-    if not data or not data.get('name') or not data.get('lat') or not data.get('lon'):
-        return jsonify({'message': 'Missing data'}), 400
-
-    new_stop = Parada(
-        nombre=data['name'],
-        latitud=data['lat'],
-        longitud=data['lon'],
-        descripcion=data.get('description'),
-        tipo=data.get('type', 'secundaria')
-    )
-    db.session.add(new_stop)
+    try:
+        new_stop = crear_parada_desde_datos(request.get_json())
+    except ErrorOperacion as e:
+        db.session.rollback()
+        return jsonify({'message': e.message}), e.status
     db.session.commit()
 
     return jsonify({'message': 'New stop created!', 'id': new_stop.id}), 201
@@ -369,14 +3996,11 @@ def create_stop(current_user):
 @token_required
 def update_stop(current_user, stop_id):
     stop = Parada.query.get_or_404(stop_id)
-    data = request.get_json()
-
-    stop.nombre = data.get('name', stop.nombre)
-    stop.latitud = data.get('lat', stop.latitud)
-    stop.longitud = data.get('lon', stop.longitud)
-    stop.descripcion = data.get('description', stop.descripcion)
-    stop.tipo = data.get('type', stop.tipo)
-
+    try:
+        actualizar_parada_desde_datos(stop, request.get_json())
+    except ErrorOperacion as e:
+        db.session.rollback()
+        return jsonify({'message': e.message}), e.status
     db.session.commit()
     return jsonify({'message': 'Stop updated!'})
 
@@ -384,6 +4008,7 @@ def update_stop(current_user, stop_id):
 @token_required
 def delete_stop(current_user, stop_id):
     stop = Parada.query.get_or_404(stop_id)
+    registrar_cambio('parada', stop.id, 'delete')
     db.session.delete(stop)
     db.session.commit()
     return jsonify({'message': 'Stop deleted!'})
@@ -404,7 +4029,13 @@ def add_stop_to_route(current_user, route_id):
         orden=data['order']
     )
     db.session.add(route_stop)
-    db.session.commit()
+    registrar_cambio('ruta', route.id)
+    try:
+        db.session.commit()
+    except exc.IntegrityError:
+        # uq_ruta_paradas_ruta_parada: la parada ya está asociada a la ruta
+        db.session.rollback()
+        return jsonify({'message': 'La parada ya pertenece a la ruta'}), 409
 
     return jsonify({'message': 'Stop added to route!'})
 
@@ -413,9 +4044,355 @@ def add_stop_to_route(current_user, route_id):
 def remove_stop_from_route(current_user, route_id, stop_id):
     route_stop = RutaParada.query.filter_by(ruta_id=route_id, parada_id=stop_id).first_or_404()
     db.session.delete(route_stop)
+    registrar_cambio('ruta', route_id)
     db.session.commit()
     return jsonify({'message': 'Stop removed from route!'})
 
+# --- Contadores de Rutas ---
+
+# Cada ruta guarda cuántas coordenadas y paradas tiene y la longitud de su
+# trazo. Se recalculan al confirmar la transacción para las rutas que quedaron
+# en el registro de cambios, así el resumen del panel y el listado del
+# importador leen una fila por ruta en lugar de contar con JOINs.
+
+app.config['ROUTE_COUNTERS_BATCH'] = 500
+
+def recalcular_contadores_rutas(ids=None):
+    """Recalcula num_coordenadas, num_paradas y longitud_m (todas las rutas si ids es None)"""
+    if ids is None:
+        ids = db.session.scalars(db.select(Ruta.id)).all()
+    ids = sorted(ids)
+    tabla = Ruta.__table__
+    actualizar = db.update(tabla).where(tabla.c.id == db.bindparam('_id')).values(
+        num_coordenadas=db.bindparam('_coordenadas'),
+        num_paradas=db.bindparam('_paradas'),
+        longitud_m=db.bindparam('_longitud')
+    )
+    tamano = app.config['ROUTE_COUNTERS_BATCH']
+    for inicio in range(0, len(ids), tamano):
+        lote = ids[inicio:inicio + tamano]
+        contadores = {i: {'_id': i, '_coordenadas': 0, '_paradas': 0, '_longitud': 0.0} for i in lote}
+
+        anterior = None
+        for ruta_id, lat, lon in db.session.execute(
+                db.select(RutaCoordenada.ruta_id, RutaCoordenada.latitud, RutaCoordenada.longitud)
+                .where(RutaCoordenada.ruta_id.in_(lote))
+                .order_by(RutaCoordenada.ruta_id, RutaCoordenada.orden)):
+            lat, lon = float(lat), float(lon)
+            fila = contadores[ruta_id]
+            if fila['_coordenadas']:
+                fila['_longitud'] += distancia_haversine(anterior[0], anterior[1], lat, lon)
+            fila['_coordenadas'] += 1
+            anterior = (lat, lon)
+
+        for ruta_id, total in db.session.execute(
+                db.select(RutaParada.ruta_id, db.func.count())
+                .where(RutaParada.ruta_id.in_(lote)).group_by(RutaParada.ruta_id)):
+            contadores[ruta_id]['_paradas'] = total
+
+        for fila in contadores.values():
+            fila['_longitud'] = round(fila['_longitud'], 1)
+        db.session.execute(actualizar, list(contadores.values()))
+    return len(ids)
+
+@event.listens_for(db.session, 'before_commit')
+def _actualizar_contadores_rutas(session):
+    cambios = session.info.get('cambios_red') or ()
+    borradas = {i for entidad, i, operacion in cambios if entidad == 'ruta' and operacion == 'delete'}
+    rutas = {i for entidad, i, operacion in cambios if entidad == 'ruta' and operacion == 'upsert'} - borradas
+    if rutas:
+        session.flush()
+        recalcular_contadores_rutas(rutas)
+
+@app.cli.command('recalcular-contadores')
+def recalcular_contadores_command():
+    """Recalcula los contadores de todas las rutas (las columnas las agrega `flask migrar`)"""
+    total = recalcular_contadores_rutas()
+    db.session.commit()
+    click.echo(f'Contadores recalculados para {total} rutas')
+
+@app.route('/api/admin/summary', methods=['GET'])
+@token_required
+def admin_summary(current_user):
+    """Estadísticas del panel a partir de los contadores, sin JOINs"""
+    rutas = db.session.execute(
+        db.select(Ruta.id, Ruta.nombre, Ruta.activa, Ruta.num_coordenadas, Ruta.num_paradas, Ruta.longitud_m)
+        .order_by(Ruta.id)).all()
+    total_paradas = db.session.scalar(db.select(db.func.count(Parada.id)))
+
+    return jsonify({
+        'version': version_red(),
+        'routes': {
+            'total': len(rutas),
+            'active': sum(1 for r in rutas if r.activa),
+            'without_stops': sum(1 for r in rutas if not r.num_paradas),
+            'coordinates': sum(r.num_coordenadas for r in rutas),
+            'stop_links': sum(r.num_paradas for r in rutas),
+            'length_km': round(sum(r.longitud_m for r in rutas) / 1000, 2)
+        },
+        'stops': {'total': total_paradas},
+        'per_route': [{
+            'id': r.id,
+            'name': r.nombre,
+            'active': r.activa,
+            'coordinates': r.num_coordenadas,
+            'stops': r.num_paradas,
+            'length_m': r.longitud_m
+        } for r in rutas]
+    })
+
+# --- Lote de Operaciones de Administración ---
+
+app.config['BATCH_MAX_OPERATIONS'] = 500
+
+def _resolver_id(valor, referencias):
+    """Acepta un ID numérico o '$ref' de una entidad creada antes en el mismo lote"""
+    if isinstance(valor, str) and valor.startswith('$'):
+        if valor[1:] not in referencias:
+            raise ErrorOperacion(f"Referencia desconocida: {valor}")
+        return referencias[valor[1:]]
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ErrorOperacion(f"ID inválido: {valor!r}")
+
+def _obtener_o_error(modelo, entidad_id):
+    instancia = db.session.get(modelo, entidad_id)
+    if instancia is None:
+        raise ErrorOperacion(f"{modelo.__name__} {entidad_id} no existe", 404)
+    return instancia
+
+def _ejecutar_operacion(operacion, referencias):
+    """Ejecuta una operación del lote dentro de la transacción actual"""
+    op = operacion.get('op')
+    entidad = operacion.get('entity')
+    data = operacion.get('data') or {}
+
+    if entidad == 'route':
+        if op == 'create':
+            ruta = crear_ruta_desde_datos(data)
+            return {'id': ruta.id}
+        ruta = _obtener_o_error(Ruta, _resolver_id(operacion.get('id'), referencias))
+        if op == 'update':
+            actualizar_ruta_desde_datos(ruta, data)
+        elif op == 'delete':
+            registrar_cambio('ruta', ruta.id, 'delete')
+            db.session.delete(ruta)
+        else:
+            raise ErrorOperacion(f"Operación no soportada: {op}")
+        return {'id': ruta.id}
+
+    if entidad == 'stop':
+        if op == 'create':
+            parada = crear_parada_desde_datos(data)
+            return {'id': parada.id}
+        parada = _obtener_o_error(Parada, _resolver_id(operacion.get('id'), referencias))
+        if op == 'update':
+            actualizar_parada_desde_datos(parada, data)
+        elif op == 'delete':
+            registrar_cambio('parada', parada.id, 'delete')
+            db.session.delete(parada)
+        else:
+            raise ErrorOperacion(f"Operación no soportada: {op}")
+        return {'id': parada.id}
+
+    if entidad == 'route_stop':
+        ruta_id = _resolver_id(data.get('route_id'), referencias)
+        parada_id = _resolver_id(data.get('stop_id'), referencias)
+        relacion = RutaParada.query.filter_by(ruta_id=ruta_id, parada_id=parada_id).first()
+        if op == 'create':
+            if data.get('order') is None:
+                raise ErrorOperacion('Missing data')
+            if relacion is not None:
+                raise ErrorOperacion(f"La parada {parada_id} ya pertenece a la ruta {ruta_id}", 409)
+            _obtener_o_error(Ruta, ruta_id)
+            _obtener_o_error(Parada, parada_id)
+            relacion = RutaParada(ruta_id=ruta_id, parada_id=parada_id, orden=data['order'])
+            db.session.add(relacion)
+        elif relacion is None:
+            raise ErrorOperacion(f"La parada {parada_id} no pertenece a la ruta {ruta_id}", 404)
+        elif op == 'update':
+            if data.get('order') is None:
+                raise ErrorOperacion('Missing data')
+            relacion.orden = data['order']
+        elif op == 'delete':
+            db.session.delete(relacion)
+        else:
+            raise ErrorOperacion(f"Operación no soportada: {op}")
+        registrar_cambio('ruta', ruta_id)
+        return {'route_id': ruta_id, 'stop_id': parada_id}
+
+    raise ErrorOperacion(f"Entidad no soportada: {entidad}")
+
+@app.route('/api/admin/batch', methods=['POST'])
+@token_required
+def admin_batch(current_user):
+    """
+    Ejecuta una lista ordenada de operaciones sobre rutas, paradas y sus
+    asociaciones en una sola transacción. Si alguna falla se revierte todo.
+
+    {"operations": [{"op": "create|update|delete", "entity": "route|stop|route_stop",
+                     "id": 3, "data": {...}, "ref": "nueva"}, ...]}
+
+    Las entidades creadas con "ref" pueden usarse después como "$nueva".
+    """
+    data = request.get_json(silent=True)
+    operaciones = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operaciones, list) or not operaciones:
+        return jsonify({'message': 'Missing data'}), 400
+    if len(operaciones) > app.config['BATCH_MAX_OPERATIONS']:
+        return jsonify({'message': f"Máximo {app.config['BATCH_MAX_OPERATIONS']} operaciones por lote"}), 413
+
+    referencias = {}
+    resultados = []
+    for indice, operacion in enumerate(operaciones):
+        try:
+            if not isinstance(operacion, dict):
+                raise ErrorOperacion('Operación inválida')
+            resultado = _ejecutar_operacion(operacion, referencias)
+            # flush por operación para reportar errores de integridad en la operación correcta
+            db.session.flush()
+        except ErrorOperacion as e:
+            error, status = e.message, e.status
+        except (ValueError, TypeError, KeyError, IndexError) as e:
+            error, status = f"Datos inválidos: {e}", 400
+        except exc.IntegrityError as e:
+            error, status = f"Conflicto de integridad: {e.orig}", 409
+        else:
+            if operacion.get('ref') and 'id' in resultado:
+                referencias[str(operacion['ref'])] = resultado['id']
+            resultados.append({'index': indice, 'status': 'ok', **resultado})
+            continue
+
+        db.session.rollback()
+        resultados.append({'index': indice, 'status': 'error', 'error': error})
+        return jsonify({
+            'message': 'Lote revertido, ninguna operación se aplicó',
+            'failed_index': indice,
+            'results': resultados
+        }), status
+
+    db.session.commit()
+    return jsonify({'message': 'Lote aplicado', 'results': resultados})
+
+# --- Detección de Rutas Duplicadas ---
+
+app.config['DUPLICATE_ROUTE_SAMPLES'] = 128      # puntos por trazo remuestreado
+app.config['DUPLICATE_ROUTE_TOLERANCE_M'] = 60   # distancia de Hausdorff máxima para considerar duplicado
+
+def remuestrear_trazo(lats, lons, muestras):
+    """Trazo en metros (x, y) con `muestras` puntos equidistantes a lo largo del recorrido"""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    xs = lons * np.cos(np.radians(lats)) * METROS_POR_GRADO
+    ys = lats * METROS_POR_GRADO
+    acumulado = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(xs), np.diff(ys)))))
+    objetivo = np.linspace(0.0, acumulado[-1], muestras)
+    return np.column_stack((np.interp(objetivo, acumulado, xs), np.interp(objetivo, acumulado, ys)))
+
+def comparar_trazos(a, b):
+    """
+    Regresa (hausdorff, media_mismo_sentido, media_sentido_contrario) en metros.
+    Las medias comparan punto a punto los trazos remuestreados, lo que
+    distingue un duplicado de su recorrido de regreso.
+    """
+    distancias = np.hypot(a[:, None, 0] - b[None, :, 0], a[:, None, 1] - b[None, :, 1])
+    hausdorff = max(distancias.min(axis=1).max(), distancias.min(axis=0).max())
+    diagonal = np.arange(len(a))
+    return (float(hausdorff),
+            float(distancias[diagonal, diagonal].mean()),
+            float(distancias[diagonal, diagonal[::-1]].mean()))
+
+class DetectorDuplicados:
+    """Firmas (caja y trazo remuestreado) de las rutas para compararlas contra un trazo nuevo"""
+
+    def __init__(self, tolerancia=None, muestras=None):
+        self.tolerancia = tolerancia or app.config['DUPLICATE_ROUTE_TOLERANCE_M']
+        self.muestras = muestras or app.config['DUPLICATE_ROUTE_SAMPLES']
+        self.firmas = []
+
+    @classmethod
+    def desde_base_de_datos(cls, **kwargs):
+        detector = cls(**kwargs)
+        nombres = dict(db.session.query(Ruta.id, Ruta.nombre).all())
+        consulta = db.select(RutaCoordenada.ruta_id, RutaCoordenada.latitud, RutaCoordenada.longitud)\
+            .order_by(RutaCoordenada.ruta_id, RutaCoordenada.orden)
+        actual, lats, lons = None, [], []
+        for ruta_id, lat, lon in _filas_en_lotes(consulta):
+            if ruta_id != actual:
+                if actual is not None:
+                    detector.agregar(actual, nombres.get(actual), lats, lons)
+                actual, lats, lons = ruta_id, [], []
+            lats.append(float(lat))
+            lons.append(float(lon))
+        if actual is not None:
+            detector.agregar(actual, nombres.get(actual), lats, lons)
+        return detector
+
+    def agregar(self, ruta_id, nombre, lats, lons):
+        if len(lats) < 2:
+            return
+        trazo = remuestrear_trazo(lats, lons, self.muestras)
+        self.firmas.append((ruta_id, nombre, trazo.min(axis=0) - self.tolerancia,
+                            trazo.max(axis=0) + self.tolerancia, trazo))
+
+    def _coincidencias(self, trazo, firmas):
+        minimo, maximo = trazo.min(axis=0), trazo.max(axis=0)
+        for ruta_id, nombre, caja_min, caja_max, otro in firmas:
+            if (minimo > caja_max).any() or (maximo < caja_min).any():
+                continue
+            hausdorff, directa, inversa = comparar_trazos(trazo, otro)
+            if hausdorff <= self.tolerancia:
+                yield {
+                    'route_id': ruta_id,
+                    'name': nombre,
+                    'kind': 'duplicate' if directa <= inversa else 'reverse',
+                    'hausdorff_m': round(hausdorff, 1),
+                    'mean_m': round(min(directa, inversa), 1)
+                }
+
+    def buscar(self, lats, lons):
+        """Rutas existentes que coinciden con el trazo, duplicados primero"""
+        if len(lats) < 2:
+            return []
+        coincidencias = list(self._coincidencias(remuestrear_trazo(lats, lons, self.muestras), self.firmas))
+        coincidencias.sort(key=lambda c: (c['kind'] != 'duplicate', c['hausdorff_m']))
+        return coincidencias
+
+    def pares(self):
+        """Todos los pares de rutas duplicadas o de ida/regreso entre las firmas cargadas"""
+        resultado = {'duplicates': [], 'reverse_pairs': []}
+        for i, (ruta_id, nombre, _, _, trazo) in enumerate(self.firmas):
+            for coincidencia in self._coincidencias(trazo, self.firmas[i + 1:]):
+                par = {
+                    'route_id': ruta_id,
+                    'name': nombre,
+                    'other_id': coincidencia['route_id'],
+                    'other_name': coincidencia['name'],
+                    'hausdorff_m': coincidencia['hausdorff_m'],
+                    'mean_m': coincidencia['mean_m']
+                }
+                clave = 'duplicates' if coincidencia['kind'] == 'duplicate' else 'reverse_pairs'
+                resultado[clave].append(par)
+        return resultado
+
+@app.route('/api/admin/routes/duplicates', methods=['GET'])
+@token_required
+def find_duplicate_routes(current_user):
+    """Pares de rutas con trazos casi idénticos (duplicados) o inversos (ida/regreso)"""
+    try:
+        tolerancia = float(request.args.get('tolerance_m', app.config['DUPLICATE_ROUTE_TOLERANCE_M']))
+    except ValueError:
+        return jsonify({'message': 'tolerance_m debe ser numérico'}), 400
+    if not 0 < tolerancia <= 1000:
+        return jsonify({'message': 'tolerance_m debe estar entre 0 y 1000'}), 400
+
+    detector = DetectorDuplicados.desde_base_de_datos(tolerancia=tolerancia)
+    resultado = detector.pares()
+    resultado['routes_compared'] = len(detector.firmas)
+    resultado['tolerance_m'] = tolerancia
+    return jsonify(resultado)
+
 # --- Funciones Auxiliares para KML ---
 
 def allowed_file(filename):
@@ -565,13 +4542,20 @@ def extract_placemarks_from_kml(kml_file_path):
         print(f"Error al parsear KML: {e}")
         return []
 
-def process_kml_data(placemarks):
-    """Procesa los placemarks y los guarda en la base de datos"""
+def process_kml_data(placemarks, allow_duplicates=False):
+    """
+    Procesa los placemarks y los guarda en la base de datos.
+    Las rutas cuyo trazo duplica a una existente se omiten salvo que
+    allow_duplicates sea verdadero; los recorridos inversos (ida/regreso)
+    se importan y se reportan.
+    """
     results = {
         'routes_imported': 0,
         'stops_imported': 0,
         'routes': [],
         'stops': [],
+        'duplicates_skipped': [],
+        'reverse_pairs': [],
         'errors': []
     }
     
@@ -579,10 +4563,22 @@ def process_kml_data(placemarks):
         # Separar rutas y paradas
         routes = [p for p in placemarks if p['type'] == 'LineString']
         stops = [p for p in placemarks if p['type'] == 'Point']
+        detector = DetectorDuplicados.desde_base_de_datos() if routes else None
         
         # Primero importar rutas
         route_id_map = {}
         for placemark in routes:
+            lats = [c[0] for c in placemark['coordinates']]
+            lons = [c[1] for c in placemark['coordinates']]
+            coincidencias = detector.buscar(lats, lons)
+            duplicado = next((c for c in coincidencias if c['kind'] == 'duplicate'), None)
+            if duplicado and not allow_duplicates:
+                results['duplicates_skipped'].append({'name': placemark['name'], 'duplicate_of': duplicado})
+                results['errors'].append(
+                    f"Ruta '{placemark['name']}' omitida: duplica a '{duplicado['name']}' "
+                    f"(ID: {duplicado['route_id']}, {duplicado['hausdorff_m']} m)")
+                continue
+            
             try:
                 new_route = Ruta(
                     nombre=placemark['name'],
@@ -607,7 +4603,12 @@ def process_kml_data(placemarks):
                     )
                     db.session.add(new_coord)
                 
+                registrar_cambio('ruta', new_route.id)
                 db.session.commit()
+                detector.agregar(new_route.id, new_route.nombre, lats, lons)
+                for coincidencia in coincidencias:
+                    if coincidencia['kind'] == 'reverse':
+                        results['reverse_pairs'].append({'route_id': new_route.id, 'reverse_of': coincidencia})
                 results['routes_imported'] += 1
                 results['routes'].append({
                     'id': new_route.id,
@@ -648,6 +4649,7 @@ def process_kml_data(placemarks):
                     )
                     db.session.add(new_stop)
                     db.session.flush()
+                    registrar_cambio('parada', new_stop.id, propagar=False)
                     
                     stop_id_map[placemark['name']] = new_stop.id
                     results['stops_imported'] += 1
@@ -671,6 +4673,7 @@ def process_kml_data(placemarks):
                             orden=orden
                         )
                         db.session.add(ruta_parada)
+                        registrar_cambio('ruta', route_id)
                 
                 db.session.commit()
                 
@@ -705,6 +4708,7 @@ def import_kml(current_user):
         filename = secure_filename(file.filename)
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{timestamp}_{filename}"
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
@@ -716,7 +4720,8 @@ def import_kml(current_user):
             return jsonify({'message': 'No se encontraron elementos válidos en el archivo KML'}), 400
         
         # Procesar datos
-        results = process_kml_data(placemarks)
+        allow_duplicates = request.form.get('allow_duplicates', '').lower() in ('1', 'true', 'yes')
+        results = process_kml_data(placemarks, allow_duplicates=allow_duplicates)
         
         # Opcional: eliminar archivo después de procesar
         # os.remove(filepath)
@@ -727,12 +4732,320 @@ def import_kml(current_user):
             'stops_imported': results['stops_imported'],
             'routes': results['routes'],
             'stops': results['stops'],
+            'duplicates_skipped': results['duplicates_skipped'],
+            'reverse_pairs': results['reverse_pairs'],
             'errors': results['errors']
         }), 200
     
     except Exception as e:
         return jsonify({'message': f'Error al procesar el archivo: {str(e)}'}), 500
 
+# --- Importación GTFS ---
+
+app.config['GTFS_IMPORT_BATCH'] = 5000
+ARCHIVOS_GTFS_REQUERIDOS = ('stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt')
+ARCHIVOS_GTFS_OPCIONALES = ('shapes.txt', 'frequencies.txt')
+
+def _buscar_en_zip(zf, nombre):
+    """Algunos feeds vienen dentro de una carpeta; busca por nombre base"""
+    for ruta in zf.namelist():
+        if ruta.rsplit('/', 1)[-1] == nombre:
+            return ruta
+    return None
+
+def _leer_csv_gtfs(zf, nombre):
+    """Itera las filas de un archivo del feed directamente desde el zip (sin extraerlo)"""
+    with zf.open(nombre) as crudo:
+        texto = io.TextIOWrapper(crudo, encoding='utf-8-sig', newline='')
+        for fila in csv.DictReader(texto):
+            yield {k.strip(): (v or '').strip() for k, v in fila.items() if k}
+
+def _segundos_gtfs(valor):
+    """'25:10:00' -> segundos desde la medianoche del día de servicio"""
+    h, m, seg = (int(x) for x in valor.split(':'))
+    return h * 3600 + m * 60 + seg
+
+def _time_desde_segundos(segundos):
+    segundos %= 24 * 3600
+    return datetime.time(segundos // 3600, segundos % 3600 // 60, segundos % 60)
+
+def planear_importacion_gtfs(zf):
+    """
+    Lee el feed y arma el plan de importación sin tocar la base de datos.
+    Cada combinación ruta + sentido se vuelve una Ruta, usando como trazo y
+    secuencia de paradas el viaje con más paradas.
+    """
+    archivos = {n: _buscar_en_zip(zf, n) for n in ARCHIVOS_GTFS_REQUERIDOS + ARCHIVOS_GTFS_OPCIONALES}
+    faltantes = [n for n in ARCHIVOS_GTFS_REQUERIDOS if not archivos[n]]
+    if faltantes:
+        raise ValueError(f"El feed GTFS no contiene: {', '.join(faltantes)}")
+
+    avisos = []
+
+    paradas = {}
+    for fila in _leer_csv_gtfs(zf, archivos['stops.txt']):
+        if fila.get('location_type', '') not in ('', '0'):
+            continue  # estaciones, accesos, etc.
+        try:
+            paradas[fila['stop_id']] = {
+                'nombre': (fila.get('stop_name') or fila['stop_id'])[:100],
+                'lat': float(fila['stop_lat']),
+                'lon': float(fila['stop_lon']),
+                'descripcion': fila.get('stop_desc') or None
+            }
+        except (KeyError, ValueError):
+            avisos.append(f"Parada inválida: {fila.get('stop_id')}")
+
+    rutas = {}
+    for fila in _leer_csv_gtfs(zf, archivos['routes.txt']):
+        corto, largo = fila.get('route_short_name'), fila.get('route_long_name')
+        nombre = largo or corto or fila.get('route_id')
+        # El exportador escribe el nombre en ambas columnas; solo se antepone un número que el largo no trae
+        if corto and largo and not largo.startswith(corto):
+            nombre = f"{corto} {largo}"
+        color = fila.get('route_color', '')
+        rutas[fila.get('route_id', '')] = {
+            'nombre': nombre,
+            'color': f"#{color.upper()}" if re.fullmatch(r'[0-9A-Fa-f]{6}', color) else '#FF0000',
+            'descripcion': fila.get('route_desc') or None
+        }
+
+    viajes = {}
+    for fila in _leer_csv_gtfs(zf, archivos['trips.txt']):
+        if fila.get('route_id') in rutas:
+            viajes[fila['trip_id']] = (fila['route_id'], fila.get('direction_id', ''), fila.get('shape_id', ''))
+
+    # Primera pasada por stop_times: paradas por viaje y horario de cada ruta/sentido
+    conteos = {}
+    horarios = {}
+    for fila in _leer_csv_gtfs(zf, archivos['stop_times.txt']):
+        viaje = viajes.get(fila.get('trip_id'))
+        if viaje is None:
+            continue
+        conteos[fila['trip_id']] = conteos.get(fila['trip_id'], 0) + 1
+        hora = fila.get('departure_time') or fila.get('arrival_time')
+        if hora:
+            try:
+                segundos = _segundos_gtfs(hora)
+            except ValueError:
+                continue
+            clave = viaje[:2]
+            minimo, maximo = horarios.get(clave, (segundos, segundos))
+            horarios[clave] = (min(minimo, segundos), max(maximo, segundos))
+
+    if archivos['frequencies.txt']:
+        for fila in _leer_csv_gtfs(zf, archivos['frequencies.txt']):
+            viaje = viajes.get(fila.get('trip_id'))
+            try:
+                inicio, fin = _segundos_gtfs(fila['start_time']), _segundos_gtfs(fila['end_time'])
+            except (KeyError, ValueError):
+                continue
+            if viaje:
+                minimo, maximo = horarios.get(viaje[:2], (inicio, fin))
+                horarios[viaje[:2]] = (min(minimo, inicio), max(maximo, fin))
+
+    representativos = {}
+    for trip_id, total in conteos.items():
+        clave = viajes[trip_id][:2]
+        if clave not in representativos or total > conteos[representativos[clave]]:
+            representativos[clave] = trip_id
+
+    # Segunda pasada: secuencia de paradas solo de los viajes representativos
+    secuencias = {trip_id: [] for trip_id in representativos.values()}
+    for fila in _leer_csv_gtfs(zf, archivos['stop_times.txt']):
+        secuencia = secuencias.get(fila.get('trip_id'))
+        if secuencia is not None:
+            try:
+                secuencia.append((int(fila['stop_sequence']), fila['stop_id']))
+            except (KeyError, ValueError):
+                avisos.append(f"stop_time inválido en el viaje {fila.get('trip_id')}")
+
+    trazos = {}
+    necesarios = {viajes[t][2] for t in representativos.values() if viajes[t][2]}
+    if archivos['shapes.txt'] and necesarios:
+        for fila in _leer_csv_gtfs(zf, archivos['shapes.txt']):
+            if fila.get('shape_id') in necesarios:
+                try:
+                    trazos.setdefault(fila['shape_id'], []).append(
+                        (int(fila['shape_pt_sequence']), float(fila['shape_pt_lat']), float(fila['shape_pt_lon'])))
+                except (KeyError, ValueError):
+                    avisos.append(f"Punto de trazo inválido en {fila.get('shape_id')}")
+
+    sentidos = {}
+    for route_id, direccion in representativos:
+        sentidos[route_id] = sentidos.get(route_id, 0) + 1
+
+    plan_rutas = []
+    for (route_id, direccion), trip_id in sorted(representativos.items()):
+        ruta = rutas[route_id]
+        nombre = ruta['nombre']
+        if sentidos[route_id] > 1:
+            nombre += ' (regreso)' if direccion == '1' else ' (ida)'
+
+        # Una parada puede repetirse en circuitos; se conserva su primera aparición
+        ids_paradas = []
+        for _, stop_id in sorted(secuencias[trip_id]):
+            if stop_id in paradas and stop_id not in ids_paradas:
+                ids_paradas.append(stop_id)
+
+        shape_id = viajes[trip_id][2]
+        if shape_id in trazos:
+            coordenadas = [(lat, lon) for _, lat, lon in sorted(trazos[shape_id])]
+        else:
+            coordenadas = [(paradas[s]['lat'], paradas[s]['lon']) for s in ids_paradas]
+            avisos.append(f"Ruta '{nombre}' sin shapes.txt; se usa la secuencia de paradas como trazo")
+
+        horario = horarios.get((route_id, direccion))
+        plan_rutas.append({
+            'nombre': nombre[:100],
+            'color': ruta['color'],
+            'descripcion': ruta['descripcion'],
+            'horario_inicio': _time_desde_segundos(horario[0]) if horario else None,
+            'horario_fin': _time_desde_segundos(horario[1]) if horario else None,
+            'paradas': ids_paradas,
+            'coordenadas': coordenadas
+        })
+
+    return {'routes': plan_rutas, 'stops': paradas, 'warnings': avisos}
+
+def _emparejar_paradas(paradas):
+    """
+    Resuelve cada stop_id del feed a una parada existente en el mismo punto
+    (~10 m) o a la llave del punto de una parada nueva; el feed puede repetir
+    un mismo punto con distintos stop_id y todos comparten la misma parada.
+    Regresa ({stop_id: parada_id o llave}, {llave: datos de la parada nueva}).
+    """
+    existentes = {
+        (round(float(lat), 4), round(float(lon), 4)): parada_id
+        for parada_id, lat, lon in db.session.execute(db.select(Parada.id, Parada.latitud, Parada.longitud))
+    }
+    ids_paradas = {}
+    nuevas = {}
+    for stop_id, parada in paradas.items():
+        clave = (round(parada['lat'], 4), round(parada['lon'], 4))
+        if clave in existentes:
+            ids_paradas[stop_id] = existentes[clave]
+        else:
+            nuevas.setdefault(clave, parada)
+            ids_paradas[stop_id] = clave
+    return ids_paradas, nuevas
+
+def _paradas_de_ruta(ids_paradas, stop_ids):
+    """Paradas de una ruta en orden; una ruta circular o dos stop_id del mismo punto repiten la parada y se conserva la primera"""
+    return list(dict.fromkeys(ids_paradas[stop_id] for stop_id in stop_ids))
+
+def _insertar_en_lotes(modelo, filas):
+    lote = app.config['GTFS_IMPORT_BATCH']
+    for i in range(0, len(filas), lote):
+        db.session.execute(db.insert(modelo), filas[i:i + lote])
+
+def importar_gtfs(origen, dry_run=False):
+    """
+    Importa un feed GTFS (ruta o archivo zip) dentro de la transacción actual.
+    No hace commit; con dry_run solo valida y cuenta.
+    """
+    with zipfile.ZipFile(origen) as zf:
+        plan = planear_importacion_gtfs(zf)
+
+    ids_paradas, nuevas = _emparejar_paradas(plan['stops'])
+    paradas_rutas = [_paradas_de_ruta(ids_paradas, r['paradas']) for r in plan['routes']]
+    resumen = {
+        'dry_run': dry_run,
+        'routes_imported': len(plan['routes']),
+        'stops_imported': len(nuevas),
+        'stops_reused': sum(1 for v in ids_paradas.values() if not isinstance(v, tuple)),
+        'coordinates_imported': sum(len(r['coordenadas']) for r in plan['routes']),
+        'route_stops_imported': sum(len(p) for p in paradas_rutas),
+        'warnings': plan['warnings']
+    }
+    if dry_run:
+        return resumen
+
+    nuevas = {clave: Parada(nombre=parada['nombre'], latitud=parada['lat'], longitud=parada['lon'],
+                            descripcion=parada['descripcion'], tipo='secundaria')
+              for clave, parada in nuevas.items()}
+    db.session.add_all(nuevas.values())
+
+    rutas = [Ruta(nombre=r['nombre'], color=r['color'], descripcion=r['descripcion'], costo=8.00,
+                  horario_inicio=r['horario_inicio'], horario_fin=r['horario_fin'], activa=True)
+             for r in plan['routes']]
+    db.session.add_all(rutas)
+    db.session.flush()
+
+    for parada in nuevas.values():
+        registrar_cambio('parada', parada.id, propagar=False)
+
+    coordenadas = []
+    relaciones = []
+    for ruta, datos, paradas_ruta in zip(rutas, plan['routes'], paradas_rutas):
+        registrar_cambio('ruta', ruta.id)
+        coordenadas.extend({'ruta_id': ruta.id, 'latitud': lat, 'longitud': lon, 'orden': i}
+                           for i, (lat, lon) in enumerate(datos['coordenadas']))
+        relaciones.extend({'ruta_id': ruta.id, 'parada_id': nuevas[p].id if isinstance(p, tuple) else p, 'orden': i}
+                          for i, p in enumerate(paradas_ruta, 1))
+
+    _insertar_en_lotes(RutaCoordenada, coordenadas)
+    _insertar_en_lotes(RutaParada, relaciones)
+    return resumen
+
+@app.route('/api/admin/import-gtfs', methods=['POST'])
+@token_required
+def import_gtfs(current_user):
+    """Endpoint para subir un feed GTFS (.zip); ?dry_run=1 solo valida"""
+    if 'file' not in request.files:
+        return jsonify({'message': 'No se envió ningún archivo'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'message': 'No se seleccionó ningún archivo'}), 400
+    if not file.filename.lower().endswith('.zip'):
+        return jsonify({'message': 'Tipo de archivo no permitido. Solo feeds GTFS (.zip)'}), 400
+
+    dry_run = request.values.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    filename = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{secure_filename(file.filename)}"
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(filepath)
+
+    try:
+        resumen = importar_gtfs(filepath, dry_run=dry_run)
+        if not dry_run:
+            db.session.commit()
+    except (ValueError, KeyError, zipfile.BadZipFile) as e:
+        db.session.rollback()
+        return jsonify({'message': f'Feed GTFS inválido: {str(e)}'}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error al procesar el feed: {str(e)}'}), 500
+    finally:
+        if dry_run and os.path.exists(filepath):
+            os.remove(filepath)
+
+    mensaje = 'Feed GTFS validado (sin cambios)' if dry_run else 'Feed GTFS importado exitosamente'
+    return jsonify({'message': mensaje, **resumen}), 200
+
+@app.cli.command('import-gtfs')
+@click.argument('archivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Valida el feed y reporta conteos sin escribir')
+def import_gtfs_command(archivo, dry_run):
+    """Importa un feed GTFS (.zip) a rutas, paradas y trazos"""
+    inicio = time.perf_counter()
+    try:
+        resumen = importar_gtfs(archivo, dry_run=dry_run)
+        if not dry_run:
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise click.ClickException(f"No se pudo importar el feed: {e}")
+
+    for aviso in resumen['warnings']:
+        print(f"  ⚠ {aviso}")
+    print(f"{'Validación' if dry_run else 'Importación'} completada en {time.perf_counter() - inicio:.1f} s:")
+    print(f"  • Rutas: {resumen['routes_imported']}")
+    print(f"  • Paradas nuevas: {resumen['stops_imported']} (reutilizadas: {resumen['stops_reused']})")
+    print(f"  • Puntos de trazo: {resumen['coordinates_imported']}")
+    print(f"  • Paradas por ruta: {resumen['route_stops_imported']}")
+
 # ===================================================
 # ENDPOINT TEMPORAL: Asociar paradas existentes con rutas
 # ===================================================
@@ -770,6 +5083,8 @@ def fix_route_stops(current_user):
                 db.session.add(ruta_parada)
                 results['associations_created'] += 1
             
+            if paradas:
+                registrar_cambio('ruta', ruta.id)
             results['details'].append(f"Ruta '{ruta.nombre}' asociada con {len(paradas)} paradas")
         
         db.session.commit()
@@ -790,9 +5105,8 @@ def fix_route_stops(current_user):
 
 @app.route('/ver_rutas')
 def ver_rutas():
-    """Paso 1 READ: Listar todas las rutas"""
-    rutas = Ruta.query.all()
-    return render_template('rutas.html', rutas=rutas)
+    """Paso 1 READ: Listar todas las rutas (la tabla se llena por páginas desde /api/admin/routes)"""
+    return render_template('rutas.html', tamano_pagina=app.config['ADMIN_PAGE_SIZE'])
 
 @app.route('/nueva_ruta', methods=['GET', 'POST'])
 def nueva_ruta():
@@ -820,6 +5134,8 @@ def nueva_ruta():
         
         # Guardar en la base de datos
         db.session.add(nueva)
+        db.session.flush()
+        registrar_cambio('ruta', nueva.id)
         db.session.commit()
         
         # Redirigir a la página de edición para agregar puntos
@@ -849,13 +5165,22 @@ def editar_ruta(id):
         ruta.activa = request.form.get('activa') == '1'
         
         # Guardar cambios
+        registrar_cambio('ruta', ruta.id)
         db.session.commit()
         
         # Redirigir a la misma página
         return redirect(url_for('editar_ruta', id=id))
     
-    # GET: Mostrar formulario de edición con puntos
-    return render_template('editar_ruta.html', ruta=ruta)
+    # GET: Mostrar formulario de edición; los puntos se piden por páginas
+    # (tabla y mapa) a /api/admin/routes/<id>/points
+    limites = db.session.execute(db.select(
+        db.func.min(RutaCoordenada.latitud), db.func.min(RutaCoordenada.longitud),
+        db.func.max(RutaCoordenada.latitud), db.func.max(RutaCoordenada.longitud),
+        db.func.max(RutaCoordenada.orden)
+    ).where(RutaCoordenada.ruta_id == id)).one()
+    extension = [[float(limites[0]), float(limites[1])], [float(limites[2]), float(limites[3])]] if limites[0] is not None else None
+    return render_template('editar_ruta.html', ruta=ruta, extension=extension,
+                           siguiente_orden=(limites[4] or 0) + 1, tamano_pagina=app.config['ADMIN_PAGE_SIZE'])
 
 @app.route('/agregar_punto/<int:id_ruta>', methods=['POST'])
 def agregar_punto(id_ruta):
@@ -875,6 +5200,7 @@ def agregar_punto(id_ruta):
     
     # Guardar en la base de datos
     db.session.add(nuevo_punto)
+    registrar_cambio('ruta', id_ruta)
     db.session.commit()
     
     # Redirigir de vuelta a la edición de la ruta
@@ -891,6 +5217,7 @@ def borrar_punto(id_punto):
     
     # Borrar y commit
     db.session.delete(punto)
+    registrar_cambio('ruta', id_ruta)
     db.session.commit()
     
     # Redirigir de vuelta a la edición de la ruta
@@ -898,9 +5225,243 @@ def borrar_punto(id_punto):
 
 # FIN SECCIÓN CRUD
 
+# --- Migraciones del Esquema ---
+
+# Cada migración tiene un número de versión y se registra en esquema_versiones
+# al aplicarse. Deben poder repetirse sin efecto: una base de datos creada
+# antes de este registro no tiene versión y recorre todas desde la primera.
+# Los índices también están declarados en los modelos, así que una base nueva
+# los recibe desde la migración 1 y las siguientes solo confirman que existen.
+
+_migraciones = []
+
+def migracion(version, nombre):
+    """Registra una función como la migración `version` del esquema"""
+    def registrar(f):
+        _migraciones.append((version, nombre, f))
+        _migraciones.sort(key=lambda m: m[0])
+        return f
+    return registrar
+
+def _inspector():
+    return db.inspect(db.session.connection())
+
+def _columnas_existentes(tabla):
+    return {c['name'] for c in _inspector().get_columns(tabla)}
+
+def _indices_existentes(tabla):
+    inspector = _inspector()
+    nombres = {i['name'] for i in inspector.get_indexes(tabla)}
+    nombres.update(u['name'] for u in inspector.get_unique_constraints(tabla))
+    return nombres
+
+def _agregar_columna(modelo, columna):
+    if columna not in _columnas_existentes(modelo.__tablename__):
+        ddl = CreateColumn(modelo.__table__.c[columna]).compile(dialect=db.session.get_bind().dialect)
+        db.session.execute(db.text(f'ALTER TABLE {modelo.__tablename__} ADD COLUMN {ddl}'))
+
+def _crear_indice(modelo, nombre):
+    if nombre not in _indices_existentes(modelo.__tablename__):
+        indice = next(i for i in modelo.__table__.indexes if i.name == nombre)
+        indice.create(db.session.connection())
+
+@migracion(1, 'tablas iniciales')
+def _migracion_tablas_iniciales():
+    db.metadata.create_all(db.session.connection())
+
+@migracion(2, 'contadores de rutas')
+def _migracion_contadores_rutas():
+    for columna in ('num_coordenadas', 'num_paradas', 'longitud_m'):
+        _agregar_columna(Ruta, columna)
+    recalcular_contadores_rutas()
+
+@migracion(3, 'índices de coordenadas y paradas de ruta')
+def _migracion_indices_rutas():
+    # registrar_cambio ya numera los cambios con el contador de la migración 4
+    _migracion_version_red()
+
+    # El índice único no se puede crear si ya hay asociaciones repetidas; se conserva la primera
+    repetidas = db.session.execute(
+        db.select(db.func.min(RutaParada.id), RutaParada.ruta_id, RutaParada.parada_id)
+        .group_by(RutaParada.ruta_id, RutaParada.parada_id)
+        .having(db.func.count() > 1)).all()
+    for conservar, ruta_id, parada_id in repetidas:
+        db.session.execute(db.delete(RutaParada).where(
+            RutaParada.ruta_id == ruta_id, RutaParada.parada_id == parada_id, RutaParada.id != conservar))
+        registrar_cambio('ruta', ruta_id)
+
+    _crear_indice(RutaCoordenada, 'ix_ruta_coordenadas_ruta_orden')
+    _crear_indice(RutaParada, 'ix_ruta_paradas_ruta_orden')
+    _crear_indice(RutaParada, 'uq_ruta_paradas_ruta_parada')
+
+@migracion(4, 'versión de la red por orden de commit')
+def _migracion_version_red():
+    # Los cambios anteriores conservan su id como versión y el contador sigue desde el mayor
+    VersionRed.__table__.create(db.session.connection(), checkfirst=True)
+    _agregar_columna(CambioRed, 'version')
+    cambios = CambioRed.__table__
+    db.session.execute(cambios.update().where(cambios.c.version.is_(None)).values(version=cambios.c.id))
+    _crear_indice(CambioRed, 'ix_cambios_red_version')
+
+    ultima = db.session.scalar(db.select(db.func.max(CambioRed.version))) or 0
+    contador = db.session.get(VersionRed, 1)
+    if contador is None:
+        db.session.add(VersionRed(id=1, version=ultima))
+    else:
+        contador.version = max(contador.version, ultima)
+    db.session.flush()
+
+def version_esquema():
+    """Última migración aplicada (0 si la base de datos no tiene registro)"""
+    if not _inspector().has_table(VersionEsquema.__tablename__):
+        return 0
+    return db.session.scalar(db.select(db.func.max(VersionEsquema.version))) or 0
+
+def aplicar_migraciones(hasta=None):
+    """Aplica en orden las migraciones pendientes, cada una en su transacción"""
+    actual = version_esquema()
+    aplicadas = []
+    for version, nombre, funcion in _migraciones:
+        if version <= actual or (hasta is not None and version > hasta):
+            continue
+        try:
+            funcion()
+            db.session.add(VersionEsquema(version=version, nombre=nombre))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        aplicadas.append((version, nombre))
+    return aplicadas
+
+@app.cli.command('migrar')
+@click.option('--hasta', type=int, help='Aplicar solo hasta esta versión')
+@click.option('--estado', is_flag=True, help='Mostrar las migraciones sin aplicar nada')
+def migrar_command(hasta, estado):
+    """Crea o actualiza el esquema de la base de datos"""
+    if estado:
+        actual = version_esquema()
+        for version, nombre, _ in _migraciones:
+            click.echo(f"{'✓' if version <= actual else '·'} {version:3d}  {nombre}")
+        return
+    aplicadas = aplicar_migraciones(hasta)
+    for version, nombre in aplicadas:
+        click.echo(f'Aplicada {version}: {nombre}')
+    if not aplicadas:
+        click.echo(f'El esquema ya está en la versión {version_esquema()}')
+
+# Consultas frecuentes y el índice con el que el motor debe resolverlas
+_CONSULTAS_INDEXADAS = [
+    ('coordenadas de una ruta',
+     'SELECT latitud, longitud FROM ruta_coordenadas WHERE ruta_id = :ruta_id ORDER BY orden',
+     'ix_ruta_coordenadas_ruta_orden'),
+    ('paradas de una ruta',
+     'SELECT parada_id FROM ruta_paradas WHERE ruta_id = :ruta_id ORDER BY orden',
+     'ix_ruta_paradas_ruta_orden'),
+    ('página de puntos del editor',
+     'SELECT id, orden, latitud, longitud FROM ruta_coordenadas WHERE ruta_id = :ruta_id '
+     'AND (orden > :orden OR (orden = :orden AND id > :id)) ORDER BY orden, id LIMIT 101',
+     'ix_ruta_coordenadas_ruta_orden'),
+    ('cambios desde una versión',
+     'SELECT entidad, entidad_id, operacion FROM cambios_red WHERE version > :version ORDER BY version, id',
+     'ix_cambios_red_version'),
+    ('asociación ruta-parada',
+     'SELECT id FROM ruta_paradas WHERE ruta_id = :ruta_id AND parada_id = :parada_id',
+     'uq_ruta_paradas_ruta_parada'),
+]
+
+def verificar_indices():
+    """Regresa [(consulta, índice, lo usa, plan)] según el EXPLAIN del motor en uso"""
+    parametros = {'ruta_id': 1, 'parada_id': 1, 'orden': 1, 'id': 1, 'version': 1}
+    resultados = []
+    for nombre, sql, indice in _CONSULTAS_INDEXADAS:
+        if db.session.get_bind().dialect.name == 'sqlite':
+            filas = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql), parametros).all()
+            plan = '; '.join(f[-1] for f in filas)
+            usa = indice in plan and 'TEMP B-TREE' not in plan
+        else:
+            filas = db.session.execute(db.text('EXPLAIN ' + sql), parametros).mappings().all()
+            plan = '; '.join(f"{f['table']}: key={f['key']} {f['Extra'] or ''}".strip() for f in filas)
+            usa = any(f['key'] == indice for f in filas) and 'filesort' not in plan
+        resultados.append((nombre, indice, usa, plan))
+    return resultados
+
+@app.cli.command('verificar-indices')
+def verificar_indices_command():
+    """Comprueba con EXPLAIN que las consultas frecuentes usan sus índices"""
+    resultados = verificar_indices()
+    for nombre, indice, usa, plan in resultados:
+        click.echo(f"{'✓' if usa else '✗'} {nombre} ({indice}): {plan}")
+    if not all(usa for _, _, usa, _ in resultados):
+        raise SystemExit(1)
+
+# --- Arranque de la Aplicación ---
+
+def calentar_caches(peticiones=('/api/routes', '/api/stops', '/api/sync')):
+    """
+    Carga la red y los índices derivados antes de atender peticiones y hace
+    una petición de prueba a cada URL. Regresa los milisegundos de cada paso.
+    """
+    pasos = [
+        ('mapeos', sa_orm.configure_mappers),
+        ('version', sincronizar_cambios_red),
+        ('instantanea', snapshot_red),
+        ('plantillas', lambda: [app.jinja_env.get_template(nombre) for nombre in app.jinja_env.list_templates()]),
+        ('busqueda', indice_busqueda.cargar),
+        ('segmentos', indice_segmentos.cargar),
+        ('clusters', indice_clusters),
+        ('horarios', horarios),
+        ('isocronas', red_isocronas),
+        ('imagenes', manifiesto_imagenes),
+    ]
+    tiempos = {}
+    with app.app_context():
+        for nombre, paso in pasos:
+            inicio = time.perf_counter()
+            paso()
+            tiempos[nombre] = (time.perf_counter() - inicio) * 1000
+        db.session.remove()
+
+    cliente = app.test_client()
+    for url in peticiones:
+        inicio = time.perf_counter()
+        respuesta = cliente.get(url, environ_base={'combimap.interna': True})   # sin límite de peticiones
+        respuesta.close()
+        tiempos[f"GET {url}"] = (time.perf_counter() - inicio) * 1000
+    return tiempos
+
+def create_app(config=None, calentar=False):
+    """
+    Configura la aplicación para servirla. Con calentar=True carga las
+    cachés en el proceso actual; con un servidor pre-fork (gunicorn con
+    preload_app) eso ocurre una vez en el maestro y los workers comparten
+    la memoria copy-on-write.
+    """
+    if config:
+        app.config.update(config)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    if calentar:
+        inicio = time.perf_counter()
+        try:
+            tiempos = calentar_caches()
+        except exc.SQLAlchemyError as e:
+            app.logger.warning("No se pudieron precargar las cachés: %s", e)
+        else:
+            total = (time.perf_counter() - inicio) * 1000
+            detalle = ', '.join(f"{nombre} {ms:.0f} ms" for nombre, ms in tiempos.items())
+            print(f"Cachés precargadas en {total:.0f} ms ({detalle})", flush=True)
+        finally:
+            # Las conexiones abiertas no deben heredarse a los procesos hijos
+            with app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+    return app
+
 if __name__ == '__main__':
+    create_app()
     with app.app_context():
-        db.create_all()
+        aplicar_migraciones()
         if not User.query.filter_by(username='admin').first():
             admin = User(username='admin')
             admin.set_password('admin')
@@ -0,0 +1,289 @@
+"""
+Punto de entrada ASGI para producción:
+
+    gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app
+
+Las lecturas públicas que pasan la mayor parte del tiempo esperando E/S
+(/api/routes, /api/stops y /api/reverse-geocode) se atienden aquí con un
+driver asíncrono de base de datos (aiomysql / aiosqlite) y un cliente HTTP
+asíncrono, de modo que un proceso sostiene miles de conexiones lentas sin
+ocupar un hilo por cada una; lo mismo el stream de vehículos
+(/api/vehicles/stream), que solo lee la tabla compartida de posiciones.
+Todo lo demás (panel de administración, importaciones, exportaciones en
+streaming, etc.) lo sigue atendiendo la aplicación Flask, montada debajo y
+ejecutada en un pool de hilos.
+
+La lógica de negocio es la misma de app.py: serializadores, instantánea
+binaria de la red, limitador compartido y configuración. Para agregar otro
+endpoint asíncrono basta con escribir su función y registrarla en RUTAS.
+"""
+import contextlib
+import json
+import math
+import os
+import time
+
+import anyio
+import httpx
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import selectinload
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as combimap
+from app import app as flask_app, db, Ruta, RutaParada, Parada
+
+flask_app.config['ASYNC_DATABASE_URI'] = os.environ.get('COMBIMAP_ASYNC_DATABASE_URI')   # por omisión se deriva de SQLALCHEMY_DATABASE_URI
+flask_app.config['ASYNC_REPLICA_URI'] = os.environ.get('COMBIMAP_ASYNC_REPLICA_URI')
+flask_app.config['ASYNC_WSGI_THREADS'] = int(os.environ.get('COMBIMAP_THREADS', 4)) * 4   # hilos del pool de a2wsgi que ejecuta la aplicación Flask montada
+flask_app.config['VEHICLE_STREAM_ASYNC'] = True   # /api/vehicles/stream se atiende aquí (el mapa se suscribe)
+
+# Drivers síncronos de app.py y su equivalente asíncrono
+DRIVERS_ASINCRONOS = {
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'mysql+mysqlconnector': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+def url_asincrona(url):
+    """La misma base de datos con el driver asíncrono equivalente"""
+    url = make_url(url)
+    driver = DRIVERS_ASINCRONOS.get(url.drivername)
+    if driver is None:
+        raise ValueError(f"No hay driver asíncrono para {url.drivername}; usa COMBIMAP_ASYNC_DATABASE_URI")
+    return url.set(drivername=driver)
+
+def crear_motor(url):
+    url = url_asincrona(url)
+    opciones = {}
+    if not url.drivername.startswith('sqlite'):
+        # Mismo tamaño de pool que la aplicación síncrona
+        opciones = {k: v for k, v in flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'].items()
+                    if k in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')}
+    return create_async_engine(url, **opciones)
+
+# Motores, sesiones y cliente HTTP: se crean por worker al arrancar (no en el
+# maestro de gunicorn, cuyas conexiones no deben heredarse)
+recursos = {'sesiones': None, 'sesiones_replica': None, 'http': None}
+
+@contextlib.asynccontextmanager
+async def ciclo_de_vida(aplicacion):
+    config = flask_app.config
+    motores = [crear_motor(config['ASYNC_DATABASE_URI'] or config['SQLALCHEMY_DATABASE_URI'])]
+    recursos['sesiones'] = async_sessionmaker(motores[0], class_=AsyncSession, expire_on_commit=False)
+    replica = config['ASYNC_REPLICA_URI'] or config.get('SQLALCHEMY_BINDS', {}).get('replica', {}).get('url')
+    if replica:
+        motores.append(crear_motor(replica))
+    recursos['sesiones_replica'] = async_sessionmaker(motores[-1], class_=AsyncSession, expire_on_commit=False)
+    recursos['http'] = httpx.AsyncClient(headers=combimap.CABECERAS_NOMINATIM, timeout=config['NOMINATIM_TIMEOUT'])
+    try:
+        yield
+    finally:
+        await recursos['http'].aclose()
+        for motor in motores:
+            await motor.dispose()
+
+def sesion_de_lectura(request):
+    """Réplica para lecturas públicas, salvo que el cliente haya escrito hace poco (igual que en Flask)"""
+    try:
+        ultima_escritura = float(request.cookies.get(flask_app.config['REPLICA_STICKY_COOKIE'], 0))
+    except ValueError:
+        ultima_escritura = 0
+    if time.time() - ultima_escritura > flask_app.config['REPLICA_STICKY_SECONDS']:
+        return recursos['sesiones_replica']()
+    return recursos['sesiones']()
+
+# --- Instantánea de la Red ---
+
+def _refrescar_red():
+    with flask_app.app_context():
+        try:
+            combimap.sincronizar_cambios_red()
+            return combimap.snapshot_red()
+        finally:
+            db.session.remove()
+
+async def red_actual():
+    """
+    Instantánea de la red. Mientras nadie confirme cambios se sirve sin
+    tocar la base de datos; si quedó atrás, se aplica el registro de cambios
+    y se reconstruye en un hilo para no bloquear el event loop.
+    """
+    red = combimap.snapshot_vigente()
+    if red is None and flask_app.config['NETWORK_SNAPSHOT']:
+        red = await anyio.to_thread.run_sync(_refrescar_red)
+    return red
+
+# Cuerpos ya codificados de las respuestas que no dependen de la petición,
+# por versión de la red: con miles de clientes solo el primero las serializa
+_respuestas = {}
+
+def _cuerpo_en_cache(clave, version, generar):
+    guardada = _respuestas.get(clave)
+    if guardada is None or guardada[0] != version:
+        guardada = _respuestas[clave] = (version, json.dumps(generar(), ensure_ascii=False).encode('utf-8'))
+    return guardada[1]
+
+@contextlib.contextmanager
+def contexto_flask(request):
+    """Contexto de petición de Flask para url_for (URLs de imágenes) y config"""
+    with flask_app.test_request_context(request.url.path, base_url=str(request.base_url)):
+        yield
+
+# --- Límite de Peticiones ---
+
+def limitar(request, endpoint):
+    """Misma cubeta compartida que las peticiones de Flask; regresa la respuesta 429 o None"""
+    config = flask_app.config
+    costo = config['RATE_LIMIT_COSTS'].get(endpoint, config['RATE_LIMIT_DEFAULT_COST'])
+    if not config['RATE_LIMIT_ENABLED'] or not costo:
+        return None
+    cliente = combimap.cliente_de(request.headers.get('x-forwarded-for'), request.client.host if request.client else None)
+    permitido, fichas, espera = combimap.limitador.consumir(
+        cliente, endpoint, costo, config['RATE_LIMIT_CAPACITY'], config['RATE_LIMIT_REFILL'])
+    request.state.fichas_restantes = int(fichas)
+    if permitido:
+        # Las funciones asíncronas no toman cupo de API_MAX_CONCURRENT: esperar E/S no ocupa un hilo
+        return None
+    reintentar = max(1, math.ceil(espera))
+    return JSONResponse({'message': 'Demasiadas peticiones', 'retry_after': reintentar}, status_code=429,
+                        headers={'Retry-After': str(reintentar)})
+
+def _json(datos, status=200, request=None):
+    respuesta = datos if isinstance(datos, Response) else JSONResponse(datos, status_code=status)
+    if request is not None and hasattr(request.state, 'fichas_restantes'):
+        respuesta.headers['X-RateLimit-Remaining'] = str(request.state.fichas_restantes)
+    return respuesta
+
+# --- API para Ciudadanos ---
+
+async def get_routes(request):
+    if 'stream' in request.query_params:
+        return None
+    rechazo = limitar(request, 'get_routes')
+    if rechazo:
+        return rechazo
+
+    red = await red_actual()
+    with contexto_flask(request):
+        if red is not None:
+            cuerpo = _cuerpo_en_cache('rutas', red.version, lambda: [
+                combimap.serializar_vista_ruta(vista) for vista in red.rutas(solo_activas=True)])
+            return _json(Response(cuerpo, media_type='application/json'), request=request)
+
+        async with sesion_de_lectura(request) as sesion:
+            rutas = (await sesion.scalars(select(Ruta).where(Ruta.activa == True).options(
+                selectinload(Ruta.coordenadas),
+                selectinload(Ruta.paradas).joinedload(RutaParada.parada)
+            ))).all()
+        return _json([combimap.serializar_ruta(ruta) for ruta in rutas], request=request)
+
+async def get_all_stops(request):
+    if 'stream' in request.query_params:
+        return None
+    rechazo = limitar(request, 'get_all_stops')
+    if rechazo:
+        return rechazo
+
+    red = await red_actual()
+    with contexto_flask(request):
+        if 'lat' in request.query_params or 'lon' in request.query_params:
+            datos, status = combimap.paradas_cercanas_publicas(red, request.query_params)
+            return _json(datos, status, request)
+        if red is not None:
+            # Las URLs de las imágenes cambian con el manifiesto aunque la red no cambie
+            version = (red.version, combimap.contador_version_media.leer())
+            cuerpo = _cuerpo_en_cache('paradas', version, lambda: [
+                combimap.serializar_parada_con_imagenes(p) for p in red.paradas()])
+            return _json(Response(cuerpo, media_type='application/json'), request=request)
+
+        async with sesion_de_lectura(request) as sesion:
+            paradas = (await sesion.scalars(select(Parada))).all()
+        return _json([combimap.serializar_parada_con_imagenes(p) for p in paradas], request=request)
+
+async def reverse_geocode_api(request):
+    rechazo = limitar(request, 'reverse_geocode_api')
+    if rechazo:
+        return rechazo
+    lat = request.query_params.get('lat')
+    lon = request.query_params.get('lon')
+    if not lat or not lon:
+        return _json({"error": "Latitud y longitud son requeridas"}, 400, request)
+
+    try:
+        respuesta = await recursos['http'].get(combimap.url_geocodificacion(lat, lon))
+        respuesta.raise_for_status()
+        return _json({"address": combimap.direccion_geocodificada(respuesta.json())}, request=request)
+    except Exception as e:
+        print(f"Error con la API de Nominatim: {e}")
+        return _json({"error": "No se pudo obtener la dirección"}, 500, request)
+
+async def vehicles_stream(request):
+    """Server-Sent Events con las posiciones de los vehículos de las rutas indicadas"""
+    if combimap.modo_vehiculos() is None:
+        return _json({'message': 'No se reciben posiciones de vehículos'}, 503)
+    rechazo = limitar(request, 'vehicles_stream')
+    if rechazo:
+        return rechazo
+    rutas = combimap.ids_de_rutas(request.query_params.get('routes'))
+    intervalo = flask_app.config['VEHICLE_STREAM_INTERVAL']
+    fin = time.monotonic() + flask_app.config['VEHICLE_STREAM_MAX_SECONDS']
+    tabla = combimap.tabla_vehiculos
+
+    async def generar():
+        ultimo_seq = 0
+        yield 'retry: 3000\n\n'
+        # Al cerrarse, el navegador se reconecta y puede caer en otro worker
+        while time.monotonic() < fin:
+            esperado = time.monotonic() + 15
+            while tabla.secuencia() <= ultimo_seq and time.monotonic() < esperado:
+                await anyio.sleep(intervalo)
+            ultimo_seq, evento = combimap.eventos_vehiculos(rutas, ultimo_seq)
+            yield evento
+            await anyio.sleep(intervalo)
+
+    respuesta = StreamingResponse(generar(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    return _json(respuesta, request=request)
+
+# --- Aplicación ---
+
+flask_asgi = WSGIMiddleware(flask_app, workers=flask_app.config['ASYNC_WSGI_THREADS'])
+
+class ManejadorPublico:
+    """Atiende la ruta con la función asíncrona; si regresa None la petición sigue a Flask tal cual"""
+
+    def __init__(self, funcion):
+        self.funcion = funcion
+
+    async def __call__(self, scope, receive, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            return await flask_asgi(scope, receive, send)
+        respuesta = await self.funcion(Request(scope, receive))
+        if respuesta is None:
+            return await flask_asgi(scope, receive, send)
+        await respuesta(scope, receive, send)
+
+RUTAS = [
+    ('/api/routes', get_routes),
+    ('/api/stops', get_all_stops),
+    ('/api/reverse-geocode', reverse_geocode_api),
+    ('/api/vehicles/stream', vehicles_stream),
+]
+
+def create_asgi_app(calentar=True):
+    """Aplicación ASGI con la API pública asíncrona y Flask montada para el resto"""
+    combimap.create_app(calentar=calentar)
+    rutas = [Route(ruta, ManejadorPublico(funcion)) for ruta, funcion in RUTAS]
+    return Starlette(routes=rutas + [Mount('/', app=flask_asgi)], lifespan=ciclo_de_vida)
+
+app = create_asgi_app()
@@ -0,0 +1,25 @@
+"""
+Configuración de gunicorn; los valores se pueden ajustar con variables de entorno.
+
+Sirve para los dos puntos de entrada:
+
+    gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app   # recomendado
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Solo el worker ASGI sirve /api/vehicles/stream (SSE): con hilos, cada
+cliente del mapa ocuparía uno mientras tenga la página abierta. Con wsgi:app
+el stream responde 503 y el mapa consulta /api/vehicles periódicamente.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('COMBIMAP_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('COMBIMAP_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('COMBIMAP_THREADS', 4))   # hilos por worker con wsgi:app; con asgi:app, base de ASYNC_WSGI_THREADS
+timeout = int(os.environ.get('COMBIMAP_TIMEOUT', 120))  # importaciones KML/GTFS grandes
+
+# Cargar la aplicación (y sus cachés) en el maestro antes de crear los workers
+preload_app = True
+
+def post_fork(server, worker):
+    server.log.info("Worker %s listo (cachés heredadas del maestro)", worker.pid)
@@ -0,0 +1,369 @@
+"""
+Prueba de carga de CombiMap: simula teléfonos usando el mapa público
+(templates/map.html) y un administrador importando los KML de uploads/,
+contra un servidor levantado aparte y un sustituto local de Nominatim.
+
+    # 1) el servidor, apuntando al sustituto y confiando en X-Forwarded-For
+    #    (cada teléfono simulado manda su propia IP y tiene su cubeta de fichas)
+    COMBIMAP_NOMINATIM_URL=http://127.0.0.1:8089 COMBIMAP_TRUST_PROXY=1 \\
+        gunicorn -c gunicorn.conf.py wsgi:app
+    # 2) la prueba (levanta el sustituto en :8089)
+    python loadtest.py --url http://127.0.0.1:8000 --users 500 --duration 60
+
+Con --spawn la prueba levanta gunicorn con esas variables y lo detiene al
+final; con --asgi además usa el worker de uvicorn y asgi:app. El reporte JSON trae, por endpoint, rendimiento, latencias p50/p95/p99
+y tasas de error y de rechazo (429/503).
+"""
+import argparse
+import glob
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Centro de Teziutlán (el mismo que usa el mapa) y radio de los puntos simulados
+CENTRO = (19.8151, -97.3594)
+RADIO_GRADOS = 0.03                 # ~3 km
+BUSQUEDAS = ['centro', 'amila', 'san pedro', 'xoloco', 'foviste', 'mercado', 'parque']
+
+
+# --- Sustituto de Nominatim ---
+
+class _ManejadorNominatim(BaseHTTPRequestHandler):
+    """Responde /reverse como Nominatim, con una latencia simulada"""
+    latencia = 0.08
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        consulta = urllib.parse.urlparse(self.path)
+        parametros = urllib.parse.parse_qs(consulta.query)
+        if consulta.path != '/reverse' or 'lat' not in parametros or 'lon' not in parametros:
+            self.send_error(400)
+            return
+        time.sleep(self.latencia)
+        lat, lon = parametros['lat'][0], parametros['lon'][0]
+        cuerpo = json.dumps({
+            'place_id': 1,
+            'lat': lat,
+            'lon': lon,
+            'display_name': f'Calle simulada, Teziutlán, Puebla, México ({lat}, {lon})'
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+def iniciar_sustituto_nominatim(puerto, latencia):
+    _ManejadorNominatim.latencia = latencia
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), _ManejadorNominatim)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='nominatim', daemon=True).start()
+    return servidor
+
+
+# --- Registro de resultados ---
+
+class Registro:
+    """Latencias y códigos de estado por endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.muestras = {}          # endpoint -> [(status, ms)]
+
+    def anotar(self, endpoint, status, ms):
+        with self.lock:
+            self.muestras.setdefault(endpoint, []).append((status, ms))
+
+    def reporte(self, segundos):
+        endpoints = {}
+        todas = []
+        for endpoint, muestras in sorted(self.muestras.items()):
+            endpoints[endpoint] = _resumen(muestras, segundos)
+            todas.extend(muestras)
+        return {'total': _resumen(todas, segundos), 'endpoints': endpoints}
+
+def _percentil(ordenadas, p):
+    if not ordenadas:
+        return None
+    return round(ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * p / 100))], 2)
+
+def _resumen(muestras, segundos):
+    latencias = sorted(ms for _, ms in muestras)
+    total = len(muestras)
+    ok = sum(1 for status, _ in muestras if 200 <= status < 400)
+    limitadas = sum(1 for status, _ in muestras if status == 429)
+    descartadas = sum(1 for status, _ in muestras if status == 503)
+    errores = total - ok - limitadas - descartadas
+    return {
+        'requests': total,
+        'throughput_rps': round(total / segundos, 2) if segundos else None,
+        'ok': ok,
+        'rate_limited_429': limitadas,
+        'shed_503': descartadas,
+        'errors': errores,
+        'error_rate': round(errores / total, 4) if total else 0.0,
+        'rejection_rate': round((limitadas + descartadas) / total, 4) if total else 0.0,
+        'latency_ms': {
+            'p50': _percentil(latencias, 50),
+            'p95': _percentil(latencias, 95),
+            'p99': _percentil(latencias, 99),
+            'max': round(latencias[-1], 2) if latencias else None,
+            'mean': round(sum(latencias) / total, 2) if total else None
+        },
+        'status_codes': {str(c): sum(1 for s, _ in muestras if s == c) for c in sorted({s for s, _ in muestras})}
+    }
+
+
+# --- Clientes simulados ---
+
+class Cliente:
+    """Conexión keep-alive al servidor; cada petición queda en el registro"""
+
+    def __init__(self, url, registro, cabeceras=None, timeout=30):
+        partes = urllib.parse.urlparse(url)
+        self.host = partes.hostname
+        self.puerto = partes.port or (443 if partes.scheme == 'https' else 80)
+        self.clase = http.client.HTTPSConnection if partes.scheme == 'https' else http.client.HTTPConnection
+        self.registro = registro
+        self.cabeceras = cabeceras or {}
+        self.timeout = timeout
+        self.conexion = None
+
+    def pedir(self, endpoint, ruta, metodo='GET', cuerpo=None, cabeceras=None):
+        """Regresa (status, cuerpo); status 0 si falló la conexión"""
+        todas = dict(self.cabeceras, **(cabeceras or {}))
+        inicio = time.perf_counter()
+        for intento in range(2):
+            reutilizada = self.conexion is not None
+            try:
+                if self.conexion is None:
+                    self.conexion = self.clase(self.host, self.puerto, timeout=self.timeout)
+                self.conexion.request(metodo, ruta, body=cuerpo, headers=todas)
+                respuesta = self.conexion.getresponse()
+                datos = respuesta.read()
+                status = respuesta.status
+                if respuesta.will_close:
+                    self.cerrar()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # El servidor cerró la conexión keep-alive inactiva: se reconecta una vez, como un navegador
+                self.cerrar()
+                status, datos = 0, b''
+                if not reutilizada:
+                    break
+            except (OSError, http.client.HTTPException):
+                self.cerrar()
+                status, datos = 0, b''
+                break
+        self.registro.anotar(endpoint, status, (time.perf_counter() - inicio) * 1000)
+        return status, datos
+
+    def cerrar(self):
+        if self.conexion is not None:
+            self.conexion.close()
+            self.conexion = None
+
+def _punto_aleatorio(rng):
+    return (round(CENTRO[0] + rng.uniform(-RADIO_GRADOS, RADIO_GRADOS), 6),
+            round(CENTRO[1] + rng.uniform(-RADIO_GRADOS, RADIO_GRADOS), 6))
+
+def _bbox(lat, lon, zoom):
+    # Ventana aproximada de un teléfono (~400x800 px) al zoom dado
+    alto = 800 * 360 / (256 * 2 ** zoom)
+    ancho = alto / 2
+    return f"{lon - ancho:.6f},{lat - alto / 2:.6f},{lon + ancho:.6f},{lat + alto / 2:.6f}"
+
+def sesion_telefono(cliente, rng, pausa):
+    """Lo que hace un teléfono al abrir el mapa (ver templates/map.html)"""
+    lat, lon = _punto_aleatorio(rng)
+    # Carga del mapa: red completa, lista de rutas y paradas visibles
+    cliente.pedir('GET /api/sync', '/api/sync?since=0')
+    cliente.pedir('GET /api/routes', '/api/routes')
+    cliente.pedir('GET /api/stops/clusters', f'/api/stops/clusters?zoom=14&bbox={_bbox(*CENTRO, 14)}')
+    time.sleep(pausa * rng.uniform(1, 3))
+
+    # "Mi ubicación": dirección y parada más cercana
+    cliente.pedir('GET /api/reverse-geocode', f'/api/reverse-geocode?lat={lat}&lon={lon}')
+    cliente.pedir('GET /api/stops?lat&lon', f'/api/stops?lat={lat}&lon={lon}&radius_m=800')
+    time.sleep(pausa * rng.uniform(1, 3))
+
+    # Algunos movimientos del mapa y, a veces, una búsqueda
+    for _ in range(rng.randint(1, 3)):
+        zoom = rng.randint(13, 17)
+        lat, lon = _punto_aleatorio(rng)
+        cliente.pedir('GET /api/stops/clusters', f'/api/stops/clusters?zoom={zoom}&bbox={_bbox(lat, lon, zoom)}')
+        time.sleep(pausa * rng.uniform(0.5, 2))
+    if rng.random() < 0.3:
+        consulta = urllib.parse.quote(rng.choice(BUSQUEDAS))
+        cliente.pedir('GET /api/search', f'/api/search?q={consulta}&limit=8')
+
+def usuario_telefono(url, registro, fin, semilla, pausa):
+    """Un usuario abre el mapa una y otra vez; cada sesión es un teléfono (IP) distinto"""
+    rng = random.Random(semilla)
+    while time.monotonic() < fin:
+        ip = f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        cliente = Cliente(url, registro, {'X-Forwarded-For': ip, 'User-Agent': 'CombiMapLoadTest/1.0'})
+        try:
+            sesion_telefono(cliente, rng, pausa)
+        finally:
+            cliente.cerrar()
+        time.sleep(pausa * rng.uniform(1, 5))
+
+def _multipart(campos, nombre_archivo, contenido):
+    limite = uuid.uuid4().hex
+    partes = []
+    for nombre, valor in campos.items():
+        partes.append(f'--{limite}\r\nContent-Disposition: form-data; name="{nombre}"\r\n\r\n{valor}\r\n'.encode())
+    partes.append(f'--{limite}\r\nContent-Disposition: form-data; name="file"; filename="{nombre_archivo}"\r\n'
+                  f'Content-Type: application/vnd.google-earth.kml+xml\r\n\r\n'.encode())
+    partes.append(contenido + b'\r\n')
+    partes.append(f'--{limite}--\r\n'.encode())
+    return b''.join(partes), f'multipart/form-data; boundary={limite}'
+
+def usuario_administrador(url, registro, fin, semilla, intervalo, archivos, usuario, contrasena):
+    """Importa un KML de uploads/ cada `intervalo` segundos y consulta el resumen del panel"""
+    rng = random.Random(semilla)
+    cliente = Cliente(url, registro, {'X-Forwarded-For': '10.255.255.254', 'User-Agent': 'CombiMapLoadTest/1.0'},
+                      timeout=120)
+    status, datos = cliente.pedir('POST /api/login', '/api/login', 'POST',
+                                  json.dumps({'username': usuario, 'password': contrasena}),
+                                  {'Content-Type': 'application/json'})
+    if status != 200:
+        print(f"✗ No se pudo iniciar sesión como {usuario} (HTTP {status}); sin tráfico de administración",
+              file=sys.stderr)
+        return
+    token = json.loads(datos)['token']
+    while time.monotonic() < fin:
+        ruta = rng.choice(archivos)
+        with open(ruta, 'rb') as f:
+            cuerpo, tipo = _multipart({}, os.path.basename(ruta), f.read())
+        cliente.pedir('POST /api/admin/import-kml', '/api/admin/import-kml', 'POST', cuerpo,
+                      {'Content-Type': tipo, 'x-access-token': token})
+        cliente.pedir('GET /api/admin/summary', '/api/admin/summary', cabeceras={'x-access-token': token})
+        time.sleep(min(intervalo, max(0.0, fin - time.monotonic())))
+    cliente.cerrar()
+
+
+# --- Ejecución ---
+
+def esperar_servidor(url, limite=90):
+    cliente = Cliente(url, Registro(), timeout=5)
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        status, _ = cliente.pedir('espera', '/api/bases')
+        if status == 200:
+            cliente.cerrar()
+            return True
+        time.sleep(0.5)
+    return False
+
+def levantar_servidor(url, nominatim_url, asgi=False):
+    partes = urllib.parse.urlparse(url)
+    entorno = dict(os.environ,
+                   COMBIMAP_BIND=f"{partes.hostname}:{partes.port or 80}",
+                   COMBIMAP_NOMINATIM_URL=nominatim_url,
+                   COMBIMAP_TRUST_PROXY='1')
+    comando = ['-k', 'uvicorn_worker.UvicornWorker', 'asgi:app'] if asgi else ['wsgi:app']
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', *comando],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=entorno)
+
+def correr(args, registro):
+    archivos = sorted(glob.glob(os.path.join(args.uploads, '*.kml')))
+    fin = time.monotonic() + args.ramp + args.duration
+    hilos = []
+    for i in range(args.users):
+        hilo = threading.Thread(target=usuario_telefono, name=f'telefono-{i}', daemon=True,
+                                args=(args.url, registro, fin, args.seed + i, args.think))
+        hilos.append((args.ramp * i / max(1, args.users), hilo))
+    if args.admin_interval > 0 and archivos:
+        hilos.append((0, threading.Thread(target=usuario_administrador, name='admin', daemon=True,
+                                          args=(args.url, registro, fin, args.seed - 1, args.admin_interval,
+                                                archivos, args.admin_user, args.admin_password))))
+    elif args.admin_interval > 0:
+        print(f"⚠ No hay archivos KML en {args.uploads}; sin tráfico de administración", file=sys.stderr)
+
+    inicio = time.monotonic()
+    for retraso, hilo in sorted(hilos, key=lambda h: h[0]):
+        time.sleep(max(0.0, inicio + retraso - time.monotonic()))
+        hilo.start()
+    for _, hilo in hilos:
+        hilo.join(max(0.0, fin - time.monotonic()) + 150)
+    return time.monotonic() - inicio
+
+def imprimir(reporte):
+    print(f"\n{'endpoint':32s} {'peticiones':>10s} {'rps':>8s} {'p50':>8s} {'p95':>8s} {'p99':>8s} {'error':>7s} {'429/503':>8s}")
+    filas = list(reporte['endpoints'].items()) + [('TOTAL', reporte['total'])]
+    for endpoint, r in filas:
+        lat = r['latency_ms']
+        print(f"{endpoint:32s} {r['requests']:10d} {r['throughput_rps'] or 0:8.1f} "
+              f"{lat['p50'] or 0:8.1f} {lat['p95'] or 0:8.1f} {lat['p99'] or 0:8.1f} "
+              f"{r['error_rate']:7.2%} {r['rejection_rate']:8.2%}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga del mapa público y del panel de CombiMap')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='servidor a probar')
+    parser.add_argument('--users', type=int, default=100, help='usuarios (teléfonos) concurrentes')
+    parser.add_argument('--duration', type=float, default=60, help='segundos de carga sostenida')
+    parser.add_argument('--ramp', type=float, default=10, help='segundos para arrancar a todos los usuarios')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='escala de las pausas entre acciones (0 = sin pausas)')
+    parser.add_argument('--admin-interval', type=float, default=15,
+                        help='segundos entre importaciones KML del administrador (0 = sin administrador)')
+    parser.add_argument('--admin-user', default='admin')
+    parser.add_argument('--admin-password', default='admin')
+    parser.add_argument('--uploads', default='uploads', help='carpeta con los KML a importar')
+    parser.add_argument('--nominatim-port', type=int, default=8089)
+    parser.add_argument('--nominatim-latency', type=float, default=0.08, help='segundos por respuesta del sustituto')
+    parser.add_argument('--spawn', action='store_true', help='levantar gunicorn con el sustituto configurado')
+    parser.add_argument('--asgi', action='store_true', help='con --spawn, servir asgi:app (API pública asíncrona)')
+    parser.add_argument('--seed', type=int, default=2025)
+    parser.add_argument('--output', default='loadtest-report.json', help='reporte JSON')
+    args = parser.parse_args()
+
+    sustituto = iniciar_sustituto_nominatim(args.nominatim_port, args.nominatim_latency)
+    nominatim_url = f'http://127.0.0.1:{args.nominatim_port}'
+    servidor = levantar_servidor(args.url, nominatim_url, args.asgi) if args.spawn else None
+    if servidor is None:
+        print(f"Sustituto de Nominatim en {nominatim_url}; el servidor debe tener COMBIMAP_NOMINATIM_URL={nominatim_url}")
+
+    try:
+        if not esperar_servidor(args.url):
+            print(f"✗ El servidor no responde en {args.url}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Probando {args.url} con {args.users} usuarios durante {args.duration:.0f} s "
+              f"(+{args.ramp:.0f} s de arranque)...", flush=True)
+        registro = Registro()
+        segundos = correr(args, registro)
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+        sustituto.shutdown()
+
+    reporte = {
+        'url': args.url,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - segundos)),
+        'seconds': round(segundos, 2),
+        'config': {k: v for k, v in vars(args).items() if k != 'admin_password'},
+        **registro.reporte(segundos)
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(reporte, f, ensure_ascii=False, indent=2)
+    imprimir(reporte)
+    print(f"\nReporte en {args.output}")
+    if reporte['total']['error_rate'] > 0:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
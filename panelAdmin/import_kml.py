@@ -9,7 +9,12 @@ Descripción: Este script lee archivos KML y extrae rutas, coordenadas y paradas
 
 import sys
 import os
+import glob
+import math
+import argparse
 from pathlib import Path
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
 from xml.etree import ElementTree as ET
 import re
 import mysql.connector
@@ -31,15 +36,52 @@ KML_NAMESPACE = {
     'gx': 'http://www.google.com/kml/ext/2.2'
 }
 
+# Radio medio de la Tierra en metros (para la longitud de las rutas)
+RADIO_TIERRA_M = 6371000.0
+
+# Tipos de importación aceptados por la línea de comandos
+TIPOS_IMPORTACION = ('auto', 'routes', 'stops')
+
+# Tolerancia (en grados, ~10 metros) para considerar que una parada ya existe;
+# también es el tamaño de celda del índice de paradas en memoria
+TOLERANCIA_PARADA = 0.0001
+
+# Raíz del proyecto, para reutilizar la lógica de app.py (detección de
+# duplicados y contador de versión compartido por los workers)
+RAIZ_PROYECTO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app():
+    """Importa app.py solo cuando hace falta (el parseo y --dry-run no lo necesitan)"""
+    if RAIZ_PROYECTO not in sys.path:
+        sys.path.insert(0, RAIZ_PROYECTO)
+    import app
+    return app
+
+
+def route_length_m(coordinates):
+    """Longitud de un trazo [[lat, lon], ...] en metros (haversine), como la calcula app.py"""
+    total = 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(coordinates, coordinates[1:]):
+        d_lat = math.radians(lat2 - lat1)
+        d_lon = math.radians(lon2 - lon1)
+        a = math.sin(d_lat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon / 2) ** 2
+        total += 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+    return round(total, 1)
+
 
 class KMLImporter:
     """Clase para importar datos desde archivos KML"""
     
-    def __init__(self, db_config):
+    def __init__(self, db_config, allow_duplicates=False):
         """Inicializa el importador con la configuración de BD"""
         self.db_config = db_config
         self.connection = None
         self.cursor = None
+        self.stop_index = None  # Paradas existentes por celda, se carga al importar la primera
+        self.allow_duplicates = allow_duplicates
+        self.detector = None  # Trazos de las rutas existentes, se carga al importar la primera
+        self.pending_changes = []  # (entidad, id) escritos en la transacción en curso
         
     def connect_db(self):
         """Conecta a la base de datos"""
@@ -184,69 +226,102 @@ class KMLImporter:
             print(f"✗ Error al parsear KML: {e}")
             return []
     
-    def import_route(self, route_data):
+    def import_route(self, route_data, commit=True):
         """
-        Importa una ruta a la base de datos
+        Importa una ruta a la base de datos.
+        Con commit=False la ruta queda dentro de la transacción en curso
+        (la usa import_placemarks para escribir un archivo completo de una vez)
         """
         try:
             # Insertar ruta
             insert_route = """
-                INSERT INTO rutas (nombre, color, descripcion, costo, activa)
-                VALUES (%s, %s, %s, %s, %s)
+                INSERT INTO rutas (nombre, color, descripcion, costo, activa, num_coordenadas, longitud_m)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
             """
             self.cursor.execute(insert_route, (
                 route_data['name'],
                 route_data['color'],
                 route_data.get('description', ''),
                 8.00,  # Costo por defecto
-                True
+                True,
+                len(route_data['coordinates']),
+                route_length_m(route_data['coordinates'])
             ))
             
             route_id = self.cursor.lastrowid
+            self.pending_changes.append(('ruta', route_id))
             
-            # Insertar coordenadas
+            # Insertar coordenadas: executemany agrupa las filas en un solo
+            # INSERT de varios VALUES en lugar de una consulta por punto
             if route_data['coordinates']:
                 insert_coord = """
                     INSERT INTO ruta_coordenadas (ruta_id, latitud, longitud, orden)
                     VALUES (%s, %s, %s, %s)
                 """
-                for i, coord in enumerate(route_data['coordinates']):
-                    self.cursor.execute(insert_coord, (
-                        route_id,
-                        coord[0],  # latitud
-                        coord[1],  # longitud
-                        i
-                    ))
+                self.cursor.executemany(insert_coord, [
+                    (route_id, coord[0], coord[1], i)
+                    for i, coord in enumerate(route_data['coordinates'])
+                ])
             
-            self.connection.commit()
+            if not commit:
+                return route_id
+            
+            self.commit()
             print(f"  ✓ Ruta importada: {route_data['name']} (ID: {route_id})")
             return route_id
             
         except Error as e:
+            if not commit:
+                raise
             print(f"  ✗ Error al importar ruta '{route_data['name']}': {e}")
-            self.connection.rollback()
+            self.rollback()
             return None
     
-    def import_stop(self, stop_data):
+    def load_stop_index(self):
+        """
+        Carga las paradas existentes en una cuadrícula en memoria para
+        detectar duplicados sin consultar la base de datos por cada parada
+        """
+        self.stop_index = {}
+        self.cursor.execute("SELECT id, nombre, latitud, longitud FROM paradas")
+        for stop_id, name, lat, lon in self.cursor.fetchall():
+            self._index_stop(stop_id, name, float(lat), float(lon))
+    
+    def _index_stop(self, stop_id, name, lat, lon):
+        """Agrega una parada a la celda que le corresponde"""
+        key = (int(lat // TOLERANCIA_PARADA), int(lon // TOLERANCIA_PARADA))
+        self.stop_index.setdefault(key, []).append((stop_id, name, lat, lon))
+    
+    def find_nearby_stop(self, lat, lon):
+        """
+        Busca una parada existente dentro de la tolerancia (~10 metros).
+        Retorna: (id, nombre) o None
+        """
+        if self.stop_index is None:
+            self.load_stop_index()
+        
+        row = int(lat // TOLERANCIA_PARADA)
+        col = int(lon // TOLERANCIA_PARADA)
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                for stop_id, name, s_lat, s_lon in self.stop_index.get((row + d_row, col + d_col), ()):
+                    if abs(s_lat - lat) < TOLERANCIA_PARADA and abs(s_lon - lon) < TOLERANCIA_PARADA:
+                        return stop_id, name
+        return None
+    
+    def import_stop(self, stop_data, commit=True):
         """
-        Importa una parada a la base de datos
+        Importa una parada a la base de datos.
+        Retorna: (id, nueva) o None si hubo un error
         """
+        lat, lon = stop_data['coordinates'][0], stop_data['coordinates'][1]
         try:
             # Verificar si ya existe una parada cercana (dentro de 10 metros)
-            check_query = """
-                SELECT id, nombre FROM paradas 
-                WHERE ABS(latitud - %s) < 0.0001 AND ABS(longitud - %s) < 0.0001
-                LIMIT 1
-            """
-            self.cursor.execute(check_query, (
-                stop_data['coordinates'][0],
-                stop_data['coordinates'][1]
-            ))
-            
-            existing = self.cursor.fetchone()
+            existing = self.find_nearby_stop(lat, lon)
             if existing:
-                print(f"  ⚠ Parada ya existe cerca: {existing[1]} (ID: {existing[0]})")
-                return existing[0]
+                if commit:
+                    print(f"  ⚠ Parada ya existe cerca: {existing[1]} (ID: {existing[0]})")
+                return existing[0], False
             
             # Insertar parada
             insert_stop = """
@@ -255,22 +330,146 @@ class KMLImporter:
             """
             self.cursor.execute(insert_stop, (
                 stop_data['name'],
-                stop_data['coordinates'][0],  # latitud
-                stop_data['coordinates'][1],  # longitud
+                lat,
+                lon,
                 stop_data.get('description', ''),
                 'secundaria'  # Tipo por defecto
             ))
             
             stop_id = self.cursor.lastrowid
-            self.connection.commit()
+            self._index_stop(stop_id, stop_data['name'], lat, lon)
+            self.pending_changes.append(('parada', stop_id))
+            
+            if not commit:
+                return stop_id, True
+            
+            self.commit()
             print(f"  ✓ Parada importada: {stop_data['name']} (ID: {stop_id})")
-            return stop_id
+            return stop_id, True
             
         except Error as e:
+            # El índice en memoria pudo quedar con paradas que no se guardaron
+            self.stop_index = None
+            if not commit:
+                raise
             print(f"  ✗ Error al importar parada '{stop_data['name']}': {e}")
-            self.connection.rollback()
+            self.rollback()
             return None
     
+    def commit(self):
+        """
+        Confirma la transacción con sus entradas en el registro de cambios de
+        la red, como registrar_cambio en app.py: sin ellas la instantánea, los
+        índices de los workers y /api/sync seguirían sirviendo la red anterior.
+        La versión sale del contador red_version, actualizado justo antes del
+        commit para que las versiones se hagan visibles en orden.
+        """
+        version = None
+        if self.pending_changes:
+            self.cursor.execute("UPDATE red_version SET version = version + 1 WHERE id = 1")
+            self.cursor.execute("SELECT version FROM red_version WHERE id = 1")
+            row = self.cursor.fetchone()
+            if row is None:
+                raise Error(msg="Falta el contador red_version; aplica las migraciones (flask migrar)")
+            version = row[0]
+            insert_change = """
+                INSERT INTO cambios_red (entidad, entidad_id, operacion, creado, version)
+                VALUES (%s, %s, 'upsert', UTC_TIMESTAMP(), %s)
+            """
+            self.cursor.executemany(insert_change, [
+                (entity, entity_id, version) for entity, entity_id in dict.fromkeys(self.pending_changes)
+            ])
+        
+        self.connection.commit()
+        self.pending_changes = []
+        if version is not None:
+            self.notify_workers(version)
+    
+    def rollback(self):
+        """Revierte la transacción y olvida sus cambios pendientes"""
+        self.connection.rollback()
+        self.pending_changes = []
+    
+    def notify_workers(self, version):
+        """Sube el contador compartido para que los workers de esta máquina apliquen los cambios"""
+        try:
+            load_app().contador_version_red.subir(version)
+        except OSError as e:
+            # Los workers lo verán al consultar la base de datos (NETWORK_VERSION_POLL)
+            print(f"  ⚠ No se pudo avisar a los workers ({e}); verán la versión {version} en su siguiente consulta")
+    
+    def load_duplicate_detector(self):
+        """Carga los trazos de las rutas existentes con el mismo detector que usa la API de KML"""
+        self.detector = load_app().DetectorDuplicados()
+        self.cursor.execute("SELECT id, nombre FROM rutas")
+        names = dict(self.cursor.fetchall())
+        self.cursor.execute("SELECT ruta_id, latitud, longitud FROM ruta_coordenadas ORDER BY ruta_id, orden")
+        current, lats, lons = None, [], []
+        for route_id, lat, lon in self.cursor.fetchall():
+            if route_id != current:
+                if current is not None:
+                    self.detector.agregar(current, names.get(current), lats, lons)
+                current, lats, lons = route_id, [], []
+            lats.append(float(lat))
+            lons.append(float(lon))
+        if current is not None:
+            self.detector.agregar(current, names.get(current), lats, lons)
+    
+    def find_duplicate_route(self, route_data):
+        """
+        Ruta existente cuyo trazo duplica al de route_data (mismo criterio que
+        /api/admin/import-kml). Retorna la coincidencia o None
+        """
+        if self.allow_duplicates:
+            return None
+        if self.detector is None:
+            self.load_duplicate_detector()
+        lats = [c[0] for c in route_data['coordinates']]
+        lons = [c[1] for c in route_data['coordinates']]
+        return next((c for c in self.detector.buscar(lats, lons) if c['kind'] == 'duplicate'), None)
+    
+    def import_placemarks(self, placemarks, import_type='auto'):
+        """
+        Escribe los elementos de un archivo en una sola transacción.
+        Si alguno falla se revierte el archivo completo y se propaga el error.
+        Las rutas que duplican a una existente se omiten (salvo allow_duplicates).
+        Retorna: {'routes', 'duplicates', 'stops', 'existing_stops', 'coordinates'}
+        """
+        totals = {'routes': 0, 'duplicates': 0, 'stops': 0, 'existing_stops': 0, 'coordinates': 0}
+        added = []
+        try:
+            for placemark in placemarks:
+                if placemark['type'] == 'LineString' and import_type in ['auto', 'routes']:
+                    duplicate = self.find_duplicate_route(placemark)
+                    if duplicate:
+                        print(f"  ⚠ Ruta omitida: '{placemark['name']}' duplica a '{duplicate['name']}' "
+                              f"(ID: {duplicate['route_id']}, {duplicate['hausdorff_m']} m)")
+                        totals['duplicates'] += 1
+                        continue
+                    route_id = self.import_route(placemark, commit=False)
+                    added.append((route_id, placemark))
+                    totals['routes'] += 1
+                    totals['coordinates'] += len(placemark['coordinates'])
+                    
+                elif placemark['type'] == 'Point' and import_type in ['auto', 'stops']:
+                    _, nueva = self.import_stop(placemark, commit=False)
+                    totals['stops' if nueva else 'existing_stops'] += 1
+            
+            self.commit()
+            
+        except Error:
+            self.rollback()
+            self.stop_index = None
+            raise
+        
+        # Las rutas confirmadas también cuentan como existentes para los siguientes archivos
+        if self.detector is not None:
+            for route_id, placemark in added:
+                self.detector.agregar(route_id, placemark['name'],
+                                      [c[0] for c in placemark['coordinates']],
+                                      [c[1] for c in placemark['coordinates']])
+        return totals
+    
     def import_from_kml(self, kml_file, import_type='auto'):
         """
         Importa datos desde un archivo KML
@@ -293,38 +492,95 @@ class KMLImporter:
         
         print(f"✓ Se encontraron {len(placemarks)} elementos\n")
         
-        routes_imported = 0
-        stops_imported = 0
-        
-        for placemark in placemarks:
-            if placemark['type'] == 'LineString' and import_type in ['auto', 'routes']:
-                if self.import_route(placemark):
-                    routes_imported += 1
-                    
-            elif placemark['type'] == 'Point' and import_type in ['auto', 'stops']:
-                if self.import_stop(placemark):
-                    stops_imported += 1
+        try:
+            totals = self.import_placemarks(placemarks, import_type)
+        except Error as e:
+            print(f"✗ Error al importar {kml_file}: {e}")
+            return False
         
         print(f"\n{'='*60}")
         print(f"Importación completada:")
-        print(f"  • Rutas importadas: {routes_imported}")
-        print(f"  • Paradas importadas: {stops_imported}")
+        print(f"  • Rutas importadas: {totals['routes']} ({totals['duplicates']} duplicadas omitidas)")
+        print(f"  • Paradas importadas: {totals['stops']} ({totals['existing_stops']} ya existían)")
         print(f"{'='*60}\n")
         
         return True
     
+    def import_many(self, kml_files, import_type='auto', jobs=1, dry_run=False):
+        """
+        Importa varios archivos KML: el parseo se reparte en un pool de
+        procesos y este proceso escribe los resultados en orden, un archivo
+        por transacción, sobre la misma conexión.
+        Con dry_run=True solo se parsea y se reporta lo que se importaría.
+        """
+        print(f"\n{'='*60}")
+        modo = " (simulación, sin escribir)" if dry_run else ""
+        print(f"Importando {len(kml_files)} archivo(s) con {jobs} proceso(s){modo}")
+        print(f"{'='*60}\n")
+        
+        totals = {'routes': 0, 'duplicates': 0, 'stops': 0, 'existing_stops': 0, 'coordinates': 0}
+        empty = failed = 0
+        parse_seconds = write_seconds = 0.0
+        start = perf_counter()
+        width = len(str(len(kml_files)))
+        
+        for n, (kml_file, placemarks, seconds) in enumerate(parse_kml_files(kml_files, jobs), 1):
+            parse_seconds += seconds
+            prefix = f"[{n:{width}d}/{len(kml_files)}] {os.path.basename(kml_file)}"
+            
+            if not placemarks:
+                empty += 1
+                print(f"{prefix}: ⚠ sin elementos para importar")
+                continue
+            
+            if dry_run:
+                result = {
+                    'routes': sum(1 for p in placemarks if p['type'] == 'LineString' and import_type in ['auto', 'routes']),
+                    'duplicates': 0,
+                    'stops': sum(1 for p in placemarks if p['type'] == 'Point' and import_type in ['auto', 'stops']),
+                    'existing_stops': 0,
+                    'coordinates': sum(len(p['coordinates']) for p in placemarks
+                                       if p['type'] == 'LineString' and import_type in ['auto', 'routes'])
+                }
+            else:
+                write_start = perf_counter()
+                try:
+                    result = self.import_placemarks(placemarks, import_type)
+                except Error as e:
+                    failed += 1
+                    print(f"{prefix}: ✗ {e}")
+                    continue
+                finally:
+                    write_seconds += perf_counter() - write_start
+            
+            for key in totals:
+                totals[key] += result[key]
+            print(f"{prefix}: {result['routes']} ruta(s), {result['coordinates']} coords, "
+                  f"{result['stops']} parada(s)")
+        
+        elapsed = perf_counter() - start
+        print(f"\n{'='*60}")
+        print(f"Importación completada en {elapsed:.2f} s{modo}:")
+        print(f"  • Archivos: {len(kml_files)} ({empty} sin elementos, {failed} con error)")
+        print(f"  • Rutas importadas: {totals['routes']} ({totals['coordinates']} coordenadas, "
+              f"{totals['duplicates']} duplicadas omitidas)")
+        print(f"  • Paradas importadas: {totals['stops']} ({totals['existing_stops']} ya existían)")
+        print(f"  • Parseo: {parse_seconds:.2f} s acumulados en {jobs} proceso(s) | Escritura: {write_seconds:.2f} s")
+        if elapsed > 0:
+            print(f"  • Rendimiento: {len(kml_files) / elapsed:.1f} archivos/s, "
+                  f"{totals['coordinates'] / elapsed:,.0f} coordenadas/s")
+        print(f"{'='*60}\n")
+        
+        return failed == 0
+    
     def list_existing_routes(self):
         """Lista las rutas existentes en la base de datos"""
         try:
+            # Los contadores se mantienen al escribir (ver /api/admin/summary)
             query = """
-                SELECT r.id, r.nombre, r.color, r.activa, 
-                       COUNT(DISTINCT rc.id) as num_coordenadas,
-                       COUNT(DISTINCT rp.id) as num_paradas
-                FROM rutas r
-                LEFT JOIN ruta_coordenadas rc ON r.id = rc.ruta_id
-                LEFT JOIN ruta_paradas rp ON r.id = rp.ruta_id
-                GROUP BY r.id
-                ORDER BY r.id
+                SELECT id, nombre, color, activa, num_coordenadas, num_paradas, longitud_m
+                FROM rutas
+                ORDER BY id
             """
             self.cursor.execute(query)
             routes = self.cursor.fetchall()
@@ -335,7 +591,7 @@ class KMLImporter:
                 print(f"{'='*60}")
                 for route in routes:
                     status = "✓" if route[3] else "✗"
-                    print(f"{status} ID: {route[0]:3d} | {route[1]:30s} | Color: {route[2]} | Coords: {route[4]:3d} | Paradas: {route[5]:3d}")
+                    print(f"{status} ID: {route[0]:3d} | {route[1]:30s} | Color: {route[2]} | Coords: {route[4]:3d} | Paradas: {route[5]:3d} | {route[6] / 1000:.1f} km")
                 print(f"{'='*60}\n")
             else:
                 print("\n⚠ No hay rutas en la base de datos\n")
@@ -344,6 +600,61 @@ class KMLImporter:
             print(f"✗ Error al listar rutas: {e}")
 
 
+def parse_kml_file(kml_file):
+    """
+    Parsea un archivo KML (se ejecuta dentro de los procesos del pool)
+    Retorna: (archivo, placemarks, segundos)
+    """
+    start = perf_counter()
+    placemarks = KMLImporter(None).extract_placemarks(kml_file)
+    return kml_file, placemarks, perf_counter() - start
+
+
+def parse_kml_files(kml_files, jobs=1):
+    """
+    Parsea los archivos en paralelo y entrega los resultados en el mismo
+    orden de entrada, para que los IDs asignados no dependan de qué proceso
+    termine primero
+    """
+    if jobs <= 1 or len(kml_files) <= 1:
+        for kml_file in kml_files:
+            yield parse_kml_file(kml_file)
+        return
+    
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunksize = max(1, len(kml_files) // (jobs * 4))
+        yield from executor.map(parse_kml_file, kml_files, chunksize=chunksize)
+
+
+def collect_kml_files(paths):
+    """
+    Expande archivos, directorios (de forma recursiva) y patrones glob
+    a una lista de archivos .kml sin repetir
+    """
+    kml_files = []
+    seen = set()
+    
+    for pattern in paths:
+        path = Path(pattern)
+        if path.is_dir():
+            matches = sorted(p for p in path.rglob('*') if p.suffix.lower() == '.kml' and p.is_file())
+        elif path.is_file():
+            matches = [path]
+        else:
+            matches = sorted(Path(p) for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+        
+        if not matches:
+            print(f"⚠ Sin archivos KML en: {pattern}")
+        
+        for match in matches:
+            key = match.resolve()
+            if key not in seen:
+                seen.add(key)
+                kml_files.append(str(match))
+    
+    return kml_files
+
+
 def main():
     """Función principal"""
     print("""
@@ -352,46 +663,77 @@ def main():
     ╚════════════════════════════════════════════════════════════╝
     """)
     
+    parser = argparse.ArgumentParser(
+        prog='import_kml.py',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Importa rutas y paradas desde archivos KML.',
+        epilog="""Tipos de importación:
+  auto   - Importar todo (rutas y paradas) [por defecto]
+  routes - Importar solo rutas
+  stops  - Importar solo paradas
+
+Ejemplos:
+  python import_kml.py rutas_teziutlan.kml
+  python import_kml.py paradas.kml stops
+  python import_kml.py grabaciones/ --jobs 8
+  python import_kml.py "temporada/**/*.kml" --type routes --dry-run
+""")
+    parser.add_argument('paths', nargs='*', metavar='ruta',
+                        help='archivos .kml, directorios o patrones glob')
+    parser.add_argument('-t', '--type', dest='import_type', choices=TIPOS_IMPORTACION, default='auto',
+                        help='qué importar (auto, routes, stops)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='procesos para parsear en paralelo (por defecto: núcleos disponibles)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='solo parsear y mostrar lo que se importaría, sin tocar la base de datos')
+    parser.add_argument('--allow-duplicates', action='store_true',
+                        help='importar también las rutas cuyo trazo duplica a una existente')
+    args = parser.parse_args()
+    
+    # Compatibilidad con la forma anterior: import_kml.py <archivo.kml> [tipo]
+    if len(args.paths) > 1 and args.paths[-1] in TIPOS_IMPORTACION and not os.path.exists(args.paths[-1]):
+        args.import_type = args.paths.pop()
+    
+    if args.jobs < 1:
+        parser.error('--jobs debe ser al menos 1')
+    
+    kml_files = collect_kml_files(args.paths)
+    if args.paths and not kml_files:
+        print("✗ No se encontraron archivos KML para importar")
+        sys.exit(1)
+    
     # Crear instancia del importador
-    importer = KMLImporter(DB_CONFIG)
+    importer = KMLImporter(DB_CONFIG, allow_duplicates=args.allow_duplicates)
+    
+    if args.dry_run:
+        if not kml_files:
+            parser.print_help()
+            sys.exit(1)
+        importer.import_many(kml_files, args.import_type, min(args.jobs, len(kml_files)), dry_run=True)
+        return
     
-    # Conectar a la base de datos
+    # Conectar a la base de datos (una sola conexión para todas las escrituras)
     if not importer.connect_db():
         sys.exit(1)
     
     try:
-        if len(sys.argv) < 2:
-            print("Uso:")
-            print("  python import_kml.py <archivo.kml> [tipo]")
-            print("\nTipos de importación:")
-            print("  auto   - Importar todo (rutas y paradas) [por defecto]")
-            print("  routes - Importar solo rutas")
-            print("  stops  - Importar solo paradas")
-            print("\nEjemplos:")
-            print("  python import_kml.py rutas_teziutlan.kml")
-            print("  python import_kml.py paradas.kml stops")
+        if not kml_files:
+            parser.print_help()
             print("\n")
             importer.list_existing_routes()
         else:
-            kml_file = sys.argv[1]
-            import_type = sys.argv[2] if len(sys.argv) > 2 else 'auto'
-            
-            # Validar tipo
-            if import_type not in ['auto', 'routes', 'stops']:
-                print(f"✗ Tipo inválido: {import_type}")
-                print("Tipos válidos: auto, routes, stops")
-                sys.exit(1)
-            
             # Importar
-            importer.import_from_kml(kml_file, import_type)
+            ok = importer.import_many(kml_files, args.import_type, min(args.jobs, len(kml_files)))
             
             # Mostrar resumen
             importer.list_existing_routes()
             
+            if not ok:
+                sys.exit(1)
+            
     finally:
         importer.disconnect_db()
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,11 +1,24 @@
 const { createApp } = Vue;
 
+// Aplica un delta de /api/sync a una lista ordenada por id
+function mergeById(items, upserts, deletedIds) {
+    const byId = new Map(items.map(item => [item.id, item]));
+    deletedIds.forEach(id => byId.delete(id));
+    upserts.forEach(item => byId.set(item.id, item));
+    return Array.from(byId.values()).sort((a, b) => a.id - b.id);
+}
+
 const app = createApp({
     data() {
         return {
             map: null,
             routes: [],
             stops: [],
+            networkVersion: 0,
+            summary: {
+                routes: { total: 0, active: 0, without_stops: 0, coordinates: 0, stop_links: 0, length_km: 0 },
+                stops: { total: 0 },
+            },
             showCreateRouteModal: false,
             showCreateStopModal: false,
             showEditRouteModal: false,
@@ -15,6 +28,7 @@ const app = createApp({
             isUploading: false,
             drawControl: null,
             selectedFile: null,
+            allowDuplicates: false,
             importResults: {
                 routes_imported: 0,
                 stops_imported: 0,
@@ -39,8 +53,7 @@ const app = createApp({
     mounted() {
         this.checkAuth();
         this.initMap();
-        this.fetchRoutes();
-        this.fetchStops();
+        this.syncNetwork();
     },
     methods: {
         checkAuth() {
@@ -102,38 +115,42 @@ const app = createApp({
             this.isPlacingStop = true;
             L.DomUtil.addClass(this.map._container, 'crosshair-cursor');
         },
-        async fetchRoutes() {
+        async syncNetwork() {
+            // Trae solo lo que cambió desde la última versión conocida
             try {
-                const token = localStorage.getItem('token');
-                const response = await fetch('/api/admin/routes', {
-                    headers: {
-                        'x-access-token': token
-                    }
-                });
-                if (response.ok) {
-                    this.routes = await response.json();
+                const response = await fetch(`/api/sync?since=${this.networkVersion}`);
+                if (!response.ok) {
+                    console.error('Error al sincronizar rutas y paradas');
+                    return;
+                }
+                const delta = await response.json();
+                const routes = delta.routes.map(r => ({ id: r.id, name: r.name, color: r.color, active: r.active }));
+                const stops = delta.stops.map(s => ({ id: s.id, name: s.name, lat: s.lat, lon: s.lon }));
+                if (delta.full) {
+                    this.routes = mergeById([], routes, []);
+                    this.stops = mergeById([], stops, []);
                 } else {
-                    console.error('Error al obtener las rutas');
+                    this.routes = mergeById(this.routes, routes, delta.deleted.routes);
+                    this.stops = mergeById(this.stops, stops, delta.deleted.stops);
                 }
+                this.networkVersion = delta.version;
+                this.fetchSummary();
             } catch (error) {
-                console.error('Error obteniendo rutas:', error);
+                console.error('Error sincronizando rutas y paradas:', error);
             }
         },
-        async fetchStops() {
+        async fetchSummary() {
+            // Estadísticas de las tarjetas, calculadas en el servidor con los contadores de cada ruta
             try {
                 const token = localStorage.getItem('token');
-                const response = await fetch('/api/stops', { // Using the public endpoint for now
-                    headers: {
-                        'x-access-token': token
-                    }
+                const response = await fetch('/api/admin/summary', {
+                    headers: { 'x-access-token': token }
                 });
                 if (response.ok) {
-                    this.stops = await response.json();
-                } else {
-                    console.error('Error al obtener las paradas');
+                    this.summary = await response.json();
                 }
             } catch (error) {
-                console.error('Error obteniendo paradas:', error);
+                console.error('Error obteniendo el resumen:', error);
             }
         },
         async createRoute() {
@@ -149,7 +166,7 @@ const app = createApp({
                 });
 
                 if (response.ok) {
-                    this.fetchRoutes();
+                    this.syncNetwork();
                     this.showCreateRouteModal = false;
                     this.newRoute = { name: '', color: '#FF0000', coordinates: [] };
                 } else {
@@ -172,7 +189,7 @@ const app = createApp({
                 });
 
                 if (response.ok) {
-                    this.fetchStops();
+                    this.syncNetwork();
                     this.showCreateStopModal = false;
                     this.newStop = { name: '', lat: 0, lon: 0 };
                 } else {
@@ -195,7 +212,7 @@ const app = createApp({
                     }
                 });
                 if (response.ok) {
-                    this.fetchRoutes();
+                    this.syncNetwork();
                 } else {
                     console.error('Error al eliminar la ruta');
                 }
@@ -216,7 +233,7 @@ const app = createApp({
                     }
                 });
                 if (response.ok) {
-                    this.fetchStops();
+                    this.syncNetwork();
                 } else {
                     console.error('Error al eliminar la parada');
                 }
@@ -242,7 +259,7 @@ const app = createApp({
                 });
 
                 if (response.ok) {
-                    this.fetchRoutes();
+                    this.syncNetwork();
                     this.showEditRouteModal = false;
                     this.editingRoute = null;
                 } else {
@@ -270,7 +287,7 @@ const app = createApp({
                 });
 
                 if (response.ok) {
-                    this.fetchStops();
+                    this.syncNetwork();
                     this.showEditStopModal = false;
                     this.editingStop = null;
                 } else {
@@ -306,6 +323,7 @@ const app = createApp({
                 const token = localStorage.getItem('token');
                 const formData = new FormData();
                 formData.append('file', this.selectedFile);
+                if (this.allowDuplicates) formData.append('allow_duplicates', '1');
 
                 const response = await fetch('/api/admin/import-kml', {
                     method: 'POST',
@@ -329,8 +347,7 @@ const app = createApp({
                     }
                     
                     // Recargar listas
-                    await this.fetchRoutes();
-                    await this.fetchStops();
+                    await this.syncNetwork();
                 } else {
                     alert(`Error: ${data.message || 'No se pudo importar el archivo'}`);
                 }
@@ -361,8 +378,7 @@ const app = createApp({
                     alert(`✅ ${data.message}\n\nAsociaciones creadas: ${data.associations_created}\n\nDetalles:\n${data.details.join('\n')}`);
                     
                     // Recargar listas
-                    await this.fetchRoutes();
-                    await this.fetchStops();
+                    await this.syncNetwork();
                 } else {
                     alert(`Error: ${data.message || 'No se pudieron crear las asociaciones'}`);
                 }
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CARPETA = tempfile.mkdtemp(prefix='combimap-pruebas-')
+ARCHIVO_BD = os.path.join(CARPETA, 'combimap.db')
+
+# La URI se lee al importar app.py
+os.environ['COMBIMAP_DATABASE_URI'] = f'sqlite:///{ARCHIVO_BD}'
+sys.path.insert(0, RAIZ)
+
+import app as combimap  # noqa: E402
+
+
+@pytest.fixture
+def base_de_datos(monkeypatch):
+    """Base SQLite vacía dentro de un contexto de aplicación; se borra al terminar"""
+    monkeypatch.setattr(combimap, 'contador_version_red',
+                        combimap.ContadorCompartido(os.path.join(CARPETA, 'version_red.bin')))
+    with combimap.app.app_context():
+        yield combimap.db
+        combimap.db.session.remove()
+        combimap.db.engine.dispose()
+    os.remove(ARCHIVO_BD)
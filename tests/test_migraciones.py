@@ -0,0 +1,95 @@
+import pytest
+
+from app import (CambioRed, Parada, Ruta, RutaParada, VersionRed, _migraciones, aplicar_migraciones,
+                 verificar_indices, version_esquema)
+
+ULTIMA = _migraciones[-1][0]
+
+
+def _sql(db, *sentencias):
+    for sentencia in sentencias:
+        db.session.execute(db.text(sentencia))
+    db.session.commit()
+
+
+def _indices(db, tabla):
+    return {i['name'] for i in db.inspect(db.session.connection()).get_indexes(tabla)}
+
+
+def _base_anterior_al_registro(db):
+    """Esquema como lo dejaba db.create_all() antes de las migraciones versionadas"""
+    db.create_all()
+    db.session.add_all([Ruta(id=1, nombre='Centro', color='#FF0000'),
+                        Parada(id=1, nombre='Zócalo', latitud=19.8, longitud=-97.36)])
+    db.session.commit()
+    _sql(db,
+         'DROP TABLE esquema_versiones',
+         'DROP TABLE red_version',
+         'DROP INDEX ix_cambios_red_version',
+         'ALTER TABLE cambios_red DROP COLUMN version',
+         'DROP INDEX ix_ruta_coordenadas_ruta_orden',
+         'DROP INDEX ix_ruta_paradas_ruta_orden',
+         'DROP INDEX uq_ruta_paradas_ruta_parada',
+         'ALTER TABLE rutas DROP COLUMN num_coordenadas',
+         'ALTER TABLE rutas DROP COLUMN num_paradas',
+         'ALTER TABLE rutas DROP COLUMN longitud_m',
+         "INSERT INTO cambios_red (entidad, entidad_id, operacion, creado) VALUES ('ruta', 1, 'upsert', '2024-01-01')",
+         "INSERT INTO cambios_red (entidad, entidad_id, operacion, creado) VALUES ('parada', 1, 'upsert', '2024-01-01')",
+         'INSERT INTO ruta_paradas (ruta_id, parada_id, orden) VALUES (1, 1, 0)',
+         'INSERT INTO ruta_paradas (ruta_id, parada_id, orden) VALUES (1, 1, 1)')
+
+
+def test_base_nueva_recorre_todas_las_migraciones(base_de_datos):
+    aplicadas = aplicar_migraciones()
+
+    assert [version for version, _ in aplicadas] == [version for version, _, _ in _migraciones]
+    assert version_esquema() == ULTIMA
+
+
+@pytest.mark.parametrize('preparar', [lambda db: None, _base_anterior_al_registro], ids=['nueva', 'anterior'])
+def test_consultas_frecuentes_usan_sus_indices(base_de_datos, preparar):
+    preparar(base_de_datos)
+    aplicar_migraciones()
+
+    resultados = verificar_indices()
+
+    assert resultados
+    for nombre, indice, usa, plan in resultados:
+        assert usa, f'{nombre} no usa {indice}: {plan}'
+
+
+def test_aplicar_dos_veces_no_cambia_nada(base_de_datos):
+    aplicar_migraciones()
+    indices = {tabla: _indices(base_de_datos, tabla) for tabla in ('ruta_coordenadas', 'ruta_paradas', 'cambios_red')}
+
+    assert aplicar_migraciones() == []
+    assert version_esquema() == ULTIMA
+    assert {tabla: _indices(base_de_datos, tabla) for tabla in indices} == indices
+
+
+def test_aplicar_por_partes(base_de_datos):
+    assert [version for version, _ in aplicar_migraciones(hasta=2)] == [1, 2]
+    assert version_esquema() == 2
+
+    assert [version for version, _ in aplicar_migraciones()] == list(range(3, ULTIMA + 1))
+    assert aplicar_migraciones() == []
+
+
+def test_base_anterior_al_registro(base_de_datos):
+    _base_anterior_al_registro(base_de_datos)
+
+    aplicadas = aplicar_migraciones()
+
+    assert [version for version, _ in aplicadas] == [version for version, _, _ in _migraciones]
+    assert RutaParada.query.count() == 1
+    ruta = base_de_datos.session.get(Ruta, 1)
+    assert (ruta.num_paradas, ruta.num_coordenadas) == (1, 0)
+
+    # Los cambios anteriores conservan su id como versión y el contador sigue después
+    versiones = [version for (version,) in base_de_datos.session.query(CambioRed.version).order_by(CambioRed.id)]
+    assert versiones[:2] == [1, 2]
+    assert versiones == sorted(versiones)
+    assert base_de_datos.session.get(VersionRed, 1).version == versiones[-1]
+
+    assert aplicar_migraciones() == []
+    assert version_esquema() == ULTIMA
@@ -0,0 +1,27 @@
+"""
+Punto de entrada WSGI para producción:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Sin el stream SSE de vehículos (el mapa las consulta periódicamente); para
+servirlo se usa asgi.py con el worker de uvicorn (ver gunicorn.conf.py).
+
+Con preload_app la aplicación se importa y se calienta una sola vez en el
+proceso maestro; los workers heredan la red y los índices ya cargados.
+"""
+import gc
+import time
+
+inicio = time.perf_counter()
+from app import create_app  # noqa: E402
+importacion = (time.perf_counter() - inicio) * 1000
+
+app = create_app(calentar=True)
+
+print(f"Arranque en frío: {(time.perf_counter() - inicio) * 1000:.0f} ms "
+      f"(importación {importacion:.0f} ms)", flush=True)
+
+# Mover los objetos ya creados a la generación permanente: el recolector no
+# los vuelve a recorrer, y así los workers no tocan (ni copian) esas páginas
+gc.collect()
+gc.freeze()